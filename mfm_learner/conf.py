@@ -1,4 +1,5 @@
 CONF_PATH = "./conf/config.yml"
 DATA_DIR = "./data"
 BAR_DIR = DATA_DIR + "/bar"
+INDUSTRY_MAPPING_FILE = DATA_DIR + "/industry_mapping_sw2014.json" # 行业中文名=>申万2014一级行业代码
 DATE_COLUMNS=['trade_date','datetime','date','ann_date']
\ No newline at end of file
@@ -1,13 +1,23 @@
 import functools
+import hashlib
+import inspect
+import json
 import logging
 import os
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import pandas as pd
-from pandas import DataFrame
+from pandas import DataFrame, Series
 
 from mfm_learner.datasource.impl.fields_mapper import MAPPER
-from mfm_learner.utils import CONF
+from mfm_learner.utils import CONF, utils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows下没有，就不加锁了
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +40,7 @@ def post_query(func):
     :return:
     """
 
+    @functools.wraps(func)
     def wrapper_it(*args, **kw):
         df = func(*args, **kw)
         if type(df) != DataFrame:
@@ -41,77 +52,269 @@ def post_query(func):
     return wrapper_it
 
 
-def _get_cache_file_name(dir, func, args, kwargs):
-    args = list(args) + list(kwargs.values())  # 获得所有的参数值
-    args = [arg for arg in args if arg is not None] # 去掉None的参数
-    file_name = "_".join(args)
-    file_name = "{}_{}.csv".format(func, file_name)
-    file_path = os.path.join(dir, file_name)
-    return file_path
-
-
-def _get_cache(dir, func, args, kwargs, str_fields=None):
-    """
-    :param func:
-    :param stock_code:
-    :param start_date:
-    :param end_date:
-    :param str_fields: 要转换成字符串的列名，逗号分隔
-    :return:
-    """
-    file_path = _get_cache_file_name(dir, func, args, kwargs)
-    if not os.path.exists(file_path): return None
-    df = pd.read_csv(file_path)
-    logger.debug("使用%s_%r缓存数据%d条", func, args, len(df))
-    # 'Unnamed: 0'，是观察出来的，第一列设置成index，原始的tushare就是这样的index结构
-    df = df.set_index("Unnamed: 0")
-
-    # 由于从csv加载，很多字段被整成int，不行，得转回str
-    default_str = ['trade_date', 'ann_date', 'ts_code'] # 默认要转的
-    if str_fields:
-        str_fields = str_fields.split(",")
-        str_fields += default_str
-    else:
-        str_fields = default_str
-
-    for str_field in str_fields:
-        if str_field in df.columns: df[str_field] = df[str_field].astype(str)
-
-    if len(df.columns)==1: df = df.iloc[:,0] # 如果只有一列，转成Series
+MAX_CACHE_SIZE = 2 * 1024 * 1024 * 1024  # 每个缓存目录最多2G，超过了，按照最久未使用(LRU)淘汰
+CACHE_INDEX_FILE = "cache_index.json"  # 缓存目录中的索引文件，记录每个缓存文件的参数、日期范围、大小、schema等
+RANGE_DATE_COLUMNS = ['trade_date', 'ann_date', 'cal_date']  # 可以做日期区间合并的日期列（rename之前的原始列名）
 
-    return df
 
+@contextmanager
+def _file_lock(lock_path):
+    """进程间的文件锁（排他），没有fcntl的系统上不加锁"""
+    with open(lock_path, 'a') as f:
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
 
-def _set_cache(dir, func, df, args, kwargs):
-    if not os.path.exists(dir): os.makedirs(dir)
-    file_path = _get_cache_file_name(dir, func, args, kwargs)
-    logger.debug("缓存%s_%r数据=>%s", func, list(args) + list(kwargs.values()), file_path)
-    df.to_csv(file_path)
 
+class DataCache():
+    """
+    二进制的缓存，用pickle保存，可以保留原始的dtype和index，不用再像csv那样，手工把trade_date等转回str了。
+
+    - 一个缓存目录一个实例，目录中有个索引文件(cache_index.json)，记录每个缓存文件的：函数、参数、日期范围、大小、schema、最后访问时间
+    - 加载的时候，会校验一下schema（列名+dtype），不一致就当做没有缓存，重新去取
+    - 日期区间合并：如果参数中有start_date、end_date，那么，缓存的是一段日期范围的数据，
+      比如，已经缓存了2018~2019的，再请求2018~2020的，只会去取2020的增量，然后合并回缓存
+    - 目录总大小超过max_size的时候，按照最后访问时间，淘汰最久没用的缓存
+    - hit/miss/merge计数，可以看缓存的效果
+    - 多进程共用一个目录：保存索引的时候，加文件锁，先读出磁盘上的索引，把自己的改动（新增、删除、访问时间）合并进去，
+      再按照合并后的索引做LRU淘汰，这样别的进程的缓存文件不会被丢掉（变成孤儿文件），max_size也是对整个目录生效的
+    - 命中缓存只更新内存中的最后访问时间，不写索引，等下次保存/淘汰的时候，再一起写进去
+    """
 
-def cache(dir,str_fields=None):
+    def __init__(self, dir, max_size=MAX_CACHE_SIZE):
+        self.dir = dir
+        self.max_size = max_size
+        self.hit = 0
+        self.miss = 0
+        self.merge = 0
+        if not os.path.exists(dir): os.makedirs(dir)
+        self.index_path = os.path.join(dir, CACHE_INDEX_FILE)
+        self.lock_path = self.index_path + ".lock"
+        self.index = self.__load_index()
+        self.saved = set()  # 还没写到索引文件里的改动：新增的、删除的、访问过的
+        self.removed = set()
+        self.accessed = {}
+
+    def __str__(self):
+        return f"缓存[{self.dir}]: 命中{self.hit}次，未命中{self.miss}次，增量合并{self.merge}次，" \
+               f"{len(self.index)}个文件，{sum(e['size'] for e in self.index.values()) / 1024 / 1024:.1f}M"
+
+    def __load_index(self):
+        if not os.path.exists(self.index_path): return {}
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def __save_index(self, keep=None):
+        with _file_lock(self.lock_path):
+            index = self.__load_index()
+            for file_name in self.removed:
+                index.pop(file_name, None)
+            for file_name in self.saved:
+                if file_name in self.index: index[file_name] = self.index[file_name]
+            for file_name, last_access in self.accessed.items():
+                if file_name in index:
+                    index[file_name]['last_access'] = max(index[file_name]['last_access'], last_access)
+            self.index = index
+            self.saved, self.removed, self.accessed = set(), set(), {}
+            self.__evict(keep)
+
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+
+    def __key(self, func, params):
+        return func + ":" + repr(sorted(params.items()))
+
+    def __schema(self, data):
+        if isinstance(data, DataFrame):
+            return {str(c): str(t) for c, t in data.dtypes.items()}
+        if isinstance(data, Series):
+            return {str(data.name): str(data.dtype)}
+        return {'type': type(data).__name__}
+
+    def __date_column(self, data):
+        if not isinstance(data, DataFrame): return None
+        for c in RANGE_DATE_COLUMNS:
+            if c in data.columns: return c
+        return None
+
+    def __load(self, file_name):
+        entry = self.index[file_name]
+        file_path = os.path.join(self.dir, file_name)
+        try:
+            data = pd.read_pickle(file_path)
+        except Exception:
+            logger.warning("缓存文件[%s]加载失败，丢弃", file_path)
+            self.__remove(file_name)
+            return None
+        if self.__schema(data) != entry['schema']:
+            logger.warning("缓存文件[%s]的schema和索引中记录的不一致，丢弃", file_path)
+            self.__remove(file_name)
+            return None
+        entry['last_access'] = self.accessed[file_name] = time.time()
+        return data
+
+    def __save(self, func, key, data, start_date=None, end_date=None, date_column=None):
+        file_name = "{}_{}.pkl".format(func, hashlib.md5(f"{key}|{start_date}|{end_date}".encode('utf-8')).hexdigest())
+        file_path = os.path.join(self.dir, file_name)
+        temp_path = f"{file_path}.{os.getpid()}.tmp"
+        pd.to_pickle(data, temp_path)
+        os.replace(temp_path, file_path)
+        self.index[file_name] = {
+            'key': key,
+            'start_date': start_date,
+            'end_date': end_date,
+            'date_column': date_column,
+            'schema': self.__schema(data),
+            'size': os.path.getsize(file_path),
+            'last_access': time.time()
+        }
+        self.saved.add(file_name)
+        self.removed.discard(file_name)
+        self.__save_index(keep=file_name)
+        return file_name
+
+    def __remove(self, file_name):
+        file_path = os.path.join(self.dir, file_name)
+        if os.path.exists(file_path): os.remove(file_path)
+        self.index.pop(file_name, None)
+        self.saved.discard(file_name)
+        self.removed.add(file_name)
+        self.__save_index()
+
+    def __evict(self, keep=None):
+        """超过最大的缓存大小，按照最后访问时间，从旧到新淘汰，在__save_index的锁里调用"""
+        total_size = sum(e['size'] for e in self.index.values())
+        for file_name, entry in sorted(self.index.items(), key=lambda x: x[1]['last_access']):
+            if total_size <= self.max_size: break
+            if file_name == keep: continue
+            total_size -= entry['size']
+            logger.debug("缓存超过%.0fM，淘汰最久未使用的缓存：%s", self.max_size / 1024 / 1024, file_name)
+            file_path = os.path.join(self.dir, file_name)
+            if os.path.exists(file_path): os.remove(file_path)
+            self.index.pop(file_name)
+
+    def __find_range(self, key, start_date):
+        """找到同样参数(除日期外)的、覆盖了start_date的、结束日期最晚的那个缓存"""
+        found = None
+        for file_name, entry in self.index.items():
+            if entry['key'] != key or entry['start_date'] is None: continue
+            if not (entry['start_date'] <= start_date <= entry['end_date']): continue
+            if found is None or entry['end_date'] > self.index[found]['end_date']:
+                found = file_name
+        return found
+
+    def __concat_sorted(self, data, df_delta, date_column):
+        """
+        合并增量，并按日期重新排序，方向和数据源返回的一致（tushare是日期倒序的），
+        不然直接concat的话，是[旧的倒序...,新的倒序...]，和不走缓存直接调用的顺序不一样
+        """
+        dates = data[date_column] if len(data) > 1 else df_delta[date_column]
+        ascending = len(dates) < 2 or dates.iloc[0] <= dates.iloc[-1]
+        data = pd.concat([data, df_delta], ignore_index=True)
+        return data.sort_values(date_column, ascending=ascending, kind='stable', ignore_index=True)
+
+    def __slice(self, df, date_column, start_date, end_date):
+        return df[(df[date_column] >= start_date) & (df[date_column] <= end_date)].copy()
+
+    def get_or_call(self, func, params, call):
+        """
+        :param func: 函数名
+        :param params: 函数的参数（不含self），dict
+        :param call: 真正的调用函数，参数是params
+        """
+        start_date, end_date = params.get('start_date'), params.get('end_date')
+        if type(start_date) != str or type(end_date) != str:
+            return self.__get_or_call_exactly(func, params, call)
+
+        key = self.__key(func, {k: v for k, v in params.items() if k not in ['start_date', 'end_date']})
+        file_name = self.__find_range(key, start_date)
+        data = self.__load(file_name) if file_name else None
+        if data is None:
+            # 整个区间都没缓存，看结果有没有日期列，有的话，按照日期区间缓存，否则，就只能按照参数精确缓存了
+            self.miss += 1
+            data = call(**params)
+            date_column = self.__date_column(data)
+            if date_column:
+                self.__save(func, key, data, start_date, end_date, date_column)
+            else:
+                self.__save(func, self.__key(func, params), data)
+            logger.debug("未命中缓存 %s%r，%s", func, params, self)
+            return data
+
+        entry = self.index[file_name]
+        if entry['end_date'] >= end_date:
+            self.hit += 1
+            logger.debug("命中缓存 %s%r，%s", func, params, self)
+            return self.__slice(data, entry['date_column'], start_date, end_date)
+
+        # 部分命中，只去取缺的那一段，然后合并回原来的缓存
+        self.merge += 1
+        delta_params = dict(params, start_date=utils.tomorrow(entry['end_date']))
+        df_delta = call(**delta_params)
+        logger.debug("缓存%s~%s，增量获取%s~%s的数据%d条",
+                     entry['start_date'], entry['end_date'], delta_params['start_date'], end_date, len(df_delta))
+        if len(df_delta) > 0:
+            data = self.__concat_sorted(data, df_delta, entry['date_column'])
+        self.__remove(file_name)
+        self.__save(func, key, data, entry['start_date'], end_date, entry['date_column'])
+        return self.__slice(data, entry['date_column'], start_date, end_date)
+
+    def __get_or_call_exactly(self, func, params, call):
+        key = self.__key(func, params)
+        for file_name, entry in list(self.index.items()):
+            if entry['key'] != key or entry['start_date'] is not None: continue
+            data = self.__load(file_name)
+            if data is not None:
+                self.hit += 1
+                logger.debug("命中缓存 %s%r，%s", func, params, self)
+                return data
+        self.miss += 1
+        data = call(**params)
+        self.__save(func, key, data)
+        logger.debug("未命中缓存 %s%r，%s", func, params, self)
+        return data
+
+
+__caches = {}
+
+
+def get_data_cache(dir, max_size=MAX_CACHE_SIZE):
+    """同一个目录，共享一个缓存实例（共享一个索引文件）"""
+    if dir not in __caches:
+        __caches[dir] = DataCache(dir, max_size)
+    return __caches[dir]
+
+
+def cache(dir, max_size=MAX_CACHE_SIZE):
     """
     实现了一个包装器，用来缓存数据，
-    主要完成，把df自动保存pd.to_cvs()成一个csv文件，
-    名字是靠参数拼接起来的，dir参数是保存的目录。
-    下次再调用的时候，如果发现dir目录中存在参数拼接的文件，就直接缓存加载返回。
+    主要完成，把结果自动保存成一个pickle文件，保存在dir目录中，
+    下次再调用的时候，如果发现dir目录中已经缓存了，就直接加载返回，
+    如果参数中有start_date、end_date，只缺一部分日期的数据的话，只取缺的那部分。
+    详细参考DataCache。
     :param dir:
     :return:
     """
 
     def decorator(func):
+        signature = inspect.signature(func)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # 看看是不是缓存了，如果是，就直接返回缓存
-            pure_args = args[1:]
-            logger.debug("缓存,函数[%s],参数：%r,%r", func.__name__, pure_args, kwargs)
-            df = _get_cache(dir, func.__name__, pure_args, kwargs, str_fields)
-            if df is not None: return df
-            # 真正的去调用函数！！！
-            df = func(*args, **kwargs)
-            # 调用完，把结果缓存一下
-            _set_cache(dir, func.__name__, df, pure_args, kwargs)
-            return df
+            # 把位置参数、默认参数，都统一成key=value的形式，防止同样的调用，写法不同，缓存不上
+            bound_args = signature.bind(*args, **kwargs)
+            bound_args.apply_defaults()
+            params = dict(bound_args.arguments)
+            self = params.pop('self')
+            logger.debug("缓存,函数[%s],参数：%r", func.__name__, params)
+            # 真正的去调用函数，是在缓存没有命中的时候
+            return get_data_cache(dir, max_size).get_or_call(func.__name__,
+                                                             params,
+                                                             lambda **_params: func(self, **_params))
 
         return wrapper
 
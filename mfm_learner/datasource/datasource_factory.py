@@ -3,6 +3,8 @@ import logging
 from mfm_learner.datasource.impl.akshare_datasource import AKShareDataSource
 from mfm_learner.datasource.impl.baostock_datasource import BaostockDataSource
 from mfm_learner.datasource.impl.database_datasource import DatabaseDataSource
+from mfm_learner.datasource.impl.memory_datasource import MemoryCacheDataSource
+from mfm_learner.datasource.impl.parquet_datasource import ParquetDataSource
 from mfm_learner.datasource.impl.tushare_datasource import TushareDataSource
 from mfm_learner.utils import CONF
 
@@ -12,6 +14,26 @@ __tushare_datasource = None
 __akshare_datasource = None
 __database_datasource = None
 __baostock_datasource = None
+__parquet_datasource = None
+
+
+def _memory_cache(datasource):
+    """如果配置了memory_cache(单位M)，就包装一层进程内的内存缓存，同样参数的数据，一个进程只取一次"""
+    max_size = CONF.get('memory_cache', 0)
+    if not max_size: return datasource
+    logger.info("数据源[%s]使用内存缓存，上限%dM", type(datasource).__name__, max_size)
+    return MemoryCacheDataSource(datasource, max_size)
+
+
+def dispose_inherited_connections():
+    """
+    fork出来的子进程，不能和父进程共用数据库连接（会串了结果集），
+    丢掉从父进程继承来的、所有已经创建了的数据源的连接池（不关闭父进程的连接），用的时候再建新的
+    """
+    for datasource in [__tushare_datasource, __akshare_datasource, __database_datasource,
+                       __baostock_datasource, __parquet_datasource]:
+        engine = getattr(datasource, 'db_engine', None)
+        if engine is not None: engine.dispose(close=False)
 
 
 def get():
@@ -27,25 +49,31 @@ def create(type=None):
     if type == "tushare":
         global __tushare_datasource
         if not __tushare_datasource:
-            __tushare_datasource = TushareDataSource()
+            __tushare_datasource = _memory_cache(TushareDataSource())
         return __tushare_datasource
 
     if type == "database":
         global __database_datasource
         if not __database_datasource:
-            __database_datasource = DatabaseDataSource()
+            __database_datasource = _memory_cache(DatabaseDataSource())
         return __database_datasource
 
+    if type == "parquet":
+        global __parquet_datasource
+        if not __parquet_datasource:
+            __parquet_datasource = _memory_cache(ParquetDataSource())
+        return __parquet_datasource
+
     if type == "baostock":
         global __baostock_datasource
         if not __baostock_datasource:
-            __baostock_datasource = BaostockDataSource()
+            __baostock_datasource = _memory_cache(BaostockDataSource())
         return __baostock_datasource
 
     if type == "akshare":
         global __akshare_datasource
         if not __akshare_datasource:
-            __akshare_datasource = AKShareDataSource()
+            __akshare_datasource = _memory_cache(AKShareDataSource())
         return __akshare_datasource
 
     raise ValueError("无效的数据源：" + type)
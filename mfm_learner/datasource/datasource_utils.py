@@ -1,11 +1,13 @@
+import json
 import logging
+import os
 import time
 
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_datetime64_any_dtype as is_datetime
-from tqdm import tqdm
 
-from mfm_learner.conf import DATE_COLUMNS
+from mfm_learner.conf import DATE_COLUMNS, INDUSTRY_MAPPING_FILE
 from mfm_learner.datasource import datasource_factory as ds_factory
 from mfm_learner.utils import CONF, utils
 
@@ -43,19 +45,13 @@ def date2str(df, date_column):
 
 
 def load_daily_data(datasource, stock_codes, start_date, end_date):
-    df_merge = pd.DataFrame()
-    # 每支股票
+    """
+    加载多只股票的日交易数据，一次性传入所有股票（各数据源的daily都支持股票列表），
+    不再一只一只的取再append，返回按照[股票,日期]排好序的长表
+    """
     start_time = time.time()
-    pbar = tqdm(total=len(stock_codes))
-    for i, stock_code in enumerate(stock_codes):
-        # 得到日交易数据
-        data = datasource.daily(stock_code=stock_code, start_date=start_date, end_date=end_date)
-        if df_merge is None:
-            df_merge = data
-        else:
-            df_merge = df_merge.append(data)
-        pbar.update(i)
-    pbar.close()
+    df_merge = datasource.daily(stock_code=list(stock_codes), start_date=start_date, end_date=end_date)
+    df_merge = df_merge.sort_values(['code', 'datetime'], kind='stable', ignore_index=True)
 
     logger.debug("一共加载 %s~%s %d 只股票，共计 %d 条日交易数据，耗时 %.2f 秒",
                  start_date,
@@ -66,37 +62,10 @@ def load_daily_data(datasource, stock_codes, start_date, end_date):
     return df_merge
 
 
-def compile_industry(series_industry):
+def _find_industry_code(df_industries, chinese_name):
     """
-    把行业列（文字）转换成统一的行业码，
-    使用的是申万的2014版（一级28个/二级104个），没用2021版本：https://tushare.pro/document/2?doc_id=181）
-    如 "家用电器" => '330000'
-    ----------
-    index_classify结果：
-    index_code  industry_name    level  industry_code is_pub parent_code
-    801024.SI          采掘服务    L2        210400   None      210000
-    801035.SI          石油化工    L2        220100   None      220000
-    801033.SI          化学原料    L2        220200   None      220000
-    靠，tushare返回的是中文字符串，不是，申万的行业代码，所以，我得自己处理了。
-    ----------
-    df_industry: 股票对应的行业中文名，3列[code, date, industry]
+    找一个行业中文名，对应的申万一级行业代码，找不到就用编辑距离最近的那个行业名
     """
-    df_industries = ds_factory.get().index_classify()
-
-    def find_industry_code(chinese_name):
-
-        # import pdb;pdb.set_trace()
-        # 找列[industry_name]中的值和中文行业名相等的行
-        found_rows = df_industries.loc[df_industries['industry_name'] == chinese_name]
-
-        for _, row in found_rows.iterrows():
-            r = __extract_industry_code(row)
-            if r: return r
-
-        r = __get_possible(df_industries, chinese_name)
-        if r is None:
-            ValueError('无法找到 [' + chinese_name + "] 对应的行业代码")
-        return r
 
     def __extract_industry_code(row):
         if row.level == 'L1': return row.industry_code
@@ -104,23 +73,85 @@ def compile_industry(series_industry):
         if row.level == 'L3':  # 假设一定能找到
             assert len(df_industries.loc[df_industries['industry_code'] == row.parent_code]) > 0
             return df_industries.loc[df_industries['industry_code'] == row.parent_code].iloc[0].parent_code
-        raise None
+        raise ValueError(f"未知的行业级别：{row.level}")
+
+    # 找列[industry_name]中的值和中文行业名相等的行
+    found_rows = df_industries.loc[df_industries['industry_name'] == chinese_name]
+    for _, row in found_rows.iterrows():
+        r = __extract_industry_code(row)
+        if r: return r
 
-    def __get_possible(df_industries, chinese_name):
-        from Levenshtein import distance
+    from Levenshtein import distance
+    distances = df_industries['industry_name'].apply(lambda x: distance(x, chinese_name))
+    first_row = df_industries.loc[distances.sort_values(kind='stable').index[0]]
+    logger.debug("行业纠错：%s=>%s", chinese_name, first_row['industry_name'])
+    return __extract_industry_code(first_row)
 
-        df_industries['distance'] = df_industries['industry_name'].apply(
-            lambda x: distance(x, chinese_name)
-        )
-        first_row = df_industries.sort_values('distance').iloc[0]
-        code = __extract_industry_code(first_row)
 
-        # logger.debug("行业纠错：%s=>%s:%s",chinese_name,first_row['industry_name'],code)
+_industry_mappings = {}  # 进程内的缓存，{映射文件:{行业中文名:申万代码}}
 
-        return code
 
+def _load_industry_mapping(mapping_file):
+    if mapping_file not in _industry_mappings:
+        mapping = {}
+        if os.path.exists(mapping_file):
+            with open(mapping_file, encoding='utf-8') as f:
+                mapping = json.load(f)
+        _industry_mappings[mapping_file] = mapping
+    return _industry_mappings[mapping_file]
+
+
+def _save_industry_mapping(mapping_file, mapping):
+    """
+    多个进程可能同时在算行业，所以：
+    - 先合并一下文件里别的进程已经保存了的映射，不然会把人家的覆盖掉
+    - 先写到临时文件，再os.replace过去，别的进程不会读到写了一半的文件
+    """
+    os.makedirs(os.path.dirname(mapping_file) or ".", exist_ok=True)
+    if os.path.exists(mapping_file):
+        with open(mapping_file, encoding='utf-8') as f:
+            for name, code in json.load(f).items():
+                mapping.setdefault(name, code)
+    temp_file = f"{mapping_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w", encoding='utf-8') as f:
+        json.dump(mapping, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(temp_file, mapping_file)
+
+
+def compile_industry(series_industry, mapping_file=INDUSTRY_MAPPING_FILE):
+    """
+    把行业列（文字）转换成统一的行业码，
+    使用的是申万的2014版（一级28个/二级104个），没用2021版本：https://tushare.pro/document/2?doc_id=181）
+    如 "家用电器" => '330000'
+    ----------
+    index_classify结果：
+    index_code  industry_name    level  industry_code is_pub parent_code
+    801024.SI          采掘服务    L2        210400   None      210000
+    801035.SI          石油化工    L2        220100   None      220000
+    801033.SI          化学原料    L2        220200   None      220000
+    靠，tushare返回的是中文字符串，不是，申万的行业代码，所以，我得自己处理了。
+    ----------
+    行业名就100来个，但是series_industry是[日期|股票]的，有几百万行，
+    所以，先factorize出不重复的行业名，每个名字只查一次，再按照编号一次性映射回去，
+    查过的 行业名=>代码 保存到mapping_file中，以后就不用再去取index_classify、算编辑距离了
+    ----------
+    series_industry: 股票对应的行业中文名
+    """
+    positions, names = pd.factorize(series_industry)  # nan的位置是-1
+
+    mapping = _load_industry_mapping(mapping_file)
+    missing_names = [name for name in names if name not in mapping]
+    if len(missing_names) > 0:
+        df_industries = ds_factory.get().index_classify()
+        for name in missing_names:
+            mapping[name] = _find_industry_code(df_industries, name)
+        _save_industry_mapping(mapping_file, mapping)
+        logger.debug("新增%d个行业名的映射，保存到：%s", len(missing_names), mapping_file)
+
+    # 最后多放一个nan，给factorize中-1的位置用
+    codes = np.array([mapping[name] for name in names] + [np.nan], dtype=object)
     # 用中文名列，生成，申万的行业代码列, df_industry['industry']是中文名，转成申万的代码：industry_code
-    return series_industry.apply(find_industry_code)
+    return pd.Series(codes[positions], index=series_industry.index, name=series_industry.name)
 
 
 def validate_trade_date(df, date_column=None, start_date=None, end_date=None):
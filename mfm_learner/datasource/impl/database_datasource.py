@@ -5,6 +5,7 @@ import logging
 import time
 
 import pandas as pd
+from sqlalchemy import bindparam, text
 
 from mfm_learner.datasource.datasource import DataSource, post_query
 from mfm_learner.datasource.impl.tushare_datasource import TushareDataSource
@@ -12,62 +13,58 @@ from mfm_learner.utils import utils, logging_time, db_utils
 
 logger = logging.getLogger(__name__)
 
+MAX_CODES_PER_QUERY = 500  # 一次 IN (...) 查询最多带多少只股票，再多就分批查，防止SQL过长
+
 
 class DatabaseDataSource(DataSource):
     def __init__(self):
         self.db_engine = utils.connect_db()
         self.tushare = TushareDataSource()
 
-    # 返回每日行情数据，不限字段
-    def __daliy_one(self, stock_code, start_date=None, end_date=None):
-        if start_date is None or end_date is None:
-            df = pd.read_sql(
-                f'select * from daily_hfq where ts_code="{stock_code}"',
-                self.db_engine)
-            return df
-        else:
-            df = pd.read_sql(
-                f'select * from daily_hfq where ts_code="{stock_code}" and trade_date>="{start_date}" and trade_date<="{end_date}"',
-                self.db_engine)
-            return df
+    def __query_by_codes(self, table_name, stock_codes, start_date=None, end_date=None):
+        """
+        按照股票代码批量查询，代替原来的"每只股票一次pd.read_sql"，
+        用 IN (...) + 绑定参数，每次最多带 MAX_CODES_PER_QUERY 只股票，
+        500只的股票池，只需要1次查询，而不是500次，最后一次性concat，不再反复append拷贝
+        """
+        if type(stock_codes) != list: stock_codes = [stock_codes]
+
+        sql = f'select * from {table_name} where ts_code in :codes'
+        params = {}
+        if start_date is not None and end_date is not None:
+            sql += ' and trade_date>=:start_date and trade_date<=:end_date'
+            params['start_date'] = start_date
+            params['end_date'] = end_date
+        sql += ' order by ts_code, trade_date'  # 保证每只股票的数据是连续的、按日期排好的，和原来逐只查询一致
+        sql = text(sql).bindparams(bindparam('codes', expanding=True))
+
+        df_list = []
+        for i in range(0, len(stock_codes), MAX_CODES_PER_QUERY):
+            params['codes'] = stock_codes[i:i + MAX_CODES_PER_QUERY]
+            df_list.append(pd.read_sql(sql, self.db_engine, params=params))
+        return pd.concat(df_list, ignore_index=True)
 
+    # 返回每日行情数据，不限字段
     @post_query
     def daily(self, stock_code, start_date=None, end_date=None):
+        start_time = time.time()
+        df = self.__query_by_codes('daily_hfq', stock_code, start_date, end_date)
         if type(stock_code) == list:
-            df_all = None
-            start_time = time.time()
-            for i, stock in enumerate(stock_code):
-                df_daily = self.__daliy_one(stock, start_date, end_date)
-                if df_all is None:
-                    df_all = df_daily
-                else:
-                    df_all = df_all.append(df_daily)
             logger.debug("获取 %s ~ %s %d 只股票的交易数据：%d 条, 耗时 %.2f 秒",
-                         start_date, end_date, len(stock_code), len(df_all), time.time() - start_time)
-            return df_all
+                         start_date, end_date, len(stock_code), len(df), time.time() - start_time)
         else:
-            df_one = self.__daliy_one(stock_code, start_date, end_date)
-            logger.debug("获取 %s ~ %s 股票[%s]的交易数据：%d 条", start_date, end_date, stock_code, len(df_one))
-            return df_one
+            logger.debug("获取 %s ~ %s 股票[%s]的交易数据：%d 条", start_date, end_date, stock_code, len(df))
+        return df
 
     @logging_time
     @post_query
     def daily_basic(self, stock_code, start_date, end_date):
+        """返回每日的其他信息，主要是市值啥的"""
         assert type(stock_code) == list or type(stock_code) == str, type(stock_code)
+        start_time = time.time()
+        df = self.__query_by_codes('daily_basic', stock_code, start_date, end_date)
         if type(stock_code) == list:
-            start_time = time.time()
-            df_basics = [self.__daily_basic_one(stock, start_date, end_date) for stock in stock_code]
-            logger.debug("获取%d只股票的每日基本信息数据%d条，耗时 : %.2f秒", len(stock_code), len(df_basics), time.time() - start_time)
-            # print(df_basics)
-            return pd.concat(df_basics)
-        return self.__daily_basic_one(stock_code, start_date, end_date)
-
-    def __daily_basic_one(self, stock_code, start_date, end_date):
-        """返回每日的其他信息，主要是市值啥的"""
-        df = pd.read_sql(
-            f'select * from daily_basic \
-                where ts_code="{stock_code}" and trade_date>="{start_date}" and trade_date<="{end_date}"',
-            self.db_engine)
+            logger.debug("获取%d只股票的每日基本信息数据%d条，耗时 : %.2f秒", len(stock_code), len(df), time.time() - start_time)
         return df
 
     # 指数日线行情
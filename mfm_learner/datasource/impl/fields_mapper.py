@@ -28,4 +28,10 @@ MAPPER={
         'trade_date': 'datetime',
         'ann_date': 'datetime'
     },
+    'parquet':{
+        'ts_code':'code',
+        'vol': 'volume',
+        'trade_date': 'datetime',
+        'ann_date': 'datetime'
+    },
 }
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+进程内的内存缓存数据源，包装一个真正的数据源（database、tushare、parquet...），
+
+一次运行中（比如factor_main），factor_creator、factor_analyzer、factor_backtester、data_loader，
+会反复地用同样的参数去取trade_cal、index_weight、daily、stock_basic、index_classify等，
+包装一下后，同样的参数的调用，在一个进程内只会真正取一次，后面都是从内存中拿。
+
+- 缓存的key是：(函数名，规整后的参数)，规整是指把位置参数、默认参数都统一成key=value，list转成tuple
+- 返回的是缓存的拷贝，防止调用方修改了(比如df['xxx']=..., dropna(inplace=True))，把缓存给污染了
+- 有内存上限，超过了，按照最久未使用(LRU)淘汰
+"""
+import inspect
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from pandas import DataFrame, Series
+
+from mfm_learner.datasource.datasource import DataSource
+
+logger = logging.getLogger(__name__)
+
+MAX_MEMORY_SIZE = 1024  # 默认最多缓存1G(单位M)
+
+
+def _normalize(value):
+    if type(value) in [list, tuple, np.ndarray, Series]:
+        return tuple(_normalize(v) for v in value)
+    if type(value) == dict:
+        return tuple(sorted((k, _normalize(v)) for k, v in value.items()))
+    return value
+
+
+def _sizeof(data):
+    if isinstance(data, DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    if isinstance(data, Series):
+        return int(data.memory_usage(deep=True))
+    if type(data) == list:
+        return 64 * len(data)
+    return 64
+
+
+def _copy(data):
+    if isinstance(data, DataFrame) or isinstance(data, Series):
+        return data.copy()
+    if type(data) == list:
+        return list(data)
+    return data
+
+
+class MemoryCacheDataSource(DataSource):
+
+    def __init__(self, datasource, max_size=MAX_MEMORY_SIZE):
+        """
+        :param datasource: 被包装的真正的数据源
+        :param max_size: 内存上限，单位M
+        """
+        self.datasource = datasource
+        self.max_size = max_size * 1024 * 1024
+        self.size = 0
+        self.hit = 0
+        self.miss = 0
+        self.cache = OrderedDict()
+
+    def __str__(self):
+        return f"内存缓存[{type(self.datasource).__name__}]: 命中{self.hit}次，未命中{self.miss}次，" \
+               f"{len(self.cache)}项，{self.size / 1024 / 1024:.1f}M"
+
+    def __call(self, method_name, *args, **kwargs):
+        method = getattr(self.datasource, method_name)
+        bound_args = inspect.signature(method).bind(*args, **kwargs)
+        bound_args.apply_defaults()
+        key = (method_name, tuple((k, _normalize(v)) for k, v in bound_args.arguments.items()))
+
+        if key in self.cache:
+            self.hit += 1
+            self.cache.move_to_end(key)
+            data, _ = self.cache[key]
+            return _copy(data)
+
+        self.miss += 1
+        data = method(*args, **kwargs)
+        size = _sizeof(data)
+        if size > self.max_size:
+            logger.warning("%s的结果%.1fM超过了内存缓存上限，不缓存", method_name, size / 1024 / 1024)
+            return data
+
+        self.cache[key] = (_copy(data), size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evict_size) = self.cache.popitem(last=False)
+            self.size -= evict_size
+        logger.debug("%s", self)
+        return data
+
+    def __getattr__(self, name):
+        # 非DataSource接口的函数，如get_factor，不缓存（因子表会被factor_creator更新），直接调用被包装的数据源
+        if name == 'datasource': raise AttributeError(name)
+        return getattr(self.datasource, name)
+
+    def daily(self, *args, **kwargs):
+        return self.__call('daily', *args, **kwargs)
+
+    def daily_basic(self, *args, **kwargs):
+        return self.__call('daily_basic', *args, **kwargs)
+
+    def index_daily(self, *args, **kwargs):
+        return self.__call('index_daily', *args, **kwargs)
+
+    def index_weight(self, *args, **kwargs):
+        return self.__call('index_weight', *args, **kwargs)
+
+    def fina_indicator(self, *args, **kwargs):
+        return self.__call('fina_indicator', *args, **kwargs)
+
+    def income(self, *args, **kwargs):
+        return self.__call('income', *args, **kwargs)
+
+    def trade_cal(self, *args, **kwargs):
+        return self.__call('trade_cal', *args, **kwargs)
+
+    def stock_basic(self, *args, **kwargs):
+        return self.__call('stock_basic', *args, **kwargs)
+
+    def index_classify(self, *args, **kwargs):
+        return self.__call('index_classify', *args, **kwargs)
+
+    def fund_daily(self, *args, **kwargs):
+        return self.__call('fund_daily', *args, **kwargs)
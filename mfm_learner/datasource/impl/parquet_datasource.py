@@ -0,0 +1,287 @@
+"""
+本地的列式存储数据源，把database中的表，按照 年+股票分桶 分区，存成一堆parquet文件：
+
+    data/parquet/
+        daily_hfq/year=2018/bucket=3/part-xxx.parquet
+        daily_hfq/year=2018/bucket=4/part-xxx.parquet
+        ...
+        trade_cal/year=2018/part-xxx.parquet
+        stock_basic/bucket=3/part-xxx.parquet
+        index_classify/part-xxx.parquet
+        factor_clv/year=2018/bucket=3/part-xxx.parquet   <--- factor_creator算出来的因子，也存在这里
+        ...
+
+好处是：
+- 不用连mysql，拷贝个目录就可以跑因子计算和回测
+- 按照股票、日期查询时，可以利用分区目录+parquet的统计信息，直接跳过无关的文件（谓词下推）
+- 列式存储，只读需要的列（列裁剪），比逐行的mysql快很多
+- 配置了datasource: parquet的话，因子(factor_<name>)、合成因子(factor_synthesis_<name>)也存在这里，
+  factor_creator、factor_backtester就完全不用数据库了
+
+数据从mysql导入：`python -m mfm_learner.datasource.impl.parquet_datasource`
+"""
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from mfm_learner.datasource.datasource import DataSource, post_query
+from mfm_learner.utils import CONF, utils, logging_time, db_utils
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NUM = 16  # 股票代码分桶数，按照代码数字部分取模，一个桶大约300只股票
+
+"""
+每个表的，代码列和日期列，用于分区和过滤，
+没有代码列的（如trade_cal）就只按年分区，没有日期列的（如stock_basic）就只按代码分桶
+"""
+TABLES = {
+    'daily_hfq': {'code': 'ts_code', 'date': 'trade_date'},
+    'daily_basic': {'code': 'ts_code', 'date': 'trade_date'},
+    'index_daily': {'code': 'ts_code', 'date': 'trade_date'},
+    'index_weight': {'code': 'index_code', 'date': 'trade_date'},
+    'fina_indicator': {'code': 'ts_code', 'date': 'ann_date'},
+    'income': {'code': 'ts_code', 'date': 'ann_date'},
+    'fund_daily': {'code': 'ts_code', 'date': 'trade_date'},
+    'trade_cal': {'code': None, 'date': 'cal_date'},
+    'stock_basic': {'code': 'ts_code', 'date': None},
+    'index_classify': {'code': None, 'date': None}
+}
+FACTOR_TABLE = {'code': 'code', 'date': 'datetime'}  # 因子表(factor_xxx)，都是[datetime,code,因子值]
+
+
+def code_to_bucket(code):
+    """'600000.SH' => 600000 % 16 => 0"""
+    return int(code[:6]) % BUCKET_NUM
+
+
+def _table(table_name):
+    if table_name in TABLES: return TABLES[table_name]
+    if table_name.startswith('factor_'): return FACTOR_TABLE
+    raise ValueError(f"不支持的本地parquet表：{table_name}")
+
+
+def _to_list(codes):
+    if type(codes) == str: return codes.split(",")
+    return list(codes)
+
+
+class ParquetDataSource(DataSource):
+
+    def __init__(self, root_dir=None):
+        if root_dir is None:
+            root_dir = CONF['datasources']['parquet']['dir']
+        self.root_dir = root_dir
+        logger.debug("使用本地parquet数据目录：%s", self.root_dir)
+
+    def __partitioning(self, table_name):
+        fields = []
+        if _table(table_name)['date']: fields.append(('year', pa.int16()))
+        if _table(table_name)['code']: fields.append(('bucket', pa.int8()))
+        if len(fields) == 0: return None
+        return ds.partitioning(pa.schema(fields), flavor='hive')
+
+    def read(self, table_name, codes=None, start_date=None, end_date=None, fields=None, filter=None):
+        """
+        读取一个表，
+        按照代码、日期的过滤，会同时作用到分区目录(year,bucket)上，这样无关的目录根本不会被打开，
+        fields是要返回的列（逗号分隔），不传就是所有列
+        """
+        table_path = os.path.join(self.root_dir, table_name)
+        if not os.path.exists(table_path):
+            raise ValueError(f"表[{table_name}]在本地parquet目录中不存在：{table_path}")
+
+        code_column = _table(table_name)['code']
+        date_column = _table(table_name)['date']
+
+        dataset = ds.dataset(table_path, format='parquet', partitioning=self.__partitioning(table_name))
+        if date_column and pa.types.is_timestamp(dataset.schema.field(date_column).type):
+            # 因子表的日期列是datetime类型的，过滤条件也要转成时间，不能和字符串比较
+            start_date = pd.Timestamp(start_date) if start_date is not None else None
+            end_date = pd.Timestamp(end_date) if end_date is not None else None
+
+        expression = filter
+        if codes is not None:
+            codes = _to_list(codes)
+            buckets = list({code_to_bucket(code) for code in codes})
+            expression = self.__and(expression, ds.field('bucket').isin(buckets))
+            expression = self.__and(expression, ds.field(code_column).isin(codes))
+        if start_date is not None:
+            expression = self.__and(expression, ds.field('year') >= int(str(start_date)[:4]))
+            expression = self.__and(expression, ds.field(date_column) >= start_date)
+        if end_date is not None:
+            expression = self.__and(expression, ds.field('year') <= int(str(end_date)[:4]))
+            expression = self.__and(expression, ds.field(date_column) <= end_date)
+
+        columns = None
+        if fields is not None:
+            columns = [f.strip() for f in fields.split(",")]
+
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        df = df.drop(columns=[c for c in ['year', 'bucket'] if c in df.columns and c not in (columns or [])])
+
+        sort_columns = [c for c in [code_column, date_column] if c and c in df.columns]
+        if sort_columns: df = df.sort_values(sort_columns, ignore_index=True)
+        return df
+
+    def write(self, table_name, df, mode='append'):
+        """
+        把一个dataframe写入到本地的parquet表中，按照年、股票分桶做分区
+        :param mode: append是追加新文件，replace是先删掉整个表
+        """
+        table_path = os.path.join(self.root_dir, table_name)
+        if mode == 'replace' and os.path.exists(table_path):
+            shutil.rmtree(table_path)
+
+        df = df.copy()
+        partitioning = self.__partitioning(table_name)
+        date_column = _table(table_name)['date']
+        if date_column:
+            # 日期为空的（比如有的财报没有ann_date），分不了区，按日期也查不到，丢掉
+            years = pd.to_numeric(df[date_column].astype(str).str[:4], errors='coerce')
+            if years.isna().any():
+                logger.warning("表[%s]中有%d条数据的%s为空，不保存", table_name, years.isna().sum(), date_column)
+                df, years = df[years.notna()], years[years.notna()]
+            df['year'] = years.astype('int16')
+        if _table(table_name)['code']:
+            df['bucket'] = df[_table(table_name)['code']].map(code_to_bucket).astype('int8')
+
+        ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False),
+                         table_path,
+                         format='parquet',
+                         partitioning=partitioning,
+                         basename_template="part-" + uuid.uuid4().hex + "-{i}.parquet",
+                         existing_data_behavior='overwrite_or_ignore')
+        logger.debug("保存%d条数据到本地parquet表：%s", len(df), table_path)
+
+    def __and(self, expression, other):
+        if expression is None: return other
+        return expression & other
+
+    @post_query
+    def daily(self, stock_code, start_date=None, end_date=None, fields=None):
+        return self.read('daily_hfq', stock_code, start_date, end_date, fields)
+
+    @logging_time
+    @post_query
+    def daily_basic(self, stock_code, start_date, end_date, fields=None):
+        return self.read('daily_basic', stock_code, start_date, end_date, fields)
+
+    # 指数日线行情
+    @post_query
+    def index_daily(self, index_code, start_date, end_date, fields=None):
+        return self.read('index_daily', index_code, start_date, end_date, fields)
+
+    # 返回指数包含的股票
+    @post_query
+    def index_weight(self, index_code, start_date, end_date=None):
+        df = self.read('index_weight', index_code, start_date, end_date, fields='index_code,con_code,trade_date')
+        return df['con_code'].unique().tolist()
+
+    # 获得财务数据
+    @post_query
+    def fina_indicator(self, stock_code, start_date, end_date, fields=None):
+        return self.read('fina_indicator', stock_code, start_date, end_date, fields)
+
+    # 获得现金流量
+    @post_query
+    def income(self, stock_code, start_date, end_date, fields=None):
+        return self.read('income', stock_code, start_date, end_date, fields)
+
+    @post_query
+    def trade_cal(self, start_date, end_date, exchange='SSE'):
+        df = self.read('trade_cal',
+                       start_date=start_date,
+                       end_date=end_date,
+                       filter=(ds.field('exchange') == exchange) & (ds.field('is_open').cast(pa.int8()) == 1))
+        return df['cal_date']
+
+    @post_query
+    def stock_basic(self, ts_code):
+        return self.read('stock_basic', ts_code)
+
+    @post_query
+    def index_classify(self, level='', src='SW2014'):
+        return self.read('index_classify', filter=ds.field('src') == src)
+
+    @post_query
+    def get_factor(self, name, stock_codes, start_date, end_date):
+        return self.read(f'factor_{name}', stock_codes, start_date, end_date)
+
+    def save_factor(self, name, df, append=False):
+        """df是[datetime,code,因子值]的，默认替换旧的，append是增量计算时，追加新的日期"""
+        self.write(f'factor_{name}', df, mode='append' if append else 'replace')
+
+    def get_factor_last_date(self, name):
+        """因子表中最后的日期，如'20220208'，表不存在、或者没数据，返回None，只读最后一年的分区"""
+        table_path = os.path.join(self.root_dir, f'factor_{name}')
+        if not os.path.exists(table_path): return None
+        years = [int(d[len('year='):]) for d in os.listdir(table_path) if d.startswith('year=')]
+        if len(years) == 0: return None
+        df = self.read(f'factor_{name}', fields='datetime', filter=ds.field('year') == max(years))
+        if len(df) == 0: return None
+        return pd.Timestamp(df['datetime'].max()).strftime('%Y%m%d')
+
+    def get_factor_synthesis(self, name, stock_codes, start_date, end_date):
+        return self.read(f'factor_synthesis_{name}', stock_codes, start_date, end_date, fields='datetime,code,value')
+
+    def save_factor_synthesis(self, name, df):
+        self.write(f'factor_synthesis_{name}', df, mode='replace')
+
+    # 基金日线，本地没有导出的话（数据库里一般没下载基金数据），就去tushare取
+    @post_query
+    def fund_daily(self, fund_code, start_date, end_date):
+        if not os.path.exists(os.path.join(self.root_dir, 'fund_daily')):
+            from mfm_learner.datasource import datasource_factory
+            return datasource_factory.create('tushare').fund_daily(fund_code, start_date, end_date)
+        return self.read('fund_daily', fund_code, start_date, end_date)
+
+
+@logging_time
+def export_from_database(table_names=None, root_dir=None):
+    """
+    把mysql中的表，按年导出到本地parquet目录中，每次都是全量替换
+    """
+    if table_names is None: table_names = list(TABLES.keys())
+    db_engine = utils.connect_db()
+    datasource = ParquetDataSource(root_dir)
+
+    for table_name in table_names:
+        start_time = time.time()
+        if not db_utils.is_table_exist(db_engine, table_name):
+            logger.warning("数据库中不存在表[%s]，跳过", table_name)
+            continue
+
+        date_column = TABLES[table_name]['date']
+        if date_column is None:
+            datasource.write(table_name, pd.read_sql(f'select * from {table_name}', db_engine), mode='replace')
+            logger.debug("导出表[%s]，耗时%.2f秒", table_name, time.time() - start_time)
+            continue
+
+        # 按年导出，防止一次把整个表读到内存中
+        first_date = pd.read_sql(f'select min({date_column}) from {table_name}', db_engine).iloc[0, 0]
+        if first_date is None:
+            logger.warning("数据库中表[%s]为空，跳过", table_name)
+            continue
+        scopes = utils.get_yearly_duration(str(first_date)[:8], utils.today())
+        mode = 'replace'
+        for start_date, end_date in scopes:
+            df = pd.read_sql(
+                f'select * from {table_name} where {date_column}>="{start_date}" and {date_column}<="{end_date}"',
+                db_engine)
+            if len(df) == 0: continue
+            datasource.write(table_name, df, mode=mode)
+            mode = 'append'
+        logger.debug("导出表[%s]，耗时%.2f秒", table_name, time.time() - start_time)
+
+
+# python -m mfm_learner.datasource.impl.parquet_datasource
+if __name__ == '__main__':
+    utils.init_logger()
+    export_from_database()
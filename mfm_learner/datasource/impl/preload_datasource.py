@@ -0,0 +1,81 @@
+"""
+预加载的数据源，包装一个真正的数据源（一般是datasource_factory.create()出来的），
+
+factor_creator一次算多个因子的时候，用的是同一个股票池，很多因子读的是同一个数据集，
+比如bm、ep、mv、cmv、换手率都读daily_basic，roe、资产负债率都读fina_indicator，只是日期范围不太一样（TTM要多取几年），
+所以，先在主进程里，把每个数据集按照所有因子要的最大日期范围，只取一次（preload），
+因子（包括fork出来的子进程里的因子）再取这个数据集的时候，只要股票、日期范围被覆盖了，就直接从预加载的数据中切出来，
+覆盖不了的，还是去调被包装的数据源。
+
+预加载的数据，放在self.data中：{函数名: (股票集合, 开始日期, 结束日期, 数据)}，可以传给别的实例共用（只读）
+"""
+import logging
+
+from mfm_learner.datasource.datasource import DataSource
+
+logger = logging.getLogger(__name__)
+
+# 可以预加载的数据集，都是 (stock_code, start_date, end_date) 参数，返回有code、datetime列的DataFrame
+PRELOAD_FUNCTIONS = ['daily_basic', 'fina_indicator', 'income']
+
+
+class PreloadDataSource(DataSource):
+
+    def __init__(self, datasource, data=None):
+        """
+        :param datasource: 被包装的真正的数据源
+        :param data: 别的PreloadDataSource预加载好的数据，共用
+        """
+        self.datasource = datasource
+        self.data = {} if data is None else data
+
+    def preload(self, func_name, stock_codes, start_date, end_date):
+        assert func_name in PRELOAD_FUNCTIONS, func_name
+        df = getattr(self.datasource, func_name)(stock_codes, start_date, end_date)
+        self.data[func_name] = (frozenset(stock_codes), start_date, end_date, df)
+        logger.info("预加载%s：%d只股票，%s~%s，%d行", func_name, len(stock_codes), start_date, end_date, len(df))
+
+    def __call(self, func_name, stock_code, start_date, end_date):
+        stock_codes = stock_code if type(stock_code) == list else [stock_code]
+        if func_name in self.data:
+            preload_codes, preload_start_date, preload_end_date, df = self.data[func_name]
+            if preload_start_date <= start_date and end_date <= preload_end_date \
+                    and preload_codes.issuperset(stock_codes):
+                df = df[df.code.isin(stock_codes) & (df.datetime >= start_date) & (df.datetime <= end_date)]
+                return df.reset_index(drop=True)
+        return getattr(self.datasource, func_name)(stock_code, start_date, end_date)
+
+    def __getattr__(self, name):
+        # 其他的函数（trade_cal、index_daily...），直接调用被包装的数据源
+        if name == 'datasource': raise AttributeError(name)
+        return getattr(self.datasource, name)
+
+    def daily(self, *args, **kwargs):
+        return self.datasource.daily(*args, **kwargs)
+
+    def daily_basic(self, stock_code, start_date, end_date):
+        return self.__call('daily_basic', stock_code, start_date, end_date)
+
+    def index_daily(self, *args, **kwargs):
+        return self.datasource.index_daily(*args, **kwargs)
+
+    def index_weight(self, *args, **kwargs):
+        return self.datasource.index_weight(*args, **kwargs)
+
+    def fina_indicator(self, stock_code, start_date, end_date):
+        return self.__call('fina_indicator', stock_code, start_date, end_date)
+
+    def income(self, stock_code, start_date, end_date):
+        return self.__call('income', stock_code, start_date, end_date)
+
+    def trade_cal(self, *args, **kwargs):
+        return self.datasource.trade_cal(*args, **kwargs)
+
+    def stock_basic(self, *args, **kwargs):
+        return self.datasource.stock_basic(*args, **kwargs)
+
+    def index_classify(self, *args, **kwargs):
+        return self.datasource.index_classify(*args, **kwargs)
+
+    def fund_daily(self, *args, **kwargs):
+        return self.datasource.fund_daily(*args, **kwargs)
@@ -137,7 +137,7 @@ class TushareDataSource(DataSource):
 
     # https://tushare.pro/document/2?doc_id=181
     @post_query
-    @cache(BASE_DIR,'parent_code,index_code,industry_code')
+    @cache(BASE_DIR)
     def index_classify(self, level='', src='SW2014'):
         # """申万行业，2014版（还有2021版）"""
         _random_sleep()
@@ -0,0 +1,205 @@
+"""
+因子检验的计算，不依赖alphalens、matplotlib，都是在numpy数组上批量算的，
+算出来的结构，和alphalens的一样，可以直接给score.score()打分用，画图是可选的，另外做：
+
+- 数据规整：算N日的远期收益率、每天按因子值分组(quantile)，即alphalens的get_clean_factor_and_forward_returns
+- IC法：每天的截面上，因子值和N日收益率的相关性（rank IC是秩相关，和alphalens一样；普通IC是pearson相关）
+- 分层法：每天每组的平均收益率，即alphalens的mean_return_by_quantile
+- 回归法：每天的截面上，股票收益率 = a + 因子值 * 因子收益率 + e，回归出 因子收益率 和 它的t值
+
+factor_data的格式，和alphalens的get_clean_factor_and_forward_returns返回的一样：
+       ----------------------------------------------
+                  |       | 1D  | 5D  | 10D  |factor|
+       ----------------------------------------------
+           date   | asset |     |     |      |      |
+       ----------------------------------------------
+                  | AAPL  | 0.09|-0.01|-0.079|  0.5 |
+                  -----------------------------------
+                  | BA    | 0.02| 0.06| 0.020| -1.1 |
+"""
+import logging
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from scipy import stats
+
+logger = logging.getLogger(__name__)
+
+
+def get_forward_returns_columns(columns):
+    """返回1D,5D,10D...这样的收益率列名，和alphalens.utils.get_forward_returns_columns一样"""
+    pattern = re.compile(r"^(\d+([Dhms]|ms|us|ns))+$", re.IGNORECASE)
+    return [c for c in columns if pattern.match(str(c))]
+
+
+def get_clean_factor_and_forward_returns(factor, prices, periods=(1, 5, 10), quantiles=5):
+    """
+    和alphalens的get_clean_factor_and_forward_returns一样：
+    - N日远期收益率：prices.pct_change(N).shift(-N)，停牌的价格前向填充（pct_change默认就是这样）
+    - 因子值、远期收益率有nan的，去掉
+    - 每天按因子值分成quantiles组（同pd.qcut，右闭区间），分组边界有重复的那天（分不开），整天去掉
+
+    :param factor: 因子值，Series，index是[日期|股票]
+    :param prices: 收盘价，DataFrame，index是日期，列是股票
+    :return: factor_data，index是[date|asset]，列是：1D,5D,...,factor,factor_quantile
+    """
+    df_factor = factor.unstack(level=1).sort_index().sort_index(axis=1)
+    prices = prices.sort_index().reindex(columns=df_factor.columns).ffill()
+    dates = df_factor.index.intersection(prices.index)
+    if len(dates) == 0:
+        raise ValueError("因子和价格的日期对不上")
+
+    columns = [f'{period}D' for period in sorted(periods)]
+    values = [df_factor.loc[dates].values.astype(float)]
+    for period in sorted(periods):
+        close = prices.values
+        forward_close = np.full(close.shape, np.nan)
+        forward_close[:len(close) - period] = close[period:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            forward_returns = DataFrame(forward_close / close - 1, index=prices.index)
+        values.append(forward_returns.loc[dates].values)
+    values = np.stack(values)  # [1+周期数 x 日期 x 股票]
+    valid = ~np.isnan(values).any(axis=0)
+
+    # 每天的分组边界，和pd.qcut一样是线性插值的分位数，第k组是 (边界k-1, 边界k]
+    factor_values = np.where(valid, values[0], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # 某天都是nan
+        borders = np.nanquantile(factor_values, np.linspace(0, 1, quantiles + 1), axis=1)  # [quantiles+1 x 日期]
+    factor_quantile = 1 + (factor_values[None] > borders[1:-1, :, None]).sum(axis=0)
+    valid &= (np.diff(borders, axis=0) > 0).all(axis=0)[:, None]
+
+    date_codes, asset_codes = np.nonzero(valid)
+    factor_data = DataFrame(values[1:, date_codes, asset_codes].T, columns=columns)
+    factor_data['factor'] = values[0, date_codes, asset_codes]
+    factor_data['factor_quantile'] = factor_quantile[date_codes, asset_codes]
+    factor_data.index = pd.MultiIndex.from_arrays([dates[date_codes], df_factor.columns[asset_codes]],
+                                                  names=['date', 'asset'])
+
+    loss = 1 - len(factor_data) / factor.count()
+    logger.debug("因子数据%d行，去掉了%.1f%%（远期收益率为nan、无法分组的）", factor.count(), loss * 100)
+    return factor_data
+
+
+def __to_panel(factor_data, column):
+    """factor_data的某列 => [日期 x 股票]的二维数组，没有的为nan"""
+    date_codes, dates = factor_data.index.get_level_values('date').factorize(sort=True)
+    asset_codes, assets = factor_data.index.get_level_values('asset').factorize(sort=True)
+    panel = np.full((len(dates), len(assets)), np.nan)
+    panel[date_codes, asset_codes] = factor_data[column].values
+    dates.name = 'date'
+    return panel, dates
+
+
+def __cross_sectional_corr(x, y):
+    """每行（每天）x和y的pearson相关系数，只用x、y都不是nan的股票"""
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        x = np.where(valid, x - np.nanmean(np.where(valid, x, np.nan), axis=1, keepdims=True), 0)
+        y = np.where(valid, y - np.nanmean(np.where(valid, y, np.nan), axis=1, keepdims=True), 0)
+        corr = (x * y).sum(axis=1) / np.sqrt((x * x).sum(axis=1) * (y * y).sum(axis=1))
+    return np.where(valid.sum(axis=1) > 1, corr, np.nan)
+
+
+def information_coefficient(factor_data, method='rank'):
+    """
+    每天的IC：截面上，因子值和N日收益率的相关系数，
+    :param method: rank - 秩相关(spearman)，就是alphalens的IC；normal - pearson相关
+    :return: DataFrame[日期 x 周期]
+    """
+    columns = get_forward_returns_columns(factor_data.columns)
+    factors, dates = __to_panel(factor_data, 'factor')
+    ic_data = DataFrame(index=dates, columns=columns, dtype=float)
+    for column in columns:
+        returns, _ = __to_panel(factor_data, column)
+        x = np.where(np.isnan(returns), np.nan, factors)
+        y = np.where(np.isnan(factors), np.nan, returns)
+        if method == 'rank':
+            x, y = DataFrame(x).rank(axis=1).values, DataFrame(y).rank(axis=1).values
+        ic_data[column] = __cross_sectional_corr(x, y)
+    return ic_data
+
+
+def ic_statistics(ic_data):
+    """
+    IC序列的统计，和alphalens的create_information_tear_sheet返回的一样：
+    :return: IC均值为0的t值，p值，偏度，峰度，每个都是一个[周期]的数组
+    """
+    t_values, p_values = stats.ttest_1samp(ic_data, 0, nan_policy='omit')
+    skew = stats.skew(ic_data, nan_policy='omit')
+    kurtosis = stats.kurtosis(ic_data, nan_policy='omit')
+    return np.asarray(t_values), np.asarray(p_values), np.asarray(skew), np.asarray(kurtosis)
+
+
+def mean_return_by_quantile(factor_data, demeaned=True):
+    """
+    每天、每组的平均收益率，和alphalens的mean_return_by_quantile(by_date=True)一样，
+    :param demeaned: 每天的收益率，先减去当天所有股票的平均收益率（即多空组合的收益）
+    :return: DataFrame，index是[factor_quantile|date]，列是周期
+    """
+    columns = get_forward_returns_columns(factor_data.columns)
+    returns = factor_data[columns]
+    dates = factor_data.index.get_level_values('date')
+    if demeaned:
+        returns = returns - returns.groupby(dates).transform('mean')
+    return returns.groupby([factor_data['factor_quantile'], dates]).mean()
+
+
+def factor_returns_regression(factor_data):
+    """
+    截面回归：每一天、每个调仓周期(1D,5D,10D...)，R_i = a + f * x_i + e_i，
+    f就是因子收益率，t是 f不为0 的t检验值，和 statsmodels 的 OLS(R, add_constant(x)) 的 params[1]、tvalues[1] 一样。
+
+    一元回归只需要每组（一天 x 一个周期）的几个和，就能算出来，所以不用每天、每个周期去构造一个OLS：
+        Sxx = Σ(x-x̄)²，Sxy = Σ(x-x̄)(y-ȳ)，Syy = Σ(y-ȳ)²，n
+        f = Sxy / Sxx
+        SSR = Syy - f * Sxy
+        t = f / sqrt(SSR / (n-2) / Sxx)
+    先减去组内均值再求和（而不是用 Σx²-(Σx)²/n），防止大数相减丢精度，
+    所有的组，都是用np.bincount一起求和的。
+
+    因子或收益率为nan的股票，不参与那一组的回归；组内少于3只股票（自由度<1）、或者因子值都一样的，为nan。
+
+    :return: t_values, factor_returns，都是 DataFrame[日期 x 周期]
+    """
+    column_names = get_forward_returns_columns(factor_data.columns)
+    dates = factor_data.index.get_level_values('date')
+    date_codes, date_index = dates.factorize(sort=True)
+    date_index.name = 'date'
+    date_num, period_num = len(date_index), len(column_names)
+
+    x = factor_data['factor'].values.astype(float)
+    y = factor_data[column_names].values.astype(float)
+    x = np.repeat(x[:, None], period_num, axis=1)
+
+    # 每一组，是 [周期 x 日期] 中的一个，组号 = 周期序号 * 日期数 + 日期序号
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    groups = (np.arange(period_num)[None, :] * date_num + date_codes[:, None])[valid]
+    x, y = x[valid], y[valid]
+    group_num = date_num * period_num
+
+    def group_sum(values):
+        return np.bincount(groups, weights=values, minlength=group_num)
+
+    n = group_sum(None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = x - (group_sum(x) / n)[groups]
+        y = y - (group_sum(y) / n)[groups]
+        sxx = group_sum(x * x)
+        sxy = group_sum(x * y)
+        syy = group_sum(y * y)
+
+        factor_returns = np.where(sxx > 0, sxy / sxx, np.nan)
+        ssr = np.maximum(syy - factor_returns * sxy, 0)
+        t_values = factor_returns / np.sqrt(ssr / (n - 2) / sxx)
+    t_values = np.where(n > 2, t_values, np.nan)
+
+    df_factor_returns = DataFrame(factor_returns.reshape(period_num, date_num).T,
+                                  index=date_index, columns=column_names)
+    df_tvalues = DataFrame(t_values.reshape(period_num, date_num).T,
+                           index=date_index, columns=column_names)
+    return df_tvalues, df_factor_returns
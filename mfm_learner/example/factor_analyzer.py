@@ -1,39 +1,39 @@
 import argparse
 import logging
+import multiprocessing
 
-import matplotlib
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-from alphalens import tears
-from alphalens.tears import create_information_tear_sheet, create_returns_tear_sheet
-from alphalens.utils import get_clean_factor_and_forward_returns, get_forward_returns_columns
-from pandas import DataFrame
 
 from mfm_learner.datasource import datasource_factory, datasource_utils
 from mfm_learner.example import factor_utils
+from mfm_learner.example.analysis import evaluation
 from mfm_learner.example.analysis.score import score
 from mfm_learner.utils import utils, db_utils
 
 logger = logging.getLogger(__name__)
 datasource = datasource_factory.create()
 
+SAVE_BATCH_SIZE = 10  # 分析结果，每多少个因子写一次库
 
-def test_by_alphalens(factor_name, factors, df_stocks, index_prices, df_stock_basic, df_mv, periods):
+
+def test_by_alphalens(factor_name, factors, df_stocks, index_prices, df_stock_basic, df_mv, periods, exposures=None):
     """
     用AlphaLens有个细节，就是你要防止未来函数，
     第二个输入变量是股票的价格数据，它是一个二维数据表(DataFrame)，行是时间，列是股票代码。
     第一是输入的价格数据必须是正确的， 必须是按照信号发出进行回测的，否则会产生前视偏差(lookahead bias)或者使用 到“未来函数”，
     可以加一个缓冲窗口递延交易来解决。例如，通常按照收盘价的回测其实就包含了这样的前视偏差，所以递延到第二天开盘价回测。
+
+    alphalens会画一堆tear sheet图，很慢，只是筛因子的话，用test_by_evaluation
     """
+    from alphalens.tears import create_information_tear_sheet, create_returns_tear_sheet
+    from alphalens.utils import get_clean_factor_and_forward_returns
 
     # 因子预处理
     factors = factor_utils.preprocess(factors)
 
     # 中性化
-    factors = factor_utils.neutralize(factors, df_stock_basic, df_mv)
+    factors = factor_utils.neutralize(factors, df_stock_basic, df_mv, exposures)
 
     # column为股票代码，index为日期，值为收盘价
     df_stock_close = df_stocks.pivot_table(index='datetime', columns='code', values='close')
@@ -110,6 +110,52 @@ def test_by_alphalens(factor_name, factors, df_stocks, index_prices, df_stock_ba
     return df_result
 
 
+def test_by_evaluation(factor_name, factors, df_stocks, index_prices, df_stock_basic, df_mv, periods, plot=False,
+                       exposures=None):
+    """
+    和test_by_alphalens一样的检验、打分，但是用的是evaluation里的numpy实现，不画tear sheet图，
+    算出来的是同样的结构（factor_data、ic_data、mean_quantile_ret_bydate...），直接给score打分，
+    画图是可选的（plot=True），只画因子分层的累计收益率图
+    exposures是factor_utils.neutralize_exposures预先算好的市值、行业，不传就用df_stock_basic、df_mv现算
+    """
+    factors = factor_utils.preprocess(factors)
+    factors = factor_utils.neutralize(factors, df_stock_basic, df_mv, exposures)
+
+    df_stock_close = df_stocks.pivot_table(index='datetime', columns='code', values='close')
+    df_stock_close = df_stock_close[df_stock_close.index.isin(factors.index.get_level_values('datetime'))]
+
+    factor_data = evaluation.get_clean_factor_and_forward_returns(factors, df_stock_close, periods)
+
+    # 分层收益率
+    mean_quantile_ret_bydate = evaluation.mean_return_by_quantile(factor_data)
+    logger.debug("mean_quantile_ret_bydate 分层的收益率的每期数据(只显示3行)\n:%r", mean_quantile_ret_bydate.head(3))
+
+    # IC法
+    ic_data = evaluation.information_coefficient(factor_data)
+    ic_mean_0_t_values, p_value, skew, kurtosis = evaluation.ic_statistics(ic_data)
+    logger.debug("ic_data(只显示3行):\n%r", ic_data.head(3))
+
+    # 回归法
+    factor_return_0_t_vlues, factor_returns = factor_returns_regression(factor_data)
+
+    df_result, retuns_filterd_by_period_quantile = \
+        score(factor_return_0_t_vlues,
+              factor_returns,
+              ic_data,
+              ic_mean_0_t_values,
+              skew,
+              kurtosis,
+              mean_quantile_ret_bydate,
+              periods)
+
+    if plot:
+        plot_quantile_cumulative_returns(retuns_filterd_by_period_quantile,
+                                         factor_name,
+                                         periods,
+                                         index_prices)
+    return df_result
+
+
 def factor_returns_regression(factor_data):
     """
     入参，factor_data:
@@ -129,63 +175,11 @@ def factor_returns_regression(factor_data):
         factor_returns: shape[Days,Periods]
         Days，就是有多少天，如2020-1-1~2022-1-1
         Period，就是调仓周期，如[1,5,20]
-    """
 
-    def cross_section_regression(date_data):
-        """
-        截面回归，每一天，50只股票的收益，50只股票的因子，
-        回归出：因子收益率、T值
-        R_i = beta_i * f + e_i
-        f就是因子收益
-        """
-
-        def regression(returns, factors):
-            factors = sm.add_constant(factors)
-            model = sm.OLS(returns, factors)  # 定义x，y
-            results = model.fit()
-            # 这个Tvalue，是回归系数不为0的假设显著性检验
-            t_value = results.tvalues[1]
-            factor_return = results.params[1]
-            return t_value, factor_return
-
-        factors = date_data['factor']
-        # get_forward_returns_columns会返回1D,2D,...的列名，是alphalens内嵌的函数
-        # 针对每个周期（1D，5D，10D），都进行处理，所以有多少个周期，就有多少个因子收益率值和T值
-        tvalues = []
-        factor_returns = []
-
-        # 按照不同的间隔日期，来做不同间隔日期（1D，5D，10D...)的因子收益率
-        for column in get_forward_returns_columns(date_data.columns):
-            returns = date_data[column]
-            # 回归啥呢？回归因子收益率：股票收益率r = 因子值 * 因子收益率 + 残差，这里的待求系数为 "因子收益率"
-            t_value, factor_return = regression(returns, factors)  # 这个是一天，横截面，这一天，因子的收益率
-            tvalues.append(t_value) # tvalue，是因子收益率不为0的显著性t检验
-            factor_returns.append(factor_return)
-        return tvalues, factor_returns
-
-    # 因为要重新分组，所以先拷贝一个
-    factor_data = factor_data.copy()
-
-    # 按照日期分组
-    date_groups = factor_data.groupby(level='date')
-
-    df_factor_returns = []
-    df_tavlues = []
-
-    # 循环每一天，对每一天，都回归出一个收益率，这样形成一个收益率序列
-    # 但是因为，我们同时处理不同周期的（1D，5D，10D...），这个的收益率序列是不同周期的
-    for name, df_cross_section in date_groups:
-        # 按照某一天进行截面回归，返回的是某一天（或者某5天，10天）的因子收益率，
-        # 以及tvalues（tvalue是判断因子收益率不为0的T检验值）
-        tvalues, factor_returns = cross_section_regression(df_cross_section)
-        df_factor_returns.append(factor_returns)
-        df_tavlues.append(tvalues) # 这里有N天的截面T检验值
-
-    column_names = get_forward_returns_columns(factor_data.columns)
-    date_index = factor_data.index.unique(level='date')
-    df_tavlues = DataFrame(df_tavlues, index=date_index, columns=column_names)
-    df_factor_returns = DataFrame(df_factor_returns, index=date_index, columns=column_names)
-    return df_tavlues, df_factor_returns
+    用的是evaluation里向量化的一元回归（所有天、所有周期一起算），
+    原来是每天、每个周期都用statsmodels.OLS回归一次，结果是一样的（误差1e-10以内）
+    """
+    return evaluation.factor_returns_regression(factor_data)
 
 
 def plot_quantile_cumulative_returns(quantile_cumulative_returns, factor_name, periods, index_prices, quantile=5):
@@ -198,6 +192,14 @@ def plot_quantile_cumulative_returns(quantile_cumulative_returns, factor_name, p
     :param quantile: 分组个数，默认为5
     :return:
     """
+    import matplotlib
+    import matplotlib.cm as cm
+    import matplotlib.pyplot as plt
+    from alphalens import tears
+
+    matplotlib.rcParams['font.sans-serif'] = ['Arial Unicode MS']  # 指定默认字体
+    matplotlib.rcParams['axes.unicode_minus'] = False  # 解决负号'-'显示为方块的问题
+
     plt.clf()
     fig, axes = plt.subplots(len(quantile_cumulative_returns), 1, figsize=(18, 18))
     # subplots很诡异，如果只有1个subplot，返回的ax是个单数，而不是list，所以统一成list
@@ -250,18 +252,24 @@ def plot_quantile_cumulative_returns(quantile_cumulative_returns, factor_name, p
     tears.plot_image(factor_name=factor_name)
 
 
-def main(factor_names, start_date, end_date, index_code, periods, num):
-    """
-    :param index_code: 股票池/指数代码
-    :param periods: 调仓周期，如 20,30
-    :param num: 股票池中使用多少只作为测试子集，仅用于测试
-    """
+# 并行分析时，每个进程都用的同一份行情、市值、行业等数据，进程池启动时设置进来，只读
+_shared_data = None
 
-    pd.set_option('display.max_rows', 1000)
-    matplotlib.rcParams['font.sans-serif'] = ['Arial Unicode MS']  # 指定默认字体
-    matplotlib.rcParams['axes.unicode_minus'] = False  # 正常显示负号
-    matplotlib.rcParams['axes.unicode_minus'] = False  # 解决负号'-'显示为方块的问题
 
+def __init_worker(shared_data):
+    global _shared_data
+    _shared_data = shared_data
+
+    # fork出来的子进程，父进程在load_shared_data中已经用过数据源了，丢掉继承来的连接池，用的时候再建新的
+    if multiprocessing.parent_process() is not None:
+        datasource_factory.dispose_inherited_connections()
+
+
+def load_shared_data(start_date, end_date, index_code, periods, num, use_alphalens=False, plot=False):
+    """
+    加载所有因子分析都要用的数据：股票池、行情、市值、行业、指数价格，
+    以及预先算好的中性化用的市值、行业（factor_utils.neutralize_exposures），每个因子就不用再算一遍了
+    """
     stock_codes = datasource.index_weight(index_code, start_date, end_date)
 
     stock_codes = stock_codes[:num]
@@ -284,17 +292,85 @@ def main(factor_names, start_date, end_date, index_code, periods, num):
     index_prices = datasource.index_daily(index_code, start_date=start_date, end_date=end_date)
     assert len(index_prices) > 0, index_prices
 
-    # 获得因子信息（注意：因子需要用factor_creator提前创建）
-    for factor_name in factor_names:
-        # 获得目标的多只股票的因子信息
-        df_factor = factor_utils.get_factor(factor_name, stock_codes, start_date, end_date)
-        if df_factor is None or len(df_factor) == 0:
-            logger.warning("无法加载因子[%s]，请运行因子创建程序去创建因子：factor_create.py", factor_name)
-            continue
+    return {
+        'stock_codes': stock_codes,
+        'start_date': start_date,
+        'end_date': end_date,
+        'periods': periods,
+        'df_stocks': df_stocks,
+        'df_mv': df_mv,
+        'df_stock_basic': df_stock_basic,
+        'index_prices': index_prices,
+        'exposures': factor_utils.neutralize_exposures(df_stock_basic, df_mv),
+        'use_alphalens': use_alphalens,
+        'plot': plot
+    }
+
+
+def analyze_factor(factor_name):
+    """用_shared_data分析一个因子，返回(因子名，打分结果)，因子不存在的，打分结果为None"""
+    data = _shared_data
+
+    # 获得目标的多只股票的因子信息（注意：因子需要用factor_creator提前创建）
+    df_factor = factor_utils.get_factor(factor_name, data['stock_codes'], data['start_date'], data['end_date'])
+    if df_factor is None or len(df_factor) == 0:
+        logger.warning("无法加载因子[%s]，请运行因子创建程序去创建因子：factor_create.py", factor_name)
+        return factor_name, None
+
+    params = [factor_name, df_factor, data['df_stocks'], data['index_prices'], data['df_stock_basic'], data['df_mv'],
+              data['periods']]
+    if data['use_alphalens']:
         # 通过alphlens测试因子
-        df_result = test_by_alphalens(factor_name, df_factor, df_stocks, index_prices, df_stock_basic, df_mv, periods)
-        save_analysis_result(factor_name, df_result)
-        logger.debug("换仓周期%r的 [%s]因子得分", periods, factor_name)
+        df_result = test_by_alphalens(*params, exposures=data['exposures'])
+    else:
+        df_result = test_by_evaluation(*params, plot=data['plot'], exposures=data['exposures'])
+    logger.debug("换仓周期%r的 [%s]因子得分", data['periods'], factor_name)
+    return factor_name, df_result
+
+
+def analyze_factors(factor_names, shared_data, workers=1):
+    """
+    分析多个因子，workers>1时，用进程池并行，每个进程在启动时拿到一份shared_data(只读)，
+    然后每个因子一个任务，谁先算完先返回谁（不保证顺序）
+    :return: 生成器，每次返回 (因子名，打分结果)
+    """
+    if workers <= 1 or len(factor_names) <= 1:
+        __init_worker(shared_data)
+        for factor_name in factor_names:
+            yield analyze_factor(factor_name)
+        return
+
+    with multiprocessing.Pool(min(workers, len(factor_names)),
+                              initializer=__init_worker,
+                              initargs=(shared_data,)) as pool:
+        for result in pool.imap_unordered(analyze_factor, factor_names):
+            yield result
+
+
+def main(factor_names, start_date, end_date, index_code, periods, num, use_alphalens=False, plot=False, workers=1):
+    """
+    :param index_code: 股票池/指数代码
+    :param periods: 调仓周期，如 20,30
+    :param num: 股票池中使用多少只作为测试子集，仅用于测试
+    :param use_alphalens: 用alphalens检验（会画tear sheet图），默认用evaluation里的实现，快很多
+    :param plot: 不用alphalens时，是否画分层累计收益率图
+    :param workers: 并行分析因子的进程数
+    """
+
+    pd.set_option('display.max_rows', 1000)
+
+    shared_data = load_shared_data(start_date, end_date, index_code, periods, num, use_alphalens, plot)
+
+    # 分析结果攒够一批，再一起写库
+    results = []
+    for factor_name, df_result in analyze_factors(factor_names, shared_data, workers):
+        if df_result is None: continue
+        results.append((factor_name, df_result))
+        if len(results) >= SAVE_BATCH_SIZE:
+            save_analysis_results(results)
+            results = []
+    if len(results) > 0:
+        save_analysis_results(results)
 
 
 def save_analysis_result(factor_name, df_result):
@@ -304,24 +380,43 @@ def save_analysis_result(factor_name, df_result):
     :param df_result:
     :return:
     """
+    save_analysis_results([(factor_name, df_result)])
+
 
+def save_analysis_results(results):
+    """
+    将多个因子跑的结果，一起保存到数据库中
+    :param results: [(因子名，打分结果)]
+    """
     engine = utils.connect_db()
 
     # 先删除旧的因子分析结果
+    factor_names = [factor_name for factor_name, _ in results]
     if db_utils.is_table_exist(engine, "factor_analysis"):
-        db_utils.run_sql(engine, f"delete from factor_analysis where factor='{factor_name}'")
+        names = ",".join([f"'{factor_name}'" for factor_name in factor_names])
+        db_utils.run_sql(engine, f"delete from factor_analysis where factor in ({names})")
+
+    df_all = pd.concat([analysis_result_to_records(factor_name, df_result) for factor_name, df_result in results])
+    df_all.to_sql('factor_analysis', engine, index=False, if_exists="append")
+    logger.info("保存了%d个因子的分析结果：%r", len(factor_names), factor_names)
 
-    # 按照调仓周期不同，分别存成不同的记录，本来 1D,5D,10D是在列上
-    # 要把他们分别保存，这样做是为了将来可以做横向对比
+
+def analysis_result_to_records(factor_name, df_result):
+    """
+    按照调仓周期不同，分别存成不同的记录，本来 1D,5D,10D是在列上
+    要把他们分别保存，这样做是为了将来可以做横向对比
+    """
     all_columns = df_result.columns
-    period_columns = get_forward_returns_columns(all_columns)
+    period_columns = evaluation.get_forward_returns_columns(all_columns)
     without_period_columns = [c for c in all_columns if c not in period_columns]
+    df_records = []
     for period_column in period_columns:
-        df_one_period = df_result[without_period_columns + [period_column]]
+        df_one_period = df_result[without_period_columns + [period_column]].copy()
         df_one_period.columns = ['name_cn', 'name_en', 'metrics']
         df_one_period['factor'] = factor_name
         df_one_period['period'] = period_column
-        df_one_period.to_sql('factor_analysis', engine, index=False, if_exists="append")
+        df_records.append(df_one_period)
+    return pd.concat(df_records)
 
 
 """
@@ -333,6 +428,16 @@ python -m mfm_learner.example.factor_analyzer \
     --num 50 \
     --period 20 \
     --index 000905.SH
+
+# 所有因子，8个进程并行分析
+python -m mfm_learner.example.factor_analyzer \
+    --factor all \
+    --start 20180101 \
+    --end 20191230 \
+    --num 50 \
+    --period 20 \
+    --index 000905.SH \
+    --workers 8
 """
 if __name__ == '__main__':
     utils.init_logger()
@@ -344,6 +449,9 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--index', type=str, help="股票池code")
     parser.add_argument('-p', '--period', type=str, help="调仓周期，多个的话，用逗号分隔")
     parser.add_argument('-n', '--num', type=int, help="股票数量")
+    parser.add_argument('-a', '--alphalens', action='store_true', help="用alphalens检验，会画tear sheet图，慢")
+    parser.add_argument('--plot', action='store_true', help="画分层累计收益率图")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="并行分析因子的进程数")
     args = parser.parse_args()
 
     if "," in args.period:
@@ -363,4 +471,7 @@ if __name__ == '__main__':
          args.end,
          args.index,
          periods,
-         args.num)
+         args.num,
+         args.alphalens,
+         args.plot,
+         args.workers)
@@ -3,9 +3,14 @@
 """
 import argparse
 import logging
+import multiprocessing
+import resource
 import time
 
+import pandas as pd
+
 from mfm_learner.datasource import datasource_factory
+from mfm_learner.datasource.impl.preload_datasource import PreloadDataSource, PRELOAD_FUNCTIONS
 from mfm_learner.example import factor_utils
 from mfm_learner.example.factors.factor import Factor
 from mfm_learner.utils import utils, dynamic_loader
@@ -14,27 +19,152 @@ datasource = datasource_factory.get()
 
 logger = logging.getLogger(__name__)
 
+# 预加载的数据集(PreloadDataSource.data)，并行计算时，进程池启动时设置进来，只读
+_preload_data = None
+
 
-def main(factor_name, start_date, end_date, index_code, stock_num):
+def main(factor_name, start_date, end_date, index_code, stock_num, workers=1, incremental=False):
+    """
+    :param factor_name: 因子名，all是所有，多个的话用逗号分隔
+    :param workers: 并行计算因子的进程数，>1时，每个因子类一个进程去算（多个因子时，要用的数据集都先只加载一次）
+    :param incremental: 增量计算，只算库里因子最后一天之后的日期，追加进去（库里还没有的因子，还是从start_date开始算）
+    """
     start_time = time.time()
 
     class_dict = dynamic_loader.dynamic_instantiation("example.factors", Factor)
     if factor_name == "all":
-        for _, clazz in class_dict.items():
-            factor = clazz()
-            factor_name = factor.name()
-            factor = dynamic_loader.create_factor_by_name(factor_name, class_dict)
-            calculate_and_save(factor_name, factor, start_date, end_date, index_code, stock_num)
+        classes = list(class_dict.values())
     else:
-        factor = dynamic_loader.create_factor_by_name(factor_name, class_dict)
-        if factor:
-            calculate_and_save(factor_name, factor, start_date, end_date, index_code, stock_num)
+        classes = []
+        for name in factor_name.split(","):
+            clazz = type(dynamic_loader.create_factor_by_name(name, class_dict))
+            if clazz not in classes: classes.append(clazz)
+
+    # 股票池只取一次，所有因子共用
+    stock_codes = datasource.index_weight(index_code, start_date, end_date)[:stock_num]
 
+    # 每个因子类的任务：(类，股票池，计算的开始日期，结束日期，库里每个因子的最后日期)
+    tasks = []
+    for clazz in classes:
+        if not incremental:
+            tasks.append((clazz, stock_codes, start_date, end_date, None))
+            continue
+        dates = incremental_dates(clazz(), start_date, end_date)
+        if dates is None:
+            logger.info("因子[%s]已经是最新的了，不用计算", clazz.__name__)
+            continue
+        tasks.append((clazz, stock_codes, dates[0], end_date, dates[1]))
+    if len(tasks) == 0: return
+
+    try:
+        # 多个因子，先把它们要用的数据集，各加载一次
+        preload_start_date = min([task[2] for task in tasks])
+        preload_data = preload_datasets([task[0] for task in tasks], stock_codes, preload_start_date, end_date) \
+            if len(tasks) > 1 else None
+
+        if workers > 1 and len(tasks) > 1:
+            # 每个进程只算一个因子类(maxtasksperchild=1)，进程的峰值内存，就是这个因子的峰值内存
+            with multiprocessing.Pool(min(workers, len(tasks)),
+                                      initializer=__init_worker,
+                                      initargs=(preload_data, Factor.daily_data),
+                                      maxtasksperchild=1) as pool:
+                stats = pool.starmap(calculate_factor, tasks)
+        else:
+            __init_worker(preload_data, {})
+            stats = [calculate_factor(*task) for task in tasks]
+    finally:
+        # 算完了，释放预加载的日线、数据集，同一个进程里再调用main（或者接着跑分析），不会一直占着内存
+        global _preload_data
+        _preload_data = None
+        Factor.clear_daily_data()
+
+    report(stats)
     logger.info("合计处理因子耗时 %.2f 秒", time.time() - start_time)
 
 
-def calculate_and_save(factor_name, factor, start_date, end_date, index_code, stock_num):
-    stock_codes = datasource.index_weight(index_code, start_date, end_date)[:stock_num]
+def incremental_dates(factor, start_date, end_date):
+    """
+    增量计算的日期：库里因子最后一天之后的，才需要算、追加，
+    再往前多加载factor.warmup_days个交易日的数据，给滚动窗口预热（比如turnover_2y要480天）
+    :return: (计算的开始日期，{因子名: 库里的最后日期})，
+             库里还没有、或者没法增量的因子，返回 (start_date, None)，即全部计算、替换，
+             已经是最新的了，返回None
+    """
+    factor_names = factor.name() if type(factor.name()) == list else [factor.name()]
+    last_dates = {name: factor_utils.get_factor_last_date(name) for name in factor_names}
+    if not factor.incremental or None in last_dates.values():
+        return start_date, None
+
+    new_start_date = utils.tomorrow(min(last_dates.values()))
+    if new_start_date > end_date: return None
+    if factor.warmup_days == 0: return new_start_date, last_dates
+
+    # 交易日大概是自然日的2/3，多往前取一些自然日，保证够warmup_days个交易日
+    trade_dates = list(datasource.trade_cal(utils.last_day(new_start_date, factor.warmup_days * 2 + 30),
+                                            utils.last_day(new_start_date, 1)))
+    return trade_dates[-min(factor.warmup_days, len(trade_dates))], last_dates
+
+
+def preload_datasets(classes, stock_codes, start_date, end_date):
+    """
+    看看这些因子类都用到了哪些数据集（Factor.datasets），每个数据集按照最大的日期范围，只加载一次：
+    - 日线：放到Factor.daily_data中
+    - 其他的（daily_basic、fina_indicator...）：放到PreloadDataSource中
+    :return: PreloadDataSource预加载的数据，给子进程用
+    """
+    years = {}
+    for clazz in classes:
+        for dataset, num in clazz.datasets.items():
+            years[dataset] = max(years.get(dataset, 0), num)
+
+    preload_datasource = PreloadDataSource(datasource)
+    for dataset, num in years.items():
+        preload_start_date = utils.last_year(start_date, num=num) if num > 0 else start_date
+        if dataset == 'daily':
+            Factor.preload_daily_data(datasource, stock_codes, preload_start_date, end_date)
+        elif dataset in PRELOAD_FUNCTIONS:
+            preload_datasource.preload(dataset, stock_codes, preload_start_date, end_date)
+    return preload_datasource.data
+
+
+def __init_worker(preload_data, daily_data):
+    global _preload_data
+    _preload_data = preload_data
+    Factor.daily_data.update(daily_data)  # fork出来的进程，本来就是同一份；spawn的话，是传过来的
+
+    # fork出来的子进程，不能和父进程共用数据库连接，丢掉继承来的连接池，用的时候再建新的
+    if multiprocessing.parent_process() is not None:
+        datasource_factory.dispose_inherited_connections()
+
+
+def calculate_factor(clazz, stock_codes, start_date, end_date, last_dates=None):
+    """
+    计算一个因子类的因子，并保存，
+    last_dates是增量计算时，库里每个因子的最后日期，只追加这之后的，不传就是全部替换
+    :return: 统计信息 (因子名, 耗时秒数, 进程峰值内存M)
+    """
+    start_time = time.time()
+    factor = clazz()
+    if _preload_data:
+        factor.datasource = PreloadDataSource(factor.datasource, _preload_data)
+    factor_name = factor.name()
+    calculate_and_save(factor_name, factor, start_date, end_date, stock_codes=stock_codes, last_dates=last_dates)
+    seconds = time.time() - start_time
+    # ru_maxrss在linux下单位是K
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return factor_name, seconds, peak_memory
+
+
+def report(stats):
+    """打印每个因子的耗时、峰值内存，慢的在前，不并行的话，峰值内存是到这个因子为止，整个进程的峰值"""
+    for factor_name, seconds, peak_memory in sorted(stats, key=lambda x: -x[1]):
+        logger.info("因子%r：耗时 %.2f 秒，进程峰值内存 %.0fM", factor_name, seconds, peak_memory)
+
+
+def calculate_and_save(factor_name, factor, start_date, end_date, index_code=None, stock_num=None, stock_codes=None,
+                       last_dates=None):
+    if stock_codes is None:
+        stock_codes = datasource.index_weight(index_code, start_date, end_date)[:stock_num]
 
     start_time = time.time()
     df_factor = factor.calculate(stock_codes, start_date, end_date)
@@ -46,11 +176,18 @@ def calculate_and_save(factor_name, factor, start_date, end_date, index_code, st
         # 处理像turnover这样，一次创建多个因子的情况
         for n, f in zip(factor_names, df_factor):
             # factor默认索引是datetime和code，为了保存数据库中，需要unindex
-            f = f.reset_index()
-            factor_utils.factor2db(name=n, factor=f)
+            f = __after_last_date(f, n, last_dates).reset_index()
+            factor_utils.factor2db(name=n, factor=f, append=last_dates is not None)
     else:
-        df_factor = df_factor.reset_index()
-        factor_utils.factor2db(name=factor_name, factor=df_factor)
+        df_factor = __after_last_date(df_factor, factor_name, last_dates).reset_index()
+        factor_utils.factor2db(name=factor_name, factor=df_factor, append=last_dates is not None)
+
+
+def __after_last_date(df_factor, factor_name, last_dates):
+    """增量计算时，只留下库里最后日期之后的（前面预热的日期，库里已经有了）"""
+    if last_dates is None: return df_factor
+    dates = pd.to_datetime(df_factor.index.get_level_values('datetime'))
+    return df_factor[dates > pd.Timestamp(last_dates[factor_name])]
 
 
 """
@@ -68,6 +205,23 @@ python -m mfm_learner.example.factor_creator \
     --num 10 \
     --index 000905.SH 
 
+python -m mfm_learner.example.factor_creator \
+    --factor all \
+    --start 20180101 \
+    --end 20191230 \
+    --num 500 \
+    --index 000905.SH \
+    --workers 8
+
+# 每天增量更新，只算库里最后一天之后的
+python -m mfm_learner.example.factor_creator \
+    --factor all \
+    --start 20080101 \
+    --end 20220209 \
+    --num 100000 \
+    --index 000905.SH \
+    --incremental
+
 python -m mfm_learner.example.factor_creator \
     --factor bm \
     --start 20180101 \
@@ -85,10 +239,14 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--end', type=str, help="结束日期")
     parser.add_argument('-i', '--index', type=str, help="股票池code")
     parser.add_argument('-n', '--num', type=int, help="股票数量")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="并行计算因子的进程数")
+    parser.add_argument('--incremental', action='store_true', help="增量计算，只算、追加库里最后一天之后的日期")
     args = parser.parse_args()
 
     main(args.factor,
          args.start,
          args.end,
          args.index,
-         args.num)
+         args.num,
+         args.workers,
+         args.incremental)
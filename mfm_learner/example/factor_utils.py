@@ -1,13 +1,15 @@
 import logging
+import warnings
 
 import numpy as np
 import pandas as pd
+import sqlalchemy
 from pandas import DataFrame, Series
 from sklearn import preprocessing
 
 from mfm_learner.datasource import datasource_utils, datasource_factory
 from mfm_learner.example.factors.factor import Factor
-from mfm_learner.utils import utils, dynamic_loader, logging_time, db_utils
+from mfm_learner.utils import CONF, utils, dynamic_loader, logging_time, db_utils
 
 logger = logging.getLogger(__name__)
 
@@ -54,13 +56,36 @@ def preprocess(factors):
     # 如果就1列，就转成Series，方便处理
     if type(factors) == DataFrame and len(factors.columns) == 1:
         factors = factors.iloc[:, 0]
+    assert type(factors) == Series, type(factors)
 
     """
-    做标准化处理，都是基于截面的，即某一天，多只股票，之间的值填充nan，去极值，标准化
+    做标准化处理，都是基于截面的，即某一天，多只股票，之间的值填充nan，去极值，标准化，
+    结果和逐日的 groupby(level='datetime').apply(fill_nan/winsorize/standardize) 一样，
+    但是不再每天调一次python函数，而是先转成[日期 x 股票]的二维矩阵，按行(即截面)一次性算完：
     """
-    factors = factors.groupby(level='datetime').apply(fill_nan)  # 填充NAN，以截面的均值来填充nan
-    factors = factors.groupby(level='datetime').apply(winsorize)  # 去极值，把分数为97.5%和2.5%之外的异常值替换成分位数值
-    factors = factors.groupby(level='datetime').apply(standardize)  # 标准化（减去均值除以方差）
+    date_pos, _ = pd.factorize(factors.index.get_level_values('datetime'))
+    code_pos, codes = pd.factorize(factors.index.get_level_values('code'))
+    panel = np.full((date_pos.max() + 1, len(codes)), np.nan)
+    panel[date_pos, code_pos] = factors.values
+    exists = np.zeros(panel.shape, dtype=bool)
+    exists[date_pos, code_pos] = True  # 矩阵中有的格子是原来就没有的(当天没有这只股票)，不能参与填充
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # 某天全是nan、或只有1只股票时，numpy会告警
+
+        # 填充NAN，以截面的均值来填充nan
+        mean = np.nanmean(panel, axis=1, keepdims=True)
+        panel = np.where(np.isnan(panel) & exists, mean, panel)
+
+        # 去极值，把分数为97.5%和2.5%之外的异常值替换成分位数值，nanquantile和Series.quantile一样，都是线性插值
+        q = np.nanquantile(panel, [0.025, 0.975], axis=1, keepdims=True)
+        panel = np.where(panel < q[0], q[0], panel)
+        panel = np.where(panel > q[1], q[1], panel)
+
+        # 标准化（减去均值除以方差），和Series.std()一样，用样本标准差(ddof=1)
+        panel = (panel - np.nanmean(panel, axis=1, keepdims=True)) / np.nanstd(panel, axis=1, ddof=1, keepdims=True)
+
+    factors = Series(panel[date_pos, code_pos], index=factors.index, name=factors.name)
     logger.debug("规范化预处理，%d行", len(factors))
     return factors
 
@@ -217,15 +242,70 @@ def pct_chg(prices, days=1):
     return (prices.shift(-days) - prices) / prices  # 向后错days天
 
 
-# 行业、市值中性化 - 对Dataframe数据，参考自jaqs_fxdayu代码
-def neutralize(factor_df, df_stock_basic, df_mv):
+def cross_sectional_residual(signal, industry=None, size=None):
     """
-    :param factor_df:
-    :param df_stock_basic:    股票的基本信息，包含了行业
-
-    :return:
+    每天(截面)，用 行业one-hot + 市值 去回归因子值，返回回归残差：
+        signal = w1*industry_1 + ... + wn*industry_n + b*size + e
+
+    不再每天get_dummies+lstsq，而是用FWL定理(Frisch-Waugh-Lovell)，变成分组去均值+分组求和，一次算完：
+    - 只有行业：行业one-hot回归的残差，就是减去 当天+行业 的均值
+    - 只有市值：带截距项的一元回归，signal和size都减去当天的均值，b = sum(x*y)/sum(x*x)，残差 = y - b*x
+    - 行业+市值：signal和size都减去 当天+行业 的均值，然后同上，求b和残差
+    这和原来每天lstsq的残差是一样的(残差是到回归空间的投影，和系数解是否唯一无关)
+
+    :param signal: 因子值，index为[datetime|code]的Series
+    :param industry: 行业代码，和signal同索引，None则不做行业中性化
+    :param size: 市值，和signal同索引，None则不做市值中性化
+    :return: 残差，和signal同索引
+    """
+    assert industry is not None or size is not None, "行业和市值，至少要有一个"
+    # 先把 日期、日期+行业 编成整数组号，后面的分组求和都用np.bincount，比groupby快得多
+    date_groups, _ = pd.factorize(signal.index.get_level_values('datetime'))
+    groups = date_groups
+    if industry is not None:
+        industry_groups, industries = pd.factorize(np.asarray(industry))
+        groups = date_groups * len(industries) + industry_groups
+
+    def _group_sum(values, groups):
+        return np.bincount(groups, weights=values)[groups]
+
+    def _demean(values):
+        return values - _group_sum(values, groups) / np.bincount(groups)[groups]
+
+    y = _demean(signal.values.astype(float))
+    if size is not None:
+        size = np.asarray(size, dtype=float)
+        x = _demean(size)
+        xx = _group_sum(x * x, date_groups)
+        # 当天市值在行业内都没差异(比如每个行业就1只股票)，市值这列就是多余的了，b按0算，和lstsq的最小范数解一样
+        tolerance = _group_sum(size * size, date_groups) * 1e-12
+        beta = np.where(xx > tolerance, _group_sum(x * y, date_groups) / np.where(xx > tolerance, xx, 1), 0)
+        y = y - beta * x
+    return Series(y, index=signal.index, name=signal.name)
+
+
+def neutralize_exposures(df_stock_basic=None, df_mv=None):
+    """
+    中性化要用的：去极值、标准化后的市值，每只股票的申万行业代码，
+    多个因子用同一份市值、行业做中性化的时候（比如factor_analyzer一次分析多个因子），先算好，传给neutralize，
+    就不用每个因子都再preprocess一遍市值、再转换一遍行业了
+    :param df_stock_basic: 股票的基本信息，包含了code、industry(中文行业名)列，为空则不算行业
+    :param df_mv: 市值，index为[datetime|code]，为空则不算市值
+    :return: (size, industry)，size是[datetime|code]索引的Series，industry是code索引的Series，没传的为None
     """
+    size, industry = None, None
+    if df_mv is not None:
+        size = preprocess(df_mv).rename("size")
+    if df_stock_basic is not None:
+        assert 'code' in df_stock_basic, df_stock_basic
+        series_industry = df_stock_basic.drop_duplicates('code').set_index('code')['industry']
+        # 这步很重要，行业数据是中文的（吐槽tushare），我必须要转成申万的行业代码
+        industry = datasource_utils.compile_industry(series_industry).rename("industry")
+    return size, industry
 
+
+# 行业、市值中性化 - 对Dataframe数据，参考自jaqs_fxdayu代码
+def neutralize(factor_df, df_stock_basic=None, df_mv=None, exposures=None):
     """
     对因子做行业、市值中性化，实际上是用市值来来做回归。
     因为有很多天数据，所以，这个F和X是一个[Days]的一个向量，回归出的e，是一个[days]的残差向量
@@ -253,97 +333,41 @@ def neutralize(factor_df, df_stock_basic, df_mv):
                         2016-06-28	0.135215	0.010403	0.059038	-0.034879	0.111691
                         2016-06-29	0.068774	0.019848	0.058476	-0.049971	0.042805
                         2016-06-30	0.039431	0.012271	0.037432	-0.027272	0.010902
-    :param float_mv: 流通市值因子(pandas.Dataframe类型),index为datetime, colunms为股票代码．为空则不进行市值中性化
+    :param df_mv: 市值，index为[datetime|code]．为空则不进行市值中性化，只做行业中性化
+    :param df_stock_basic: 股票的基本信息，包含了行业．为空则不进行行业中性化，只做市值中性化
+    :param exposures: neutralize_exposures预先算好的(市值, 行业)，传了就不用df_stock_basic、df_mv了
     :return: 中性化后的因子值(pandas.Dataframe类型),index为datetime, colunms为股票代码。
     """
 
-    def _get_stock_info(factor_df):
-        """从索引中剥离开始日期、结束日期、所有的股票"""
-        assert len(factor_df.index.names) == 2 and factor_df.index.names[0] == 'datetime', factor_df.index.names
-        assert len(factor_df.index.names) == 2 and factor_df.index.names[1] == 'code', factor_df.index.names
-        stock_codes = factor_df.index.levels[1].tolist()
-        dates = factor_df.index.levels[0]
-        dates = dates.sort_values()
-        start_date = utils.date2str(dates[0])
-        end_date = utils.date2str(dates[-1])
-        return stock_codes, start_date, end_date
-
-    def _ols_by_numpy(x, y):
-        # least-squares，最小二乘，m是回归系数：y = m * x + resid
-        m = np.linalg.lstsq(x, y)[0]
-        # 得到残差
-        resid = y - (x @ m)
-        return resid
-
-    def _generate_cross_sectional_residual(data):
-        """
-        就是把industry，变成one-hot，然后和signal（因子值）做多元回归，求残差
-        --------------------------------------------------
-        date        code        signal          industry
-        2016-06-24	000123.SH   1.1             23
-        2016-06-24	000124.SH   1.2             23
-        2016-06-24	000125.SH   1.3             22
-        2016-06-24	000126.SH   1.4             22
-        :param data:
-        :return:
-        """
-        for _, X in data.groupby(level=0):
-            # signal就是因子值
-            signal = X.pop("signal")  # pop这写法骚啊，就是单独取一列的意思，和X['pop']一个意思，不过，还包含了删除这列
-            """
-            pd.get_dummies(['A','B','A','C'])
-               A  B  C
-            0  1  0  0
-            1  0  1  0
-            2  1  0  0
-            3  0  0  1
-            X可能会有两列[signal,style(mv)]，也可能只有1列[signal]，
-            最终回归的时候，signal会变成one-hot，
-            """
-            X = pd.concat([X, pd.get_dummies(X.pop("industry"))], axis=1)
-            """
-            signal(factor value因子值) = w1*0 + ... wi*1 + ... wn*0 + e
-            我们用行业的one-hot作为x，去多元回归因子值y，剩余的残差e，就是我们需要的
-            """
-            signal = pd.Series(_ols_by_numpy(X.values, signal), index=signal.index, name=signal.name)
-            # 靠，为何要用yield，看着晕，其实就是每行都处理的意思
-            yield signal
-
-    stock_codes, start_date, end_date = _get_stock_info(factor_df)
-
-    df_factor_temp = DataFrame(factor_df)  # 防止他是Series
+    assert len(factor_df.index.names) == 2 and factor_df.index.names[0] == 'datetime', factor_df.index.names
+    assert len(factor_df.index.names) == 2 and factor_df.index.names[1] == 'code', factor_df.index.names
     assert check_factor_format(factor_df, index_type='date_code')
-    df_factor_temp = df_factor_temp.reset_index()
-
-    # 行业中性化
-    assert 'code' in df_factor_temp, df_factor_temp
-    assert 'code' in df_stock_basic, df_stock_basic
-    # 把因子数据，和，股票基础数据（包含行业）做merge
-    df_factor_temp = df_factor_temp.merge(df_stock_basic[['code', 'industry']],
-                                          on="code")  # stocks_info行太少，需要和factors做merge
-    df_factor_temp = df_factor_temp.set_index(['datetime', 'code'])
 
-    # 这步很重要，行业数据是中文的（吐槽tushare），我必须要转成申万的行业代码
-    df_industry = datasource_utils.compile_industry(df_factor_temp['industry'])
+    if exposures is None:
+        exposures = neutralize_exposures(df_stock_basic, df_mv)
+    size, industry = exposures
 
     data = []
 
     # 准备因子数据
-    assert check_factor_format(factor_df, index_type='date_code')
-    data.append(utils.dataframe2series(factor_df).rename("signal"))
+    signal = utils.dataframe2series(factor_df).rename("signal")
+    data.append(signal)
 
     # 获取对数流动市值，并去极值、标准化。市值类因子不需进行这一步
-    df_mv = preprocess(df_mv)
-    data.append(df_mv)
+    if size is not None:
+        data.append(size)
 
-    # 行业中性化处理
-    assert check_factor_format(df_industry, index_type='date_code')
-    industry_standard = utils.dataframe2series(df_industry).rename("industry")
-    data.append(industry_standard)
+    if industry is not None:
+        # 行业是按股票的，按照因子的股票列，贴到每一行上
+        codes = signal.index.get_level_values('code')
+        data.append(pd.Series(industry.reindex(codes).values, index=signal.index, name="industry"))
 
     data = pd.concat(data, axis=1).dropna()  # 按列(axis=1)合并，其实是贴到最后一列上，索引要相同，都是 [datetime|code]
-    # 做行业中性化 = one-hot行业回归后的残差
-    residuals = pd.concat(_generate_cross_sectional_residual(data))
+
+    # 做行业、市值中性化 = 回归后的残差
+    residuals = cross_sectional_residual(data['signal'],
+                                         industry=data['industry'] if 'industry' in data else None,
+                                         size=data['size'] if 'size' in data else None)
 
     """"
     中性化结果：
@@ -367,6 +391,15 @@ def get_factor_names():
     return names
 
 
+def _parquet_factor_store():
+    """
+    因子存在哪：配置的是parquet数据源的话，因子也存在本地parquet目录中(factor_<name>/)，不用数据库，
+    否则（database、tushare...）还是存在数据库中，返回None
+    """
+    if CONF['datasource'] != 'parquet': return None
+    return datasource_factory.create('parquet')
+
+
 def __get_one_factor(datasource, name, stock_codes, start_date, end_date):
     df = datasource.get_factor(name, stock_codes, start_date, end_date)
     if df is None: return None
@@ -385,7 +418,8 @@ def get_factor(name, stock_codes, start_date, end_date):
     :return:
     """
 
-    datasource = datasource_factory.create('database')  # 因子只可能在数据库中，这里写死数据源类型
+    # 因子只可能在数据库或者本地parquet中，不会在tushare之类的里面
+    datasource = _parquet_factor_store() or datasource_factory.create('database')
 
     if type(name) == list:
         df_factors = [__get_one_factor(datasource, __name, stock_codes, start_date, end_date) for __name in name]
@@ -409,6 +443,12 @@ def get_factor_dict(factor_names, stock_codes, start_date, end_date):
 
 def get_factor_synthesis(name, stock_codes, start_date, end_date):
     """直接替换旧数据"""
+    store = _parquet_factor_store()
+    if store:
+        df = datasource_utils.reset_index(store.get_factor_synthesis(name, stock_codes, start_date, end_date))
+        logger.debug("从本地parquet加载合成因子[%s] %d条", name, len(df))
+        return df
+
     engine = utils.connect_db()
 
     stock_codes = db_utils.list_to_sql_format(stock_codes)
@@ -429,32 +469,61 @@ def get_factor_synthesis(name, stock_codes, start_date, end_date):
     return df
 
 
-def __factor2db_one(name, df):
-    """直接替换旧数据"""
+def __factor2db_one(name, df, append=False):
+    """默认直接替换旧数据，append是增量计算时，把新的日期追加到后面"""
+    store = _parquet_factor_store()
+    if store:
+        store.save_factor(name, df, append)
+        logger.debug("保存因子到本地parquet：[%s]，%s%d行", f'factor_{name}', "追加" if append else "", len(df))
+        return
+
     engine = utils.connect_db()
-    df.to_sql(f'factor_{name}', engine, index=False, if_exists='replace')  # replace 替换掉旧的
-    logger.debug("保存因子到数据库：表[%s]", f'factor_{name}')
+    # 批量插入，建(code,datetime)的索引，get_factor查询的时候用
+    db_utils.bulk_to_db(df, f'factor_{name}', engine, if_exists='append' if append else 'replace')
+    logger.debug("保存因子到数据库：表[%s]，%s%d行", f'factor_{name}', "追加" if append else "", len(df))
 
 
-def factor2db(name, factor):
+def factor2db(name, factor, append=False):
     if type(name) == list:
-        return [__factor2db_one(__name, __factor) for __name, __factor in zip(name, factor)]
+        return [__factor2db_one(__name, __factor, append) for __name, __factor in zip(name, factor)]
     else:
-        return __factor2db_one(name, factor)
+        return __factor2db_one(name, factor, append)
 
 
-def factor_synthesis2db(name, desc, df_factor):
+def get_factor_last_date(name):
+    """因子表中最后的日期，如'20220208'，表不存在、或者没数据，返回None"""
+    store = _parquet_factor_store()
+    if store: return store.get_factor_last_date(name)
+
     engine = utils.connect_db()
+    table_name = f'factor_{name}'
+    if not db_utils.is_table_exist(engine, table_name): return None
+    df = pd.read_sql(f'select max(datetime) from {table_name}', engine)
+    last_date = df.iloc[0, 0]
+    if last_date is None or pd.isna(last_date): return None
+    return pd.Timestamp(last_date).strftime('%Y%m%d')
+
 
+def factor_synthesis2db(name, desc, df_factor):
     df_factor['name'] = name
     df_factor['desc'] = desc
+
+    store = _parquet_factor_store()
+    if store:
+        store.save_factor_synthesis(name, df_factor)  # 一个合成因子一个目录，直接替换
+        logger.debug("保存合成因子到本地parquet：名称:%s, %d行", name, len(df_factor))
+        return
+
+    engine = utils.connect_db()
     # df_factor = datasource_utils.date2str(df_factor,'datetime') # 把日期列变成字符串
 
     # 先删除旧的因子分析结果
     if db_utils.is_table_exist(engine, "factor_synthesis"):
         db_utils.run_sql(engine, f"delete from factor_synthesis where name='{name}'")
 
-    df_factor.to_sql(f'factor_synthesis', engine, index=False, if_exists='append')  # replace 替换掉旧的
+    db_utils.bulk_to_db(df_factor, 'factor_synthesis', engine,
+                        dtype={'name': sqlalchemy.types.VARCHAR(length=64)},
+                        index_columns=['name', 'code', 'datetime'])
     logger.debug("保存合成因子到数据库：表[%s] ，名称:%s, %d行", 'factor_synthesis', name, len(df_factor))
 
 
@@ -490,107 +559,68 @@ def handle_finance_ttm(stock_codes,
     - 如果回溯到1季报、半年报、3季报，就用其 + 去年的年报 - 去年起对应的xxx报的数据，这样粗暴的公式，是为了简单
     """
 
-    # 提取，发布日期，股票，财务日期，财务指标 ，4列
-    df_finance = df_finance[['datetime', 'code', col_name_finance_date, col_name_value]]
-    # 剔除Nan
-    df_finance.dropna(inplace=True)
+    # 提取，发布日期，股票，财务日期，财务指标 ，4列，剔除Nan
+    df_finance = df_finance[['datetime', 'code', col_name_finance_date, col_name_value]].dropna()
 
-    # 对时间，升序排列
-    df_finance.sort_values('datetime', inplace=True)
+    # 对时间，升序排列，同一天发布了多份财报的（比如4月底同时发年报和1季报），财务日期靠后的算最后发布的
+    df_finance = df_finance.sort_values(['datetime', col_name_finance_date], kind='stable', ignore_index=True)
 
     # 未来的，ttm列名
     ttm_col_name_value = col_name_value + "_ttm"
 
-    # 创建空的结果DataFrame
-    df_factor = pd.DataFrame(columns=['datetime', 'code', col_name_value])
-
-    # 返回的数据，应该是交易日数据；一只一只股票的处理
-    for stock_code in stock_codes:
-
-        # 过滤一只股票
-        df_stock_finance = df_finance[df_finance['code'] == stock_code]
-
-        logger.debug("处理股票[%s]财务数据%d条", stock_code, len(df_stock_finance))
-
-        # 处理每一天
-        for the_date in trade_dates:
-
-            # 找到最后发布的行：按照当前日作为最后一天，去反向搜索发布日在当前日之前的数据，取最后一条，就是最后发布的数据
-            series_last_one = df_stock_finance[df_stock_finance['datetime'] <= the_date].iloc[-1]
-
-            # 取出最后发布的财务日期
-            finance_date = series_last_one[col_name_finance_date]
-
-            # 取出最后发布的财务日期对应的指标值
-            current_period_value = series_last_one[col_name_value]
-
-            # 如果这条财务数据是年报数据
-            if finance_date.endswith("1231"):
-                # 直接用这条数据了
-                value = current_period_value
-                # logger.debug("财务日[%s]是年报数据，使用年报指标[%.2f]作为当日指标", finance_date, value)
-            else:
-                # 如果回溯到1季报、半年报、3季报，就用其 + 去年的年报 - 去年起对应的xxx报的数据，这样粗暴的公式，是为了简单
-                last_year_value = __last_year_value(df_stock_finance, col_name_finance_date, col_name_value,
-                                                    finance_date)
-                last_year_same_period_value = __last_year_period_value(df_stock_finance, col_name_finance_date,
-                                                                       col_name_value, finance_date)
-                # 如果去年年报数据为空，或者，也找不到去年的同期的数据，
-                if last_year_value is None or last_year_same_period_value is None:
-                    value = __calculate_ttm_by_peirod(current_period_value, finance_date)
-                    # logger.debug("财务日[%s]是非年报数据，无去年报指标，使用N倍当前指标[%.2f]作为当日指标", finance_date, value)
-                else:
-                    # 当日指标 = 今年同期 + 年报指标 - 去年同期
-                    value = current_period_value + last_year_value - last_year_same_period_value
-                    # logger.debug("财务日[%s]是非年报数据，今年同期[%.2f]+年报指标[%.2f]-去年同期[%.2f]=[%.2f]作为当日指标",
-                    #              finance_date,
-                    #              current_period_value,
-                    #              last_year_value,
-                    #              last_year_same_period_value,
-                    #              value)
-
-            df_factor = df_factor.append(
-                {'datetime': the_date,
-                 'code': stock_code,
-                 col_name_value: current_period_value,
-                 ttm_col_name_value: value},
-                ignore_index=True)
-    logger.debug("生成%d条TTM数据", len(df_factor))
-    return df_factor
-
-
-def __last_year_value(df_stock_finance, finance_date_col_name, value_col_name, current_finance_date):
-    last_year_finance_date = current_finance_date[:4] + "1231"
-    return __last_year_period_value(df_stock_finance, finance_date_col_name, value_col_name,
-                                    current_finance_date=last_year_finance_date)
-
-
-def __last_year_period_value(df_stock_finance, finance_date_col_name, value_col_name, current_finance_date):
-    """获得去年同时期的财务指标"""
+    """
+    每份财报的TTM，只和这只股票的财报们有关，和是哪个交易日无关，
+    所以先对每份财报算一次TTM，再按照发布日，把财报"摊"到每个交易日上(fill_finance_by_trade_dates)，不再每天每只股票去过滤、计算
+    """
+    df_finance[ttm_col_name_value] = __calculate_ttm(df_finance, col_name_finance_date, col_name_value)
 
-    # 获得去年财务年报的时间，20211030=>20201030
-    last_year_finance_date = utils.last_year(current_finance_date)
-    df = df_stock_finance[df_stock_finance[finance_date_col_name] == last_year_finance_date]
-    # assert len(df) == 0 or len(df) == 1, str(df)
-    if len(df) == 1: return df[value_col_name].item()
-    if len(df) == 0: return None
-    logger.warning("记录数超过2条，取第一条：%r",df)
-    return df[value_col_name].iloc[0]
+    df_factor = fill_finance_by_trade_dates(df_finance, stock_codes, trade_dates, [col_name_value, ttm_col_name_value])
+    df_factor = df_factor[['datetime', 'code', col_name_value, ttm_col_name_value]]
 
+    logger.debug("生成%d条TTM数据，其中%d条找不到之前发布的财报",
+                 len(df_factor), df_factor[col_name_value].isna().sum())
+    return df_factor
 
 
-def __calculate_ttm_by_peirod(current_period_value, finance_date):
+def __calculate_ttm(df_finance, col_name_finance_date, col_name_value):
+    """
+    对每份财报计算TTM：
+    - 如果是年报，直接用年报作为TTM
+    - 如果是1季报、半年报、3季报，就用其 + 去年的年报 - 去年同期的数据
+    - 如果去年年报数据为空，或者，也找不到去年的同期的数据，就用 N倍当前指标
+    """
+    finance_dates = df_finance[col_name_finance_date]
+
+    # 去年年报的财务日期、去年同期的财务日期，财务日期就那么几十个，每个只算一次
+    unique_dates = finance_dates.unique()
+    last_year_dates = dict(zip(unique_dates, [utils.last_year(d) for d in unique_dates]))
+    last_year_period_dates = finance_dates.map(last_year_dates)
+    last_year_annual_dates = last_year_period_dates.str[:4] + "1231"
+
+    # 按照（股票，财务日期）查指标值，有重复的取第一条（按发布日排序后的）
+    df_values = df_finance.drop_duplicates(['code', col_name_finance_date], keep='first')
+    df_values = df_values.set_index(['code', col_name_finance_date])[col_name_value]
+    last_year_value = df_values.reindex(pd.MultiIndex.from_arrays([df_finance['code'], last_year_annual_dates])).values
+    last_year_same_period_value = \
+        df_values.reindex(pd.MultiIndex.from_arrays([df_finance['code'], last_year_period_dates])).values
+
+    # 非年报的财报，换算成一年的倍数
     PERIOD_DEF = {
         '0331': 4,
         '0630': 2,
         '0930': 1.33,
     }
+    is_annual = finance_dates.str.endswith("1231").values
+    current_period_value = df_finance[col_name_value].values.astype(float)
+    periods = finance_dates.str[-4:].map(PERIOD_DEF).values.astype(float)
+    if (np.isnan(periods) & ~is_annual).any():
+        logger.warning("无法根据财务日期%r得到财务的季度间隔数", finance_dates[np.isnan(periods) & ~is_annual].unique())
 
-    periods = PERIOD_DEF.get(finance_date[-4:], None)
-    if periods is None:
-        logger.warning("无法根据财务日期[%s]得到财务的季度间隔数", finance_date)
-        return np.nan
-    return current_period_value * periods
+    # 当日指标 = 今年同期 + 年报指标 - 去年同期，没有去年的数据，就用N倍当前指标
+    ttm = np.where(np.isnan(last_year_value) | np.isnan(last_year_same_period_value),
+                   current_period_value * periods,
+                   current_period_value + last_year_value - last_year_same_period_value)
+    return np.where(is_annual, current_period_value, ttm)
 
 
 def handle_finance_fill(datasource,
@@ -603,7 +633,7 @@ def handle_finance_fill(datasource,
     比如财务数据仅提供了财务报表发表日的的数据，那么我们需要用这个数据去填充其他日子，
     填充原则是，以发布日为基准，当日数据以最后发布日的数据为准，
     算法是用通用日历来填充其他数据，但是，可能某天此股票停盘，无所谓，还是给他算出来，
-    实现是，按照日历创建空记录集，然后做左连接，空位用前面的数据补齐
+    实现是，按照日历创建 股票x日期 的网格，然后用merge_asof，每天取发布日在当天之前的最后一条数据
     有个细节，开始的日子需要再之前的财务数据，因此，我只好多query1年前的财务数据来处理，最终在过滤掉之前的数据
     """
 
@@ -613,42 +643,49 @@ def handle_finance_fill(datasource,
     trade_dates = datasource.trade_cal(start_date_1years_ago, end_date)
     # 财务数据（包含1年前的）
     df_finance = datasource.fina_indicator(stock_codes, start_date_1years_ago, end_date)
-    # 提取，发布日期，股票，财务日期，财务指标 ，4列
-    df_finance = df_finance[['code', 'datetime', finance_index_col_name_value]]
-    # 对时间，升序排列
-    df_finance.sort_values('datetime', inplace=True)
-    # 创建每个交易日为一行的一个辅助dataframe，用于生成每个股票的交易数据
-    df_calender = pd.DataFrame(trade_dates)
-    df_calender.columns = ['datetime']
-    # 创建空的结果DataFrame，保存最终结果
-    df_result = pd.DataFrame(trade_dates, columns=['code', 'datetime', finance_index_col_name_value])
-    # 返回的数据，应该是交易日数据；一只一只股票的处理
-    for stock_code in stock_codes:
-        # 过滤一只股票
-        df_stock_finance = df_finance[df_finance['code'] == stock_code]
-        logger.debug("处理股票[%s]财务数据%d条", stock_code, len(df_stock_finance))
-        # 左连接，交易日（左连接）财务数据，这样，没有的交易日，数据为NAN
-        df_join = df_calender.merge(df_stock_finance, how="left", on='datetime')
-        # 为防止日期顺序有问题，重新排序
-        df_join = df_join.sort_values('datetime')
-        # 向下填充nan值，这个是一个神奇的方法，跟Stack Overflow上学的
-        # 参考 https://stackoverflow.com/questions/27905295/how-to-replace-nans-by-preceding-or-next-values-in-pandas-dataframe
-        df_join = df_join.fillna(method='ffill')
-        # 补齐股票代码
-        df_join['code'] = stock_code
-        # 因为提前了1年的数据，所以，要把这些提前数据过滤掉
-        df_join = df_join[df_join.datetime >= start_date]
-
-        # 做一个断言，理论上不应该有nan数据
-        nan_sum = df_join[finance_index_col_name_value].isnull().sum()
-        assert nan_sum == 0, f"你需要多传一年的财务数据，防止NAN: {nan_sum}行NAN "
-
-        # 合并到总结果中
-        df_result = df_result.append(df_join, ignore_index=True)
 
+    # 原来是左连接后ffill，指标为nan的财报会被前一份财报的值填上，所以这里先剔除nan
+    df_finance = df_finance.dropna(subset=[finance_index_col_name_value])
+    df_result = fill_finance_by_trade_dates(df_finance, stock_codes, trade_dates, finance_index_col_name_value)
+
+    # 因为提前了1年的数据，所以，要把这些提前数据过滤掉
+    df_result = df_result[df_result.datetime >= start_date].reset_index(drop=True)
+
+    # 做一个断言，理论上不应该有nan数据
+    nan_sum = df_result[finance_index_col_name_value].isnull().sum()
+    assert nan_sum == 0, f"你需要多传一年的财务数据，防止NAN: {nan_sum}行NAN "
     return df_result
 
 
+def fill_finance_by_trade_dates(df_finance, stock_codes, trade_dates, col_names_value):
+    """
+    用财务数据，填充 股票 x 交易日 的网格，每个交易日，用发布日在当天之前(含)的最后一份财务数据，
+    不再一只股票一只股票的merge+ffill+append，而是所有股票一次merge_asof，
+    返回 [code, datetime, 指标...] 列，按照股票、日期排序，内存就是结果这么大，
+    同一天发布了多份的，取排在最后的那份，当天之前没有发布过的，为nan
+    """
+    if type(col_names_value) == str: col_names_value = [col_names_value]
+
+    # 对时间，升序排列
+    df_finance = df_finance[['code', 'datetime'] + col_names_value].sort_values('datetime', kind='stable')
+
+    # 股票 x 交易日 的网格，按照股票、日期的顺序
+    trade_dates = pd.Series(trade_dates).astype(str).sort_values().tolist()
+    df_result = pd.DataFrame({'code': np.repeat(list(stock_codes), len(trade_dates)),
+                              'datetime': np.tile(trade_dates, len(stock_codes))})
+
+    # merge_asof：on的列必须排好序，且不能是字符串，所以先转成整数的日期
+    df_result['_date'] = df_result['datetime'].astype(int)
+    df_result['_order'] = np.arange(len(df_result))
+    df_finance = df_finance.assign(_date=df_finance['datetime'].astype(int)).drop(columns='datetime')
+    df_result = pd.merge_asof(df_result.sort_values('_date', kind='stable'),
+                              df_finance,
+                              on='_date',
+                              by='code',
+                              direction='backward')
+    return df_result.sort_values('_order').drop(columns=['_date', '_order']).reset_index(drop=True)
+
+
 # python -m mfm_learner.example.factor_utils
 if __name__ == '__main__':
     utils.init_logger()
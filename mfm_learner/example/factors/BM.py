@@ -18,6 +18,8 @@ class BMFactor(Factor):
     所以，我用市净率取一个倒数即可
     """
 
+    datasets = {'daily_basic': 0}
+
     def __init__(self):
         super().__init__()
 
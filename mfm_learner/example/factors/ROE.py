@@ -61,6 +61,8 @@ class ROETTMFactor(Factor):
     - 多只股票可能都无法对齐ROE_TTM，比如上例中A用的是当期的，而极端的D，用的居然是截止去年10.30号发布的9.30号的3季报的数据了
     """
 
+    datasets = {'fina_indicator': 2}
+
     def __init__(self):
         super().__init__()
 
@@ -112,6 +114,8 @@ class ROEYOYFactor(Factor):
 
     """
 
+    datasets = {'fina_indicator': 1}
+
     def __init__(self):
         super().__init__()
 
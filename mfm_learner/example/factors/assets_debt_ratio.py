@@ -4,6 +4,7 @@ from mfm_learner.example.factors.factor import Factor
 
 
 class AssetsDebtRateFactor(Factor):
+    datasets = {'fina_indicator': 1}
 
     def __init__(self):
         super().__init__()
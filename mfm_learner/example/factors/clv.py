@@ -17,13 +17,17 @@
 # 参考：https://www.bilibili.com/read/cv13893224?spm_id_from=333.999.0.0
 import logging
 
+import numpy as np
+
 from mfm_learner.datasource import datasource_utils
+from mfm_learner.example.factors import panel
 from mfm_learner.example.factors.factor import Factor
 
 logger = logging.getLogger(__name__)
 
 
 class CLVFactor(Factor):
+    datasets = {'daily': 0}
 
     def __init__(self):
         super().__init__()
@@ -33,17 +37,21 @@ class CLVFactor(Factor):
 
     def calculate(self, stock_codes, start_date, end_date, df_daily=None):
         if df_daily is None:
-            df_daily = datasource_utils.load_daily_data(self.datasource, stock_codes, start_date, end_date)
+            df_daily = self.load_daily_data(stock_codes, start_date, end_date)
+
+        df_daily = datasource_utils.reset_index(df_daily)
+        df_close = panel.pivot(df_daily, 'close')  # [日期 x 股票]的面板
+        close, high, low = df_close.values, panel.pivot(df_daily, 'high').values, panel.pivot(df_daily, 'low').values
+        open_price, pre_close = panel.pivot(df_daily, 'open').values, panel.pivot(df_daily, 'pre_close').values
 
         # 计算CLV因子
-        df_daily['CLV'] = ((df_daily['close'] - df_daily['low']) - (df_daily['high'] - df_daily['close'])) / (
-                df_daily['high'] - df_daily['low'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            clv = ((close - low) - (high - close)) / (high - low)
         # 处理出现一字涨跌停
-        df_daily.loc[(df_daily['high'] == df_daily['low']) & (df_daily['open'] > df_daily['pre_close']), 'CLV'] = 1
-        df_daily.loc[(df_daily['high'] == df_daily['low']) & (df_daily['open'] < df_daily['pre_close']), 'CLV'] = -1
+        clv = np.where((high == low) & (open_price > pre_close), 1, clv)
+        clv = np.where((high == low) & (open_price < pre_close), -1, clv)
 
-        df_daily = datasource_utils.reset_index(df_daily)
-        factors = df_daily['CLV']
+        factors = panel.unpivot(clv, like=df_close, name='CLV')
         logger.debug("一共加载%s~%s %d条 CLV 数据", start_date, end_date, len(factors))
 
         return factors
@@ -35,6 +35,8 @@ class DividendRateFactor(Factor):
     TODO：目前，考虑还是直接用TTM数据了
     """
 
+    datasets = {'daily_basic': 0}
+
     def __init__(self):
         super().__init__()
 
@@ -43,6 +43,8 @@ class EBITDAFactor(Factor):
     """
     """
 
+    datasets = {'income': 1}
+
     def __init__(self):
         super().__init__()
 
@@ -65,4 +67,4 @@ class EBITDAFactor(Factor):
                                              col_name_finance_date='end_date')
 
         df = datasource_utils.reset_index(df)
-        return df['ebita_ttm']
+        return df['ebitda_ttm']
@@ -27,6 +27,7 @@ PE = PRICE / EARNING PER SHARE，指股票的本益比，也称为“利润收
 """
 
 class EPFactor(Factor):
+    datasets = {'daily_basic': 0}
 
     def __init__(self):
         super().__init__()
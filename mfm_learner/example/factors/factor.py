@@ -1,8 +1,9 @@
 import logging
 from abc import ABC, abstractmethod
 
-from mfm_learner.datasource import datasource_factory
+from mfm_learner.datasource import datasource_factory, datasource_utils
 from mfm_learner.utils import CONF
+import numpy as np
 import pandas as pd
 from sqlalchemy import Table, MetaData
 
@@ -12,9 +13,52 @@ logger = logging.getLogger(__name__)
 
 
 class Factor(ABC):
+    # 所有因子共享的日线数据，{股票池: (开始日期, 结束日期, 日线数据)}，日期范围覆盖了就直接切片，
+    # 只留最后加载的那个股票池（多年的日线很大，长时间运行的进程，不能把用过的都攒着），用完了调用clear_daily_data释放
+    daily_data = {}
+
+    # 因子用到的数据集，{数据源函数名: 开始日期往前多取几年}，如 {'fina_indicator': 2}，'daily'是日线(load_daily_data)，
+    # factor_creator一次算多个因子时，据此把每个数据集只加载一次(Factor.preload_daily_data、PreloadDataSource)
+    datasets = {}
+
+    # 增量计算(factor_creator --incremental)时，新日期之前，还要多加载多少个交易日的数据，给滚动窗口预热，
+    # 自己在calculate里已经往前多取了数据的（如动量、TTM），就不用再设了；
+    # incremental=False的因子（比如用整个期间回归的），每个日期的值和计算的日期范围有关，没法增量，只能全部重算
+    warmup_days = 0
+    incremental = True
+
     def __init__(self):
         self.datasource = datasource_factory.create(CONF['datasource'])
 
+    def load_daily_data(self, stock_codes, start_date, end_date):
+        """
+        加载日线数据，同一个股票池，加载过的日期范围能覆盖的，就不再重新加载了，
+        这样多个因子（如factor_creator --factor all）、一个因子的多个周期（如动量的10日、1月...），都共用一份数据，
+        返回的是按照[code,datetime]排序的长表（拷贝，可以随便改）
+        """
+        key = tuple(sorted(stock_codes))
+        if key in Factor.daily_data:
+            cached_start_date, cached_end_date, df_daily = Factor.daily_data[key]
+            if cached_start_date <= start_date and end_date <= cached_end_date:
+                logger.debug("使用已加载的日线数据：%s~%s，%d只股票", start_date, end_date, len(stock_codes))
+                # take出来的本来就是新的一份，不用再copy一遍
+                return df_daily.take(np.flatnonzero((df_daily.datetime >= start_date) & (df_daily.datetime <= end_date)))
+
+        return Factor.preload_daily_data(self.datasource, stock_codes, start_date, end_date).copy()
+
+    @staticmethod
+    def preload_daily_data(datasource, stock_codes, start_date, end_date):
+        """加载日线数据，放到所有因子共享的daily_data中，替换掉之前的股票池的"""
+        Factor.clear_daily_data()  # 先释放，别新旧两份同时在内存里
+        df_daily = datasource_utils.load_daily_data(datasource, stock_codes, start_date, end_date)
+        Factor.daily_data[tuple(sorted(stock_codes))] = (start_date, end_date, df_daily)
+        return df_daily
+
+    @staticmethod
+    def clear_daily_data():
+        """释放共享的日线数据"""
+        Factor.daily_data.clear()
+
     # 英文名
     @abstractmethod
     def name(self):
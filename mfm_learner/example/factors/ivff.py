@@ -3,10 +3,9 @@
 import logging
 
 import numpy as np
-import pandas as pd
-import statsmodels.formula.api as sm
 
 from mfm_learner.datasource import datasource_utils
+from mfm_learner.example.factors import panel
 from mfm_learner.example.factors.factor import Factor
 from mfm_learner.fama import fama_model
 
@@ -50,14 +49,20 @@ logger = logging.getLogger(__name__)
 
 
 class IVFFFactor(Factor):
+    datasets = {'daily': 0}
 
-    def __init__(self, index_code="000905.SH"):
+    def __init__(self, index_code="000905.SH", time_window: int = None):
         """
         :param index_code: 使用的指数股票池代码
-        :param time_window: 计算
+        :param time_window: 不传，就是用整个期间回归一次，因子是每天的残差；
+                            传了（比如20），就是每天用过去time_window天滚动回归，因子是窗口内残差的标准差 * sqrt(time_window)
         """
         super().__init__()
         self.index_code = index_code
+        self.time_window = time_window
+        # 整个期间回归一次的，残差和期间有关，不能增量计算
+        self.incremental = time_window is not None
+        self.warmup_days = time_window or 0
 
     def name(self):
         return "ivff"
@@ -71,22 +76,13 @@ class IVFFFactor(Factor):
         logger.debug("获得[%s]指数日收益，作为市场收益率:%d行", self.index_code, len(df_index))
         return df_index
 
-    # TODO: 算标准差的时候，是每天都算一次么？类滑动窗口（TODO，可以用之前写的计算滑动窗酷的工具类，貌似用shift实现的）
-    def ___calculate_residuals(self, residuals, time_window):
-        result = []
-        for i in range(residuals):
-            sub_residuals = residuals[i:i + time_window]
-            if len(sub_residuals) < time_window: result.append(np.nan)
-            result.append(sub_residuals.std())
-        return result
-
     def calculate(self, stock_codes, start_date, end_date):
 
         """
         获得各只股票的信息
         """
-        df_daily = datasource_utils.load_daily_data(self.datasource, stock_codes, start_date, end_date)
-        df_daily = datasource_utils.reset_index(df_daily, date_only=True)
+        df_daily = self.load_daily_data(stock_codes, start_date, end_date)
+        df_daily = datasource_utils.reset_index(df_daily)
 
         """
         df_fama[date | smb, hml, sl, sm, sh, bl, bm, bh]，index是date
@@ -112,58 +108,22 @@ class IVFFFactor(Factor):
         # 参考：
         - https://blog.csdn.net/CoderPai/article/details/82982146 
         - https://zhuanlan.zhihu.com/p/261031713
-        使用statsmodels.formula中的ols，可以写一个表达式，来指定Y和X_i，即dataframe中的列名，很酷，喜欢        
+
+        不再对每只股票merge+statsmodels.ols，而是把股票收益率变成[日期 x 股票]的面板，
+        所有股票共用同样的x（market, SMB, HML），用panel.ts_regression一次性批量解出来，
+        停牌的日子，在面板里是nan，不参与这只股票的回归
         """
-        results = []
-        # 计算每支股票
-        for name, df_stock in df_daily.groupby('code'):
-            """
-            数据如下：
-            date        smb         hml         stock1
-            2016-06-24	0.165260	0.002198	0.085632
-            2016-06-27	0.165537	0.003583	0.063299
-            2016-06-28	0.135215	0.010403	0.059038
-            ....
-            """
-
-            # 将市场收益率合并进去
-            df_data = df_fama.merge(df_stock, on=['datetime'], how='inner')
-
-            """
-            合并后数据如下：
-            date        market  smb         hml         stock1
-            2016-06-24	0.12321 0.165260	0.002198	0.085632
-            2016-06-27	0.2331  0.165537	0.003583	0.063299
-            2016-06-28	0.1234  0.135215	0.010403	0.059038
-            ...
-            """
-
-            """
-            做回归：
-            r_i = α_i + b1 * r_m_i + b2 * smb_i + b3 * hml_i + e_i 
-            某一只股票的所有的日子的数据做回归，r_i,r_m_i，smb_i，hml_i 已知，回归后，得到e_i(残差)
-            """
-            ols_result = sm.ols(formula='pct_chg ~ market + SMB + HML', data=df_data).fit()
-
-            # 获得残差
-            residuals = ols_result.resid
-            df_data['vi'] = residuals
-            logger.debug("计算完股票[%s]的残差：%d 条", name, len(residuals))
-            results.append(df_data[['code', 'vi']])
-
-        df = pd.concat(results, axis=0)  # 把每支股票的残差，都合并到一起
-        df = df.reset_index()  # 之前仅用date作为所以，所以要reset后，设置date+code，符合因子的格式规范
-        df = datasource_utils.reset_index(df)  # 将 date+code设为索引
-        df = df.iloc[:, 0]  # 转成Series，因子都默认是Series类型
-
-        df = df.dropna()
+        df_pct_chg = panel.pivot(df_daily, 'pct_chg')
+        df_x = df_fama[['market', 'SMB', 'HML']].reindex(df_pct_chg.index)  # 对齐到股票的交易日，fama没有的日子是nan
 
-        date_index = df.index.get_level_values('datetime')
+        if self.time_window is None:
+            _, residuals = panel.ts_regression(df_pct_chg.values, df_x.values)
+            df = panel.unpivot(residuals, like=df_pct_chg, name='vi')
+        else:
+            std = panel.ts_regression_residual_std(df_pct_chg.values, df_x.values, window=self.time_window)
+            df = panel.unpivot(std * np.sqrt(self.time_window), like=df_pct_chg, name='ivff')
 
-        logger.debug("特异波动率因子%d条,日期：%r ~ %r", len(df), date_index[0], date_index[-1])
+        date_index = df.index.get_level_values('datetime')
+        logger.debug("特异波动率因子%d条,日期：%r ~ %r", len(df), date_index.min(), date_index.max())
 
         return df
-
-        # df_residuals = self.___calculate_residuals(residuals,time_window)
-        # df_residuals = datasource_utils.reset_index(df_residuals)
-        # return df_residuals
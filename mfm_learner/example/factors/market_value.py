@@ -21,6 +21,8 @@ class MarketValueFactor(Factor):
     市值因子LNAP，是公司股票市值的自然对数，
     """
 
+    datasets = {'daily_basic': 0}
+
     def __init__(self):
         super().__init__()
 
@@ -44,6 +46,8 @@ class CirculationMarketValueFactor(Factor):
     流动市值因子LNCAP，是公司股票流通市值的自然对数
     """
 
+    datasets = {'daily_basic': 0}
+
     def __init__(self):
         super().__init__()
 
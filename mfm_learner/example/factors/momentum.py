@@ -3,6 +3,7 @@ import logging
 import numpy as np
 
 from mfm_learner.datasource import datasource_utils
+from mfm_learner.example.factors import panel
 from mfm_learner.example.factors.factor import Factor
 from mfm_learner.utils import utils
 
@@ -47,6 +48,8 @@ class MomentumFactor(Factor):
 
     """
 
+    datasets = {'daily': 2}
+
     def __init__(self):
         super().__init__()
 
@@ -68,14 +71,18 @@ class MomentumFactor(Factor):
         :param df:
         :return:
         """
+        # 所有周期共用一份数据，最长的是24个月(480天)，所以往前多取2年
+        if df_daily is None:
+            start_date_2years_ago = utils.last_year(start_date, num=2)
+            df_daily = self.load_daily_data(stock_codes, start_date_2years_ago, end_date)
+        df_daily = datasource_utils.reset_index(df_daily)  # 设置日期+code为索引
+
+        df_adj_close = (panel.pivot(df_daily, 'close') + panel.pivot(df_daily, 'high') + panel.pivot(df_daily, 'low')) / 3
+        adj_close = df_adj_close.values  # [日期 x 股票]的面板
+        in_range = df_adj_close.index >= utils.str2date(start_date)
+
         results = []
         for m in mapping:
-            start_date_2years_ago = utils.last_year(start_date, num=2)
-            df_daily = datasource_utils.load_daily_data(self.datasource, stock_codes, start_date_2years_ago, end_date)
-            adj_close = (df_daily['close'] + df_daily['high'] + df_daily['low']) / 3
-            df_daily[m['name']] = np.log(adj_close / adj_close.shift(m['days']))  # shift(1) 往后移，就变成上个月的了
-            df_daily = datasource_utils.reset_index(df_daily)  # 设置日期+code为索引
-            df_factor = df_daily[m['name']]
-            df_factor.dropna(inplace=True)
-            results.append(df_factor)
+            momentum = np.log(adj_close / panel.ts_shift(adj_close, m['days']))  # ts_shift(1) 往后移，就变成上个月的了
+            results.append(panel.unpivot(momentum[in_range], like=df_adj_close[in_range], name=m['name']))
         return results
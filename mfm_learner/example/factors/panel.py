@@ -0,0 +1,217 @@
+"""
+面板(panel)工具，因子计算用：
+
+把 [datetime, code, value...] 的长表，转成 [日期 x 股票] 的二维numpy数组（每列一只股票，每行一个交易日），
+然后在上面做：
+- ts_xxx：时序算子，沿着日期(axis=0)算，每只股票是单独的一列，所以窗口、shift不会跨到别的股票上去
+- cs_xxx：截面算子，沿着股票(axis=1)算，即每天所有股票之间算
+
+这样每个因子就是几个向量化的调用，不用再groupby、apply了，比如动量：
+    adj_close = (close + high + low) / 3
+    momentum = np.log(adj_close / ts_shift(adj_close, 20))
+
+注意：某只股票某天停牌（长表中没有这行），在面板中就是nan，
+所以ts_shift(x, 20)是20个交易日之前的值（那天停牌就是nan），而不是这只股票的前20条数据。
+ts_sum/ts_mean/ts_std的窗口默认也是按交易日的，停牌的天占着窗口的位置，窗口内不够min_periods个值就是nan；
+要像原来那样，按每只股票自己的数据开窗口（即跳过停牌的天，往前凑够window个值），用skip_nan=True。
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+def pivot(df, column):
+    """
+    长表 => 面板，df是 [datetime, code, column...] 的长表，或者是 [datetime|code] 索引的，
+    返回 [日期 x 股票] 的DataFrame，日期、股票都排好序，.values就是numpy的二维数组
+    """
+    if not isinstance(df.index, pd.MultiIndex):
+        df = df.set_index(['datetime', 'code'])
+    series = df[column]
+    series = series[~series.index.duplicated(keep='last')]  # 防止有重复的[日期,股票]
+    return series.unstack('code').sort_index().sort_index(axis=1).astype(float)
+
+
+def unpivot(values, like, name):
+    """
+    面板 => [datetime|code] 索引的Series，去掉nan，
+    :param values: 二维数组
+    :param like: pivot出来的面板，用它的日期、股票做索引
+    """
+    df = DataFrame(values, index=like.index, columns=like.columns)
+    df.columns.name = 'code'
+    df.index.name = 'datetime'
+    return df.stack(dropna=True).rename(name)
+
+
+def ts_shift(x, n):
+    """往后错n天，即每天的值，是n天前的值，前n天为nan"""
+    result = np.full(x.shape, np.nan)
+    if abs(n) >= len(x): return result
+    if n >= 0:
+        result[n:] = x[:len(x) - n]
+    else:
+        result[:n] = x[-n:]
+    return result
+
+
+def __rolling_sum_count(x, window, skip_nan=False):
+    """
+    用累加和算滚动窗口的和、非nan的个数，O(日期x股票)，和窗口大小无关，
+    skip_nan=True的时候，窗口是最近的window个非nan的值（nan的那天结果也是nan）
+    """
+    valid = ~np.isnan(x)
+    cumsum = np.cumsum(np.where(valid, x, 0), axis=0)
+    cumcount = np.cumsum(valid, axis=0)
+    if skip_nan:
+        # 第k个非nan值时的累加和，放到by_count[k]，窗口的起点就是by_count[cumcount-window]
+        by_count = np.zeros((len(x) + 1, x.shape[1]))
+        rows, cols = np.nonzero(valid)
+        by_count[cumcount[rows, cols], cols] = cumsum[rows, cols]
+        start = np.maximum(cumcount - window, 0)
+        sums = np.where(valid, cumsum - np.take_along_axis(by_count, start, axis=0), np.nan)
+        counts = np.where(valid, cumcount - start, 0)
+        return sums, counts
+    sums = cumsum.copy()
+    counts = cumcount.copy()
+    sums[window:] -= cumsum[:-window]
+    counts[window:] -= cumcount[:-window]
+    return sums, counts
+
+
+def ts_sum(x, window, min_periods=None, skip_nan=False):
+    """滚动窗口的和，窗口内非nan的个数少于min_periods(默认就是window)的为nan"""
+    if min_periods is None: min_periods = window
+    sums, counts = __rolling_sum_count(x, window, skip_nan)
+    return np.where(counts >= min_periods, sums, np.nan)
+
+
+def ts_mean(x, window, min_periods=None, skip_nan=False):
+    """滚动窗口的均值，忽略nan"""
+    if min_periods is None: min_periods = window
+    sums, counts = __rolling_sum_count(x, window, skip_nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts >= min_periods, sums / counts, np.nan)
+
+
+def ts_std(x, window, min_periods=None, ddof=1, skip_nan=False):
+    """
+    滚动窗口的标准差，忽略nan，
+    用 E(x^2)-E(x)^2 算，为了防止大数相减丢精度，先把每只股票减去它自己的均值（方差和平移无关）
+    """
+    if min_periods is None: min_periods = window
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # 某只股票全是nan时，numpy会告警
+        x = x - np.nanmean(x, axis=0)
+    sums, counts = __rolling_sum_count(x, window, skip_nan)
+    square_sums, _ = __rolling_sum_count(x * x, window, skip_nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (square_sums - sums * sums / counts) / (counts - ddof)
+    var = np.where(var < 0, 0, var)  # 浮点误差可能造成很小的负数
+    return np.where((counts >= min_periods) & (counts > ddof), np.sqrt(var), np.nan)
+
+
+def ts_rank(x, window, min_periods=None):
+    """
+    当天的值，在过去window天（含当天）中的百分位排名，(0,1]，1就是窗口内最大的，
+    循环的是窗口内的每个偏移（window次向量化的比较），而不是每一天
+    """
+    if min_periods is None: min_periods = window
+    less_equal = np.zeros(x.shape)
+    counts = np.zeros(x.shape)
+    for k in range(window):
+        x_k = ts_shift(x, k)
+        valid = ~np.isnan(x_k)
+        counts += valid
+        with np.errstate(invalid='ignore'):
+            less_equal += valid & (x_k <= x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((counts >= min_periods) & ~np.isnan(x), less_equal / counts, np.nan)
+
+
+def cs_rank(x):
+    """每天的截面百分位排名，(0,1]，nan不参与排名"""
+    return DataFrame(x).rank(axis=1, pct=True).values
+
+
+def cs_zscore(x):
+    """每天的截面标准化：(x - 均值) / 标准差(ddof=1)"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # 某天全是nan、或只有1只股票时，numpy会告警
+        return (x - np.nanmean(x, axis=1, keepdims=True)) / np.nanstd(x, axis=1, ddof=1, keepdims=True)
+
+
+def __prepare_regression(y, x):
+    """加上截距项，y或者x有nan的那天，不参与这只股票的回归（mask），nan都换成0，乘上mask后就不起作用了"""
+    x = np.column_stack([np.ones(len(x)), x])
+    mask = ~np.isnan(y) & ~np.isnan(x).any(axis=1, keepdims=True)
+    return np.where(mask, y, 0), np.where(np.isnan(x), 0, x), mask
+
+
+def __solve(xtx, xty):
+    """批量解 N个 (X'X)b = X'y，奇异的（比如窗口内没几天数据）用伪逆"""
+    try:
+        return np.linalg.solve(xtx, xty[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(xtx) @ xty[..., None])[..., 0]
+
+
+def ts_regression(y, x):
+    """
+    每只股票（每列），用同样的x（比如 市场收益、SMB、HML），做带截距项的时序回归：y_n = a_n + x * b_n + e_n，
+    所有股票一起解，不用每只股票去statsmodels.ols：
+    - 都不缺数据的话，所有股票共用一个 (X'X)^-1 X'，一次矩阵乘法就解完了
+    - 有缺数据（停牌）的，每只股票的X'X不一样，用mask算出每只股票的X'X、X'y，再批量求解
+    :param y: [日期 x 股票]
+    :param x: [日期 x k]
+    :return: 系数[股票 x (1+k)]（第1个是截距），残差[日期 x 股票]（没参与回归的为nan）
+    """
+    y0, x0, mask = __prepare_regression(y, x)
+    if mask.all():
+        betas = (np.linalg.pinv(x0) @ y0).T
+    else:
+        xtx = np.einsum('tn,ti,tj->nij', mask, x0, x0, optimize=True)
+        xty = np.einsum('ti,tn->ni', x0, y0, optimize=True)
+        betas = __solve(xtx, xty)
+    betas[mask.sum(axis=0) < x0.shape[1]] = np.nan  # 数据比参数还少，没法回归
+    residuals = np.where(mask, y0 - x0 @ betas.T, np.nan)
+    return betas, residuals
+
+
+def ts_regression_residual_std(y, x, window, min_periods=None):
+    """
+    滚动窗口版的ts_regression：每天，用过去window天（含当天）的数据回归，返回窗口内残差的标准差(ddof=1)，
+    窗口的X'X、X'y、y'y、天数，都是逐日加上新的一天、减掉出窗口的那天，每天只是批量解N个小方程，
+    残差平方和 SSR = y'y - b'X'y，不用真的算出窗口内的每个残差
+    """
+    if min_periods is None: min_periods = window
+    # 每只股票减去自己的均值、x减去均值，不影响残差（截距项会吸收掉），可以减少 y'y - b'X'y 相减丢的精度
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        y = y - np.nanmean(y, axis=0)
+        x = x - np.nanmean(x, axis=0)
+    y0, x0, mask = __prepare_regression(y, x)
+    k = x0.shape[1]
+
+    outer = x0[:, :, None] * x0[:, None, :]  # [日期 x k x k]
+    xtx = np.zeros((y.shape[1], k, k))
+    xty = np.zeros((y.shape[1], k))
+    yty = np.zeros(y.shape[1])
+    counts = np.zeros(y.shape[1])
+    result = np.full(y.shape, np.nan)
+    for t in range(len(y)):
+        for s, sign in [(t, 1), (t - window, -1)]:
+            if s < 0: continue
+            xtx += sign * mask[s][:, None, None] * outer[s]
+            xty += sign * y0[s][:, None] * x0[s]
+            yty += sign * y0[s] * y0[s]
+            counts += sign * mask[s]
+
+        valid = (counts >= max(min_periods, k + 1)) & mask[t]
+        if not valid.any(): continue
+        betas = __solve(xtx[valid], xty[valid])
+        ssr = np.maximum(yty[valid] - (betas * xty[valid]).sum(axis=1), 0)
+        result[t, valid] = np.sqrt(ssr / (counts[valid] - 1))
+    return result
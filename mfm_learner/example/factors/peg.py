@@ -52,11 +52,13 @@ import numpy as np
 
 from mfm_learner.datasource import datasource_utils
 from mfm_learner.example.factors.factor import Factor
+from mfm_learner.utils import utils
 
 logger = logging.getLogger(__name__)
 
 
 class PEGFactor(Factor):
+    datasets = {'daily_basic': 0, 'fina_indicator': 1}
 
     def __init__(self):
         super().__init__()
@@ -81,8 +83,12 @@ class PEGFactor(Factor):
             # 基本数据，包含：PE
             df_basic = self.datasource.daily_basic(stock_code=stock_code, start_date=start_date, end_date=end_date)
 
-            # 财务数据，包含：归母公司净利润(TTM)增长率
-            df_finance = self.datasource.fina_indicator(stock_code=stock_code, start_date=start_date, end_date=end_date)
+            # 财务数据，包含：归母公司净利润(TTM)增长率，
+            # 多取1年前的，开始日期之前最后发布的那份，才能填充开始的那些日子（增量计算时，新的日期里往往没有发布财报），
+            # 填充的是基本数据(df_basic)，它是从start_date开始的，所以不用再过滤提前的数据
+            df_finance = self.datasource.fina_indicator(stock_code=stock_code,
+                                                        start_date=utils.last_year(start_date, num=1),
+                                                        end_date=end_date)
 
             df_finance = df_finance.sort_index(level='datetime', ascending=True)  # 从早到晚排序
 
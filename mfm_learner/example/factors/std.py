@@ -3,6 +3,7 @@ import logging
 import numpy as np
 
 from mfm_learner.datasource import datasource_utils
+from mfm_learner.example.factors import panel
 from mfm_learner.example.factors.factor import Factor
 from mfm_learner.utils import utils
 
@@ -25,6 +26,7 @@ mapping = [
 
 
 class StdFactor(Factor):
+    datasets = {'daily': 1}
 
     def __init__(self):
         super().__init__()
@@ -39,13 +41,19 @@ class StdFactor(Factor):
         """
         计算波动率，波动率，就是往前回溯period个周期
         """
+        # 所有周期共用一份数据，最长的是6个月(120天)，往前多取1年，保证开始日期就有完整的窗口
+        if df_daily is None:
+            start_date_1year_ago = utils.last_year(start_date)
+            df_daily = self.load_daily_data(stock_codes, start_date_1year_ago, end_date)
+        df_daily = datasource_utils.reset_index(df_daily)  # 设置日期+code为索引
+
+        df_pct_chg = panel.pivot(df_daily, 'pct_chg')
+        pct_chg = df_pct_chg.values  # [日期 x 股票]的面板
+        in_range = df_pct_chg.index >= utils.str2date(start_date)
+
         results = []
         for m in mapping:
-            start_days_go = utils.last_day(start_date, num=m['days'])
-            df_daily = datasource_utils.load_daily_data(self.datasource, stock_codes, start_days_go, end_date)
-            df_daily = datasource_utils.reset_index(df_daily)  # 设置日期+code为索引
-            df_pct_chg = df_daily['pct_chg']
-            df_std = df_pct_chg.rolling(window=m['days']).std()
-            df_std.dropna(inplace=True)
-            results.append(df_std)
+            # 和原来按股票groupby再rolling一样：窗口是这只股票最近days个交易的日子，跳过停牌，不然停牌1天就是nan了
+            std = panel.ts_std(pct_chg, window=m['days'], skip_nan=True)
+            results.append(panel.unpivot(std[in_range], like=df_pct_chg[in_range], name=m['name']))
         return results
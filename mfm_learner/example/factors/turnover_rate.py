@@ -32,6 +32,8 @@ logger = logging.getLogger(__name__)
 
 
 class TurnOverFactor(Factor):
+    datasets = {'daily_basic': 0}
+    warmup_days = 480  # 最长的窗口是2年(480天)
 
     def __init__(self):
         super().__init__()
@@ -60,7 +62,6 @@ class TurnOverFactor(Factor):
         0     600230.SH   20180726           4.5734  1.115326e+06
         1     600237.SH   20180726           1.7703  2.336490e+05
         """
-        print(df_daily_basic)
         df_daily_basic = df_daily_basic[['datetime', 'code', 'turnover_rate_f', 'circ_mv']]
         df_daily_basic.columns = ['datetime', 'code', 'turnover_rate', 'circ_mv']
 
@@ -89,17 +90,33 @@ class TurnOverFactor(Factor):
     """
 
     def calculate_turnover_rate(self, data):
+        """
+        原来是rolling(...).apply(func=np.nanmean/np.nanstd)，每个窗口都要调一次python函数，而且窗口会跨到别的股票上去，
+        现在先按照[股票,日期]排好序，再按照股票分组，用rolling自带的mean/std(Cython实现)，
+        rolling的mean/std本身就忽略nan，min_periods也是只数非nan的个数，和nanmean/nanstd是一样的，
+        注意np.nanstd是总体标准差，所以std要用ddof=0
+        """
+        data = data.sort_values(['code', 'datetime'], kind='stable', ignore_index=True)
+        turnover_rate_by_code = data.groupby('code', sort=False)['turnover_rate']
+
+        # reset_index是去掉分组的code索引，和data的索引对齐
+        def rolling_mean(window):
+            return turnover_rate_by_code.rolling(window=window, min_periods=1).mean().reset_index(level=0, drop=True)
+
+        def rolling_std(window):
+            return turnover_rate_by_code.rolling(window=window, min_periods=2).std(ddof=0).reset_index(level=0, drop=True)
+
         # N个月的日均换手率
-        data['turnover_1m'] = data['turnover_rate'].rolling(window=20, min_periods=1).apply(func=np.nanmean)
-        data['turnover_3m'] = data['turnover_rate'].rolling(window=60, min_periods=1).apply(func=np.nanmean)
-        data['turnover_6m'] = data['turnover_rate'].rolling(window=120, min_periods=1).apply(func=np.nanmean)
-        data['turnover_2y'] = data['turnover_rate'].rolling(window=480, min_periods=1).apply(func=np.nanmean)
+        data['turnover_1m'] = rolling_mean(20)
+        data['turnover_3m'] = rolling_mean(60)
+        data['turnover_6m'] = rolling_mean(120)
+        data['turnover_2y'] = rolling_mean(480)
 
         # N个月的日均换手率的标准差
-        data['turnover_std_1m'] = data['turnover_rate'].rolling(window=20, min_periods=2).apply(func=np.nanstd)
-        data['turnover_std_3m'] = data['turnover_rate'].rolling(window=60, min_periods=2).apply(func=np.nanstd)
-        data['turnover_std_6m'] = data['turnover_rate'].rolling(window=120, min_periods=2).apply(func=np.nanstd)
-        data['turnover_std_2y'] = data['turnover_rate'].rolling(window=480, min_periods=2).apply(func=np.nanstd)
+        data['turnover_std_1m'] = rolling_std(20)
+        data['turnover_std_3m'] = rolling_std(60)
+        data['turnover_std_6m'] = rolling_std(120)
+        data['turnover_std_2y'] = rolling_std(480)
 
         # N个月的日换手率 / 两年内日换手率 - 1，表示N个月流动性的乖离率
         data['turnover_bias_1m'] = data['turnover_1m'] / data['turnover_2y'] - 1
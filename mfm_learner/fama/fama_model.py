@@ -1,15 +1,12 @@
 import logging
 
+import numpy as np
 import pandas as pd
 
-from mfm_learner.utils import utils
-
-utils.init_logger()
-
 from mfm_learner.datasource import datasource_factory, datasource_utils
+from mfm_learner.utils import utils
 
 logger = logging.getLogger(__name__)
-datasource = datasource_factory.get()
 
 
 # %%定义计算函数
@@ -25,26 +22,21 @@ def cal_smb_hml(df):
         SMB = (SL+SM+SH)/3 - (BL+BM+BH)/3
     - HMI：账面市值比，B/M，1/pb (PB是市净率=总市值/净资产)
         HMI = (BH+SH)/2 - (BL+SL)/2
-    """
 
-    # 划分大小市值公司
-    median = df['circ_mv'].median()
-    df['SB'] = df['circ_mv'].map(lambda x: 'B' if x >= median else 'S')
+    这里的df是多天的：[datetime, code, pct_chg, circ_mv, pb]，所有日子一起算，不再按日期循环，
+    返回每天一行：[datetime | SMB, HML, SL, SM, SH, BL, BM, BH]
+    """
+    # 划分大小市值公司，每天的市值中位数
+    median = df.groupby('datetime')['circ_mv'].transform('median')
+    size_label = np.where(df['circ_mv'] >= median, 'B', 'S')
 
     # 求账面市值比：PB的倒数
-    df['BM'] = 1 / df['pb']
-    # 划分高、中、低账面市值比公司
-    border_down, border_up = df['BM'].quantile([0.3, 0.7])
-    df['HML'] = df['BM'].map(lambda x: 'H' if x >= border_up else 'M')
-    df['HML'] = df.apply(lambda row: 'L' if row['BM'] <= border_down else row['HML'], axis=1)
-
-    # 组合划分为6组
-    df_SL = df.query('(SB=="S") & (HML=="L")')
-    df_SM = df.query('(SB=="S") & (HML=="M")')
-    df_SH = df.query('(SB=="S") & (HML=="H")')
-    df_BL = df.query('(SB=="B") & (HML=="L")')
-    df_BM = df.query('(SB=="B") & (HML=="M")')
-    df_BH = df.query('(SB=="B") & (HML=="H")')
+    bm = 1 / df['pb']
+    # 划分高、中、低账面市值比公司，每天的30%、70%分位数
+    borders = bm.groupby(df['datetime']).quantile([0.3, 0.7]).unstack()
+    border_down, border_up = df['datetime'].map(borders[0.3]), df['datetime'].map(borders[0.7])
+    bm_label = np.where(bm >= border_up, 'H', 'M')
+    bm_label = np.where(bm <= border_down, 'L', bm_label)
 
     """
     # 计算各组收益率, pct_chg:涨跌幅 , circ_mv:流通市值（万元）
@@ -53,65 +45,63 @@ def cal_smb_hml(df):
     #    每期，得到的SL是一个数，
     # 除100是因为pct_chg是按照百分比计算的，比如pct_chg=3.5，即3.5%，即0.035
     # 组内按市值赋权平均收益率 = sum(个股收益率 * 个股市值/组内总市值)
+    # 6个组，所有的日子，一次groupby求和就都算出来了
     """
-    R_SL = ((df_SL['pct_chg']/100) * (df_SL['circ_mv']/ df_SL['circ_mv'].sum()) ).sum()  # 这种写法和下面的5种结果一样
-    R_SM = (df_SM['pct_chg'] * df_SM['circ_mv'] / 100).sum() / df_SM['circ_mv'].sum()    # 我只是测试一下是否一致，
-    R_SH = (df_SH['pct_chg'] * df_SH['circ_mv'] / 100).sum() / df_SH['circ_mv'].sum()    # 大约在千分之几，也对，我做的是每日的收益率
-    R_BL = (df_BL['pct_chg'] * df_BL['circ_mv'] / 100).sum() / df_BL['circ_mv'].sum()
-    R_BM = (df_BM['pct_chg'] * df_BM['circ_mv'] / 100).sum() / df_BM['circ_mv'].sum()
-    R_BH = (df_BH['pct_chg'] * df_BH['circ_mv'] / 100).sum() / df_BH['circ_mv'].sum()
+    keys = [df['datetime'], pd.Series(size_label, index=df.index) + pd.Series(bm_label, index=df.index)]
+    weighted_return = (df['pct_chg'] * df['circ_mv'] / 100).groupby(keys).sum()
+    total_mv = df['circ_mv'].groupby(keys).sum()
+    df_returns = (weighted_return / total_mv).unstack().reindex(columns=['SL', 'SM', 'SH', 'BL', 'BM', 'BH'])
 
     # 计算SMB, HML并返回
     # 这个没啥好说的，即使按照Fama造的公式，得到了smb，smb是啥？是当期的一个数
-    smb = (R_SL + R_SM + R_SH - R_BL - R_BM - R_BH) / 3
-    hml = (R_SH + R_BH - R_SL - R_BL) / 2
-    return smb, hml, R_SL, R_SM, R_SH, R_BL, R_BM, R_BH
+    # 这个数是对股票池中的每一个股票都是一样的，它是因子的收益率，可不是因子（也就是因子暴露，简称因子）噢
+    # 每个股票的因子暴露得单独算，用回归来跑，每期，每支股票都有自己的风险暴露的
+    df_returns['SMB'] = (df_returns.SL + df_returns.SM + df_returns.SH - df_returns.BL - df_returns.BM - df_returns.BH) / 3
+    df_returns['HML'] = (df_returns.SH + df_returns.BH - df_returns.SL - df_returns.BL) / 2
+    df_returns.index.name = 'datetime'
+    df_returns.columns.name = None
+    return df_returns[['SMB', 'HML', 'SL', 'SM', 'SH', 'BL', 'BM', 'BH']].reset_index()
+
+
+_cache = {}  # 进程内缓存，{(股票池, 股票数, 开始日期, 结束日期): 结果}，IVFF等因子反复用同样的参数来算
 
 
 def calculate_factors(index_code="000905.SH", stock_num=50, start_date='20190101', end_date='20200801'):
-    # %%计算并存储数据
-    data = []
+    key = (index_code, stock_num, start_date, end_date)
+    if key in _cache:
+        logger.debug("使用缓存的Fama-French因子：%r", key)
+        return _cache[key].copy()
+
+    datasource = datasource_factory.get()
 
     # 获得股票池
-    df_stocks = datasource.index_weight(index_code=index_code, start_date=start_date)
-    logger.debug("获得股票池%d个股票", len(df_stocks))
-    stocks = stocks[:10]
+    stocks = datasource.index_weight(index_code=index_code, start_date=start_date)
+    logger.debug("获得股票池%d个股票", len(stocks))
+    stocks = stocks[:stock_num]
     logger.debug("保留股票池%d个股票分析使用", len(stocks))
 
-    # 获取月线行情
-    df_dailies = datasource.daily(start_date=start_date, end_date=end_date, stock_code=stocks)  # stock_code不能超过50个股票
+    # 获取日线行情
+    df_dailies = datasource.daily(start_date=start_date, end_date=end_date, stock_code=stocks)
 
     # 获取该日期所有股票的基本面指标，里面有市值信息
     df_basics = datasource.daily_basic(start_date=start_date, end_date=end_date, stock_code=stocks)
 
-    # %%开始获取数据
-    for date,df_daily in df_dailies.groupby('datetime'):
-        # logger.debug("获得[%s]日股票交易数据%d条",date,len(df_daily))
-
-        # 过滤出当日的基础数据
-        df_basic = df_basics[df_basics['datetime']==date]
-
-        # 数据融合——只保留两个表中公共部分的信息
-        df = pd.merge(df_daily, df_basic, on=['code','datetime'], how='inner')
-
-        # logger.debug("股票日交易数据与市场数据合并后(按日期[%s])，%d条", date, len(df))
-
-        # 返回的 smb，hml，都是一个数（当期的一个数）
-        # 这个数是对股票池中的每一个股票都是一样的，它是因子的收益率，可不是因子（也就是因子暴露，简称因子）噢
-        # 每个股票的因子暴露得单独算，用回归来跑，每期，每支股票都有自己的风险暴露的
-        smb, hml, sl, sm, sh, bl, bm, bh = cal_smb_hml(df)
-        data.append([date, smb, hml, sl, sm, sh, bl, bm, bh])
-        # logger.debug("计算完[%r] SMB=%.5f, HML=%.5f", date, smb, hml)
+    # 数据融合——只保留两个表中公共部分的信息
+    df = pd.merge(df_dailies[['code', 'datetime', 'pct_chg']],
+                  df_basics[['code', 'datetime', 'circ_mv', 'pb']],
+                  on=['code', 'datetime'],
+                  how='inner')
+    logger.debug("股票日交易数据与市场数据合并后，%d条", len(df))
 
-    # %%保存因子数据
-    df_tfm = pd.DataFrame(data, columns=['datetime', 'SMB', 'HML', 'SL', 'SM', 'SH', 'BL', 'BM', 'BH'])
-    df_tfm.to_excel('data/fama_ff3.xlsx')
+    df_tfm = cal_smb_hml(df)
     df_tfm = datasource_utils.reset_index(df_tfm, date_only=True)
-    return df_tfm
+    _cache[key] = df_tfm
+    return df_tfm.copy()
 
 
-# python -m fama.factor
+# python -m mfm_learner.fama.fama_model
 if __name__ == '__main__':
+    utils.init_logger()
     # index_code="000905.SH"，使用中证500股票池
     calculate_factors(index_code="000905.SH",
                       stock_num=10,
@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import time
@@ -28,6 +29,7 @@ def logging_time(func):
     一个包装器，用于记录函数耗时
     """
 
+    @functools.wraps(func)
     def wrapper_it(*args, **kw):
         start_time = time.time()
         result = func(*args, **kw)
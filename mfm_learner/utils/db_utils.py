@@ -6,8 +6,19 @@ import pandas as pd
 from mfm_learner.utils import utils
 
 EALIEST_DATE = '20080101'  # 最早的数据日期
+BULK_CHUNK_SIZE = 2000  # 批量插入时，一条insert语句最多插入的行数
+PARAM_BUDGET = 20000  # 批量插入时，一条insert语句最多的参数个数(行数x列数)，宽表(如fina_indicator有100多列)就少插几行
 logger = logging.getLogger(__name__)
 
+# 代码、日期字段的类型，指定成VARHCAR原因是要建索引，不能为Text类型
+SQL_DTYPES = {
+    'ts_code': sqlalchemy.types.VARCHAR(length=9),
+    'code': sqlalchemy.types.VARCHAR(length=9),
+    'trade_date': sqlalchemy.types.VARCHAR(length=8),
+    'ann_date': sqlalchemy.types.VARCHAR(length=8),
+    'end_date': sqlalchemy.types.VARCHAR(length=8)
+}
+
 
 def is_table_exist(engine, name):
     return sqlalchemy.inspect(engine).has_table(name)
@@ -38,23 +49,71 @@ def list_to_sql_format(_list):
     return ','.join(data)
 
 
-def create_db_index(engine, table_name, df):
+def get_index_columns(df):
+    """按照列名，猜索引的列：tushare的表是(ts_code,trade_date/ann_date)，因子表是(code,datetime)"""
+    if "ts_code" in df.columns and "ann_date" in df.columns: return ['ts_code', 'ann_date']
+    if "ts_code" in df.columns and "trade_date" in df.columns: return ['ts_code', 'trade_date']
+    if "code" in df.columns and "datetime" in df.columns: return ['code', 'datetime']
+    return None
+
+
+def create_db_index(engine, table_name, df, index_columns=None):
     if is_table_index_exist(engine, table_name): return
 
     # 创建索引，需要单的sql处理
-    index_sql = None
-    if "ts_code" in df.columns and "trade_date" in df.columns:
-        index_sql = "create index {}_code_date on {} (ts_code,trade_date);".format(table_name, table_name)
-    if "ts_code" in df.columns and "ann_date" in df.columns:
-        index_sql = "create index {}_code_date on {} (ts_code,ann_date);".format(table_name, table_name)
-
-    if not index_sql: return
+    if index_columns is None: index_columns = get_index_columns(df)
+    if not index_columns: return
+    index_sql = "create index {}_code_date on {} ({});".format(table_name, table_name, ",".join(index_columns))
 
     start_time = time.time()
-    engine.execute(index_sql)
+    try:
+        engine.execute(index_sql)
+    except sqlalchemy.exc.DBAPIError:
+        # 以前to_sql自动建的表，字符串列是Text类型，建不了索引，要replace重建一次表
+        logger.warning("在表[%s]上创建索引失败，字段可能是Text类型：%s", table_name, index_sql)
+        return
     logger.debug("在表[%s]上创建索引，耗时: %.2f %s", table_name, time.time() - start_time, index_sql)
 
 
+def get_sql_dtypes(df, dtype=None):
+    """
+    建表时每列的类型：代码、日期是VARCHAR（SQL_DTYPES），
+    因子表的datetime列，是日期类型的就是DATETIME，是字符串的（'20200101'）就是VARCHAR(8)，
+    其他的，用pandas默认的（浮点数是DOUBLE），dtype可以再额外指定
+    """
+    dtypes = {c: t for c, t in SQL_DTYPES.items() if c in df.columns}
+    if 'datetime' in df.columns:
+        dtypes['datetime'] = sqlalchemy.types.DateTime() \
+            if pd.api.types.is_datetime64_any_dtype(df['datetime']) else sqlalchemy.types.VARCHAR(length=8)
+    if dtype: dtypes.update(dtype)
+    return dtypes
+
+
+def get_chunk_size(df):
+    """一条insert插入几行：参数个数不超过PARAM_BUDGET，行数不超过BULK_CHUNK_SIZE"""
+    return max(1, min(BULK_CHUNK_SIZE, PARAM_BUDGET // max(1, len(df.columns))))
+
+
+def bulk_to_db(df, table_name, engine, if_exists='append', dtype=None, index_columns=None, chunksize=None):
+    """
+    批量保存dataframe到数据库中：
+    - 表不存在、或者要替换(if_exists='replace')时，先按照get_sql_dtypes的类型建空表，而不是让to_sql去猜（猜出来的字符串是Text，建不了索引）
+    - 每chunksize行(默认按列数算，见get_chunk_size)，拼成一条多行的insert(method='multi')，而不是一行一条insert，快很多
+    - 最后，没有索引的话，建上复合索引(index_columns，默认是(code,datetime)这样的，见get_index_columns)，
+      后面按股票、日期查询时，就不用全表扫描了
+    """
+    start_time = time.time()
+    dtypes = get_sql_dtypes(df, dtype)
+    if if_exists == 'replace' or not is_table_exist(engine, table_name):
+        df.head(0).to_sql(table_name, engine, index=False, if_exists='replace', dtype=dtypes)
+
+    if chunksize is None: chunksize = get_chunk_size(df)
+    df.to_sql(table_name, engine, index=False, if_exists='append', dtype=dtypes, chunksize=chunksize, method='multi')
+    logger.debug("批量导入 [%.2f] 秒, df[%d条]=>db[表%s] ", time.time() - start_time, len(df), table_name)
+
+    create_db_index(engine, table_name, df, index_columns)
+
+
 def get_last_date(table_name,date_column_name, db_engine, where=None):
     """
     如果表存在，就返回关键日期字段中，最后的日期，
@@ -81,6 +140,23 @@ def get_last_date(table_name,date_column_name, db_engine, where=None):
     # logger.debug("数据库中表[%s]的最后日期[%s]为：%s", table_name, date_column_name, latest_date)
     return latest_date
 
+def get_last_dates(table_name, date_column_name, db_engine, code_column_name='ts_code'):
+    """
+    一次查出每只股票（每个代码）的最后日期，{code: 最后日期}，
+    用一个group by，代替每只股票一个select max(...) where ts_code=...，
+    表不存在，返回空的dict
+    """
+    if not is_table_exist(db_engine, table_name):
+        logger.debug("表[%s]在数据库中不存在", table_name)
+        return {}
+
+    df = pd.read_sql('select {0}, max({1}) as last_date from {2} group by {0}'.format(
+        code_column_name, date_column_name, table_name), db_engine)
+    df = df.dropna()
+    logger.debug("查询了表[%s]中%d个代码的最后日期", table_name, len(df))
+    return dict(zip(df[code_column_name], df['last_date']))
+
+
 def get_start_date(table_name,date_column_name, db_engine, where=None):
     """
     比库的最后的日期往后挪一天
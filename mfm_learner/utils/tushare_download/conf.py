@@ -4,4 +4,9 @@ INTERVAL_STEP = 5  # 单位毫秒，2次API调用间的间隔，异常后会倍
 SLEEP_INTERVAL = 60 # 下载发生异常等待retry的时间
 EALIEST_DATE = db_utils.EALIEST_DATE # 最早的数据起始年份，默认是20080101，股改后
 MAX_STOCKS_BATCH = 200 # 对于支持批次的API，做多一个批次提交的股票数
-TODAY_TIMING = 16 # 今天的数据产生的时间点
\ No newline at end of file
+TODAY_TIMING = 16 # 今天的数据产生的时间点
+CALLS_PER_MINUTE = 300 # 并发下载时，每分钟最多调用几次，账号默认是400/分钟，留点余量
+DOWNLOAD_WORKERS = 8 # 并发下载的线程数
+FLUSH_BATCHES = 50 # 批量下载股票时，每下载完多少个批次，写一次库
+SAVE_FORMAT = 'csv' # 下载的数据，另存一份到data/tushare_download下的格式：csv | parquet(压缩的列式存储，小很多) | None(不存)
+DAG_WORKERS = 4 # updator中，最多同时运行几个下载器
@@ -0,0 +1,125 @@
+"""
+按照依赖关系(DAG)，并行地运行一堆任务：
+
+    tasks = {
+        'trade_cal': (func, []),
+        'stock_basic': (func, []),
+        'daily': (func, ['trade_cal', 'stock_basic']),
+        ...
+    }
+
+依赖都跑完了的任务，就可以开始跑了，最多workers个同时跑，
+失败了的任务，依赖它的任务（以及再依赖这些任务的）都不跑了，
+跑完后，打印每个任务的耗时，和关键路径（决定了总耗时的那条依赖链）。
+
+不在tasks里的依赖，当做已经跑完了（比如只跑其中几个任务的时候）。
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+OK, FAILED, SKIPPED = 'ok', 'failed', 'skipped'
+
+
+def topological_sort(tasks):
+    """按照依赖排序，被依赖的在前面，有循环依赖的话，抛ValueError"""
+    deps = {name: set(d for d in task_deps if d in tasks) for name, (_, task_deps) in tasks.items()}
+    result = []
+    while deps:
+        ready = sorted([name for name, task_deps in deps.items() if not task_deps])
+        if not ready: raise ValueError(f"任务有循环依赖：{sorted(deps)}")
+        for name in ready:
+            result.append(name)
+            del deps[name]
+        for task_deps in deps.values():
+            task_deps.difference_update(ready)
+    return result
+
+
+def __run(name, func, begin_time):
+    start_time = time.time() - begin_time
+    logger.info("开始任务[%s]", name)
+    try:
+        func()
+        status = OK
+    except Exception:
+        logger.exception("任务[%s]失败", name)
+        status = FAILED
+    end_time = time.time() - begin_time
+    logger.info("结束任务[%s]，%s，耗时%.1f秒", name, status, end_time - start_time)
+    return start_time, end_time, status
+
+
+def run_dag(tasks, workers):
+    """
+    :param tasks: {任务名: (函数, [依赖的任务名])}
+    :param workers: 最多同时跑几个任务
+    :return: {任务名: (开始秒数, 结束秒数, 状态)}，秒数是相对于开始运行的时间，跳过的任务，秒数为None
+    """
+    topological_sort(tasks)  # 先检查有没有循环依赖
+
+    pending = {name: set(d for d in task_deps if d in tasks) for name, (_, task_deps) in tasks.items()}
+    timings = {}
+    begin_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while True:
+            for name in sorted([name for name, task_deps in pending.items() if not task_deps]):
+                del pending[name]
+                running[executor.submit(__run, name, tasks[name][0], begin_time)] = name
+            if not running: break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name] = future.result()
+                if timings[name][2] != OK: continue
+                for task_deps in pending.values():
+                    task_deps.discard(name)
+
+    # 剩下的，都是依赖的任务失败了的
+    for name in pending:
+        logger.warning("任务[%s]依赖的任务失败了，跳过", name)
+        timings[name] = (None, None, SKIPPED)
+    return timings
+
+
+def critical_path(tasks, timings):
+    """
+    关键路径：成功了的任务中，耗时之和最长的那条依赖链，
+    并行再多，总耗时也不会比它短，要优化总耗时，就得优化这条链上的任务
+    :return: [任务名]，这条链的总秒数
+    """
+    cost, prev = {}, {}
+    for name in topological_sort(tasks):
+        start_time, end_time, status = timings[name]
+        if status != OK: continue
+        deps = [d for d in tasks[name][1] if d in cost]
+        prev[name] = max(deps, key=lambda d: cost[d]) if deps else None
+        cost[name] = end_time - start_time + (cost[prev[name]] if prev[name] else 0)
+    if not cost: return [], 0
+
+    name = max(cost, key=lambda n: cost[n])
+    total, path = cost[name], []
+    while name:
+        path.insert(0, name)
+        name = prev[name]
+    return path, total
+
+
+def report(tasks, timings):
+    logger.info("%-20s %8s %8s  %s", "任务", "开始(秒)", "耗时(秒)", "状态")
+    for name in sorted(timings, key=lambda n: (timings[n][0] is None, timings[n][0] or 0)):
+        start_time, end_time, status = timings[name]
+        if status == SKIPPED:
+            logger.info("%-20s %8s %8s  %s", name, "-", "-", status)
+        else:
+            logger.info("%-20s %8.1f %8.1f  %s", name, start_time, end_time - start_time, status)
+
+    path, seconds = critical_path(tasks, timings)
+    total = max([t[1] for t in timings.values() if t[1] is not None], default=0)
+    serial = sum([t[1] - t[0] for t in timings.values() if t[1] is not None])
+    logger.info("关键路径：%s，%.1f秒", " -> ".join(path), seconds)
+    logger.info("总耗时%.1f秒，一个一个跑的话要%.1f秒", total, serial)
@@ -2,11 +2,12 @@ import logging
 import os.path
 import time
 
-import sqlalchemy
 import tushare
 
 from mfm_learner.utils import utils, CONF, db_utils
-from mfm_learner.utils.tushare_download.conf import INTERVAL_STEP, MAX_RETRY, SLEEP_INTERVAL
+from mfm_learner.utils.tushare_download.conf import INTERVAL_STEP, MAX_RETRY, SLEEP_INTERVAL, CALLS_PER_MINUTE, \
+    DOWNLOAD_WORKERS, SAVE_FORMAT
+from mfm_learner.utils.tushare_download.downloaders.base.rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +25,11 @@ class BaseDownloader():
         logger.debug("注册到Tushare上，token:%s***", token[:10])
         self.retry_count = 0
         self.save_dir = "data/tushare_download"
+        self.save_format = SAVE_FORMAT
         if not os.path.exists(self.save_dir): os.makedirs(self.save_dir)
         self.call_interval = INTERVAL_STEP
+        self.rate_limiter = RateLimiter(CALLS_PER_MINUTE)  # 并发下载时用的限速器
+        self.workers = DOWNLOAD_WORKERS
 
     def get_table_name(self):
         """
@@ -73,6 +77,25 @@ class BaseDownloader():
             self.db_engine,
             where=where)
 
+    def get_start_dates(self, code_column_name='ts_code'):
+        """
+        一次查出每只股票（每个代码）的开始日期（库里最后日期的后一天），
+        :return: {code: 开始日期}，库里没有的代码，用get_code_start_date去取默认的
+        """
+        last_dates = db_utils.get_last_dates(self.get_table_name(),
+                                             self.get_date_column_name(),
+                                             self.db_engine,
+                                             code_column_name)
+        return {code: utils.tomorrow(last_date) for code, last_date in last_dates.items()}
+
+    def get_code_start_date(self, start_dates, codes):
+        """
+        从get_start_dates的结果中，查一个代码、或者一批代码（逗号分隔）的开始日期，
+        一批的话，用其中最早的那个，库里没有的代码，从最早日期开始
+        """
+        default_start_date = utils.tomorrow(db_utils.EALIEST_DATE)
+        return min([start_dates.get(code, default_start_date) for code in codes.split(",")])
+
     def to_db(self, df, if_exists='append'):
         """
         保存dataframe到数据库中，需要处理一下日期字段变为str，而不是text
@@ -81,23 +104,8 @@ class BaseDownloader():
         :return:
         """
 
-        start_time = time.time()
-        dtype_dic = {
-            'ts_code': sqlalchemy.types.VARCHAR(length=9),
-            'trade_date': sqlalchemy.types.VARCHAR(length=8),
-            'ann_date': sqlalchemy.types.VARCHAR(length=8),
-            'end_date': sqlalchemy.types.VARCHAR(length=8)
-        }
-        df.to_sql(self.get_table_name(),
-                  self.db_engine,
-                  index=False,
-                  if_exists=if_exists,
-                  dtype=dtype_dic,
-                  chunksize=1000)
-        logger.debug("导入 [%.2f] 秒, df[%d条]=>db[表%s] ", time.time() - start_time, len(df), self.get_table_name())
-
-        # 保存到数据库中的时候，看看有无索引，如果没有，创建之
-        db_utils.create_db_index(self.db_engine, self.get_table_name(), df)
+        # 批量插入，保存到数据库中的时候，看看有无索引，如果没有，创建之
+        db_utils.bulk_to_db(df, self.get_table_name(), self.db_engine, if_exists=if_exists)
 
     def retry_call(self, func, **kwargs):
         """
@@ -113,7 +121,9 @@ class BaseDownloader():
 
         while self.retry_count < MAX_RETRY:
             try:
+                self.rate_limiter.acquire()  # 多个下载器并行时，共用一个限速器
                 df = func(**kwargs)
+                self.rate_limiter.speed_up()
                 self.retry_count = 0
                 # Tushare Exception: 抱歉，您每分钟最多访问该接口400次，
                 # 权限的具体详情访问：https://tushare.pro/document/1?doc_id=108
@@ -133,13 +143,19 @@ class BaseDownloader():
 
     def save(self, name, df):
         """
-        保存dataframe到默认的文件夹内
+        保存dataframe到默认的文件夹内，格式是self.save_format：
+        csv；parquet（列式存储，压缩过的，文件名的后缀换成.parquet）；None的话，不保存
         :param name:
         :param df:
         :return:
         """
+        if self.save_format is None: return None
 
         file_path = os.path.join(self.save_dir, name)
-        df.to_csv(file_path)
+        if self.save_format == 'parquet':
+            file_path = os.path.splitext(file_path)[0] + ".parquet"
+            df.to_parquet(file_path, index=False)
+        else:
+            df.to_csv(file_path)
         logger.debug("保存到文件：%s中，%d条", file_path, len(df))
         return file_path
@@ -8,9 +8,10 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from mfm_learner.utils import utils
-from mfm_learner.utils.tushare_download.conf import MAX_STOCKS_BATCH, TODAY_TIMING
+from mfm_learner.utils import utils, db_utils
+from mfm_learner.utils.tushare_download.conf import MAX_STOCKS_BATCH, TODAY_TIMING, FLUSH_BATCHES
 from mfm_learner.utils.tushare_download.downloaders.base.base_downloader import BaseDownloader
+from mfm_learner.utils.tushare_download.downloaders.base.download_scheduler import DownloadScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -23,13 +24,14 @@ class BatchStocksDownloader(BaseDownloader):
     """
     用于下载所有的股票，一只一只股票的，
     可以支持1只，
-    也可以支持多只一起批量下载（为了优化），多只时，要算一下到每次下载多少只股票最合适，
-    是按照每年252个交易日来计算的记录数。
+    也可以支持多只一起批量下载（为了优化），多只时，要算一下每个批次放哪些股票最合适，
+    是按照每只股票缺的交易日数（交易日历）来计算的记录数。
     """
 
     def __init__(self):
         super().__init__()
         self.multistocks = True
+        self.flush_batches = FLUSH_BATCHES
 
     def download(self):
         start = time.time()
@@ -46,30 +48,59 @@ class BatchStocksDownloader(BaseDownloader):
         df = pd.read_sql('select * from stock_basic', self.db_engine)
         return df['ts_code']
 
-    def calculate_best_fetch_stock_num(self, start_date, end_date):
+    def get_trade_dates(self, start_date, end_date):
+        """库里trade_cal中，start_date~end_date的交易日（排好序的），没有trade_cal表、或者还没更新到end_date的话，返回None"""
+        if not db_utils.is_table_exist(self.db_engine, 'trade_cal'): return None
+        last_date = db_utils.get_last_date('trade_cal', 'cal_date', self.db_engine)
+        if last_date < end_date:
+            logger.warning("交易日历只到%s，没到%s，按照每年%d个交易日估算", last_date, end_date, TRADE_DAYS_PER_YEAR)
+            return None
+        df = pd.read_sql(f'select cal_date from trade_cal where exchange="SSE" and is_open=1 '
+                         f'and cal_date>="{start_date}" and cal_date<="{end_date}"', self.db_engine)
+        return np.sort(df['cal_date'].values.astype(str))
+
+    def count_trade_days(self, trade_dates, start_dates, end_date):
         """
-        计算最多可以下载多少只股票:
-        4800/一只股票的条数，
-        1只股票条数=天数/365*252
+        每只股票要下载多少天（即多少条）：start_date~end_date的交易日数，
+        没有交易日历的话，按照每年252个交易日估算
+        :param start_dates: [每只股票的开始日期]
         """
-        delta = utils.str2date(end_date) - utils.str2date(start_date)
-        days = delta.days
-        logger.debug("需要下载%d天的数据", days)
+        if trade_dates is not None:
+            return len(trade_dates) - np.searchsorted(trade_dates, np.asarray(start_dates, dtype=str))
+        days = [(utils.str2date(end_date) - utils.str2date(start_date)).days + 1 for start_date in start_dates]
+        return np.array([math.ceil(max(day, 0) * TRADE_DAYS_PER_YEAR / 365) for day in days])
 
-        if days <= 0: return 0
-
-        record_num_per_stock = math.ceil(days * TRADE_DAYS_PER_YEAR / 365)
-
-        stock_num = math.ceil(MAX_RECORDS / record_num_per_stock)
-        stock_num = min(stock_num, MAX_STOCKS_BATCH)  # 2022.6.16, 触发过一个批次2400只的情况，太多了，做一个限制
-        logger.debug("下载优化:共%d天,每只股票%d条,每次下载4800条，所以，可以一次可下载%d只股票", days, record_num_per_stock, stock_num)
-        return stock_num
+    def plan_batches(self, code_start_dates, code_days):
+        """
+        把股票装箱成一个个批次：一个批次从批次中最早的开始日期开始下载，
+        所以一个批次的条数 = 股票数 x 其中最多的天数，不能超过MAX_RECORDS，股票数不能超过MAX_STOCKS_BATCH。
+        按照天数从多到少排好，依次往批次里放，放不下了就开一个新的批次，
+        （批次的条数只由最多的那个决定，排好序后这样顺序地装，批次数是最少的）
+        每只股票的开始日期不一样也没关系，下载回来后，再把每只股票已经有了的日期去掉（__drop_downloaded）
+
+        :param code_start_dates: {股票: 开始日期}
+        :param code_days: {股票: 要下载的天数}
+        :return: [(逗号分隔的股票, 批次的开始日期)]
+        """
+        batches = []
+        codes, batch_days = [], 0
+        for code in sorted(code_days, key=lambda c: (-code_days[c], c)):
+            if len(codes) > 0 and (len(codes) + 1) * batch_days <= MAX_RECORDS and len(codes) < MAX_STOCKS_BATCH:
+                codes.append(code)
+                continue
+            if len(codes) > 0: batches.append((",".join(codes), code_start_dates[codes[0]]))
+            codes, batch_days = [code], code_days[code]
+            if batch_days > MAX_RECORDS:
+                logger.warning("股票[%s]要下载%d条，超过了一次最多下载的%d条", code, batch_days, MAX_RECORDS)
+        if len(codes) > 0: batches.append((",".join(codes), code_start_dates[codes[0]]))
+        return batches
 
     def optimized_batch_download(self, func, stock_codes, multistocks, **kwargs):
         """
         使用优化完的参数，来下载股票，一次可以支持1只或多只，由参数multistocks决定。
 
-        支持多只的时候，需要使用函数calculate_best_fetch_stock_num，计算到底一次下载几只最优
+        先一次查出每只股票的开始日期，按照交易日历，算出每只股票要下载的条数，
+        支持多只的时候，用plan_batches把股票装箱成批次，每个批次尽量装满MAX_RECORDS条
 
         :param func: 调用的tushare的api的函数
         :param multistocks: 是否支持同时取多只股票,原因是pro_bar不支持：https://tushare.pro/document/2?doc_id=109
@@ -82,71 +113,94 @@ class BatchStocksDownloader(BaseDownloader):
             stock_codes = utils.get_stock_codes(self.db_engine)
 
         end_date = utils.date2str(datetime.datetime.now())
-        if multistocks:
-            # 如果是需要多只股票一起下载，去看下库中所有股票的最新日期，粗略估计算是所有的股票的起始日期
-            # 但其实，每只股票下载的时候，还会去找自己的真正最后的更新日期
-            start_date = self.get_start_date()
-            stock_num_once = self.calculate_best_fetch_stock_num(start_date, end_date)
-
-            if stock_num_once ==0:
-                logger.info("[多股票同同时下载] 因为已经是截止到今天的数据了，无需下载")
-                stock_codes=[]
-            else:
-                stock_codes = np.array_split(stock_codes, math.ceil(len(stock_codes) / stock_num_once))  # 定义几组
-                stock_codes = [",".join(stocks) for stocks in stock_codes]
-                logger.debug("支持多股票下载，下载 %s~%s 的%d只股票，粗略估算：共%d个批次，每批次%d只股票同时获取",
-                         start_date,
-                         end_date,
-                         len(stock_codes),
-                         len(stock_codes),
-                         stock_num_once)
 
-        logger.debug("调用[%s]，共%d个批次，下载间隔%.0f毫秒",
-                     self.get_table_name(),
-                     len(stock_codes),
-                     self.call_interval)
-        df_all = []
-        pbar = tqdm(total=len(stock_codes))
-        for i, ts_code in enumerate(stock_codes):
-
-            start_date = self.get_start_date(where=f"ts_code='{ts_code}'")
+        # 每只股票从哪天开始下载（一次查出所有股票的最后日期）
+        start_dates = self.get_start_dates()
+        code_start_dates = {}
+        for ts_code in stock_codes:
+            start_date = self.get_code_start_date(start_dates, ts_code)
 
-            if not self.__need_download(ts_code,start_date):
-                logger.debug("股票[%s]已经是最新数据，无需下载")
+            if not self.__need_download(ts_code, start_date):
+                logger.debug("股票[%s]已经是最新数据，无需下载", ts_code)
                 continue
 
             if start_date > end_date:
-                logger.warning("股票[%s] 开始日期%s > 结束日期%s，无需下载", ts_code, start_date, end_date)
-                return
-
-            df = self.retry_call(func=func,
-                                 ts_code=ts_code,
-                                 start_date=start_date,
-                                 end_date=end_date,
-                                 **kwargs)
-            if len(df) == 0:
-                logger.warning("股票[%s] %s~%s 下载条数为0", ts_code,start_date,end_date)
+                logger.debug("股票[%s] 开始日期%s > 结束日期%s，无需下载", ts_code, start_date, end_date)
                 continue
-            if i % 100 == 0:
-                logger.debug("下载进度：%d/%d", i, len(stock_codes))
-            df_all.append(df)
-            pbar.update(1)
-        pbar.close()
 
-        if len(df_all)>0:
-            df_all = pd.concat(df_all)
+            code_start_dates[ts_code] = start_date
 
-            csv_file_name = "{}_{}_{}.csv".format(self.get_table_name(), start_date, end_date)
-            self.save(df=df_all, name=csv_file_name)
+        # 每只股票要下载多少个交易日，没有新的交易日的（比如周末），不用下载
+        trade_dates = self.get_trade_dates(min(code_start_dates.values(), default=end_date), end_date)
+        days = self.count_trade_days(trade_dates, list(code_start_dates.values()), end_date)
+        code_days = {code: day for code, day in zip(code_start_dates, days) if day > 0}
+        logger.debug("%d只股票中，%d只需要下载，共约%d条", len(stock_codes), len(code_days), sum(code_days.values()))
 
-            logger.debug("下载了 %s~%s, %d只股票的%d条数据=>%s, %.2f秒",
-                         start_date,
+        if multistocks:
+            batches = self.plan_batches(code_start_dates, code_days)
+            logger.debug("支持多股票下载，下载 %s~%s 的%d只股票，装箱成%d个批次",
+                         min(code_start_dates.values(), default=end_date),
                          end_date,
-                         len(stock_codes),
-                         len(df_all),
-                         csv_file_name,
-                         time.time() - start_time)
-            self.to_db(df_all)
+                         len(code_days),
+                         len(batches))
+        else:
+            batches = [(code, code_start_dates[code]) for code in code_days]
+
+        tasks = [dict(ts_code=codes, start_date=start_date, end_date=end_date, **kwargs)
+                 for codes, start_date in batches]
+
+        logger.debug("调用[%s]，共%d个批次，%d个线程并发下载，每分钟最多%.0f次",
+                     self.get_table_name(),
+                     len(tasks),
+                     self.workers,
+                     self.rate_limiter.rate * 60)
+        """
+        流式的下载、入库：每下载完flush_batches个批次，就写一次库（另存一份文件），不会把整张表都攒在内存里，
+        每次写库，写的都是一只只股票完整的数据（一个事务），库里每只股票的最后日期，就是它的下载进度(checkpoint)，
+        中途挂了，重新运行时，get_start_dates会从每只股票自己的最后日期，接着往后下载
+        """
+        scheduler = DownloadScheduler(self.rate_limiter, self.workers)
+        df_buffer = []
+        row_num = part = 0
+        pbar = tqdm(total=len(tasks))
+        for i, (task, df) in enumerate(scheduler.run(func, tasks)):
+            pbar.update(1)
+            if i % 100 == 0:
+                logger.debug("下载进度：%d/%d", i, len(tasks))
+            if df is None or len(df) == 0:
+                logger.warning("股票[%s] %s~%s 下载条数为0", task['ts_code'], task['start_date'], end_date)
+                continue
+            if multistocks: df = self.__drop_downloaded(df, code_start_dates)
+            df_buffer.append(df)
+            if len(df_buffer) >= self.flush_batches:
+                row_num += self.flush(df_buffer, tasks, end_date, part)
+                df_buffer, part = [], part + 1
+        if len(df_buffer) > 0:
+            row_num += self.flush(df_buffer, tasks, end_date, part)
+        pbar.close()
+
+        logger.debug("下载了 %s~%s, %d只股票的%d条数据，分%d次入库, %.2f秒",
+                     min([task['start_date'] for task in tasks], default=end_date),
+                     end_date,
+                     len(stock_codes),
+                     row_num,
+                     part + 1 if len(df_buffer) > 0 else part,
+                     time.time() - start_time)
+
+    def flush(self, df_buffer, tasks, end_date, part):
+        """把攒下的几个批次的数据，另存一份文件，再写到库里"""
+        df = pd.concat(df_buffer)
+        start_date = min([task['start_date'] for task in tasks])
+        file_name = "{}_{}_{}_{}.csv".format(self.get_table_name(), start_date, end_date, part)
+        self.save(df=df, name=file_name)
+        self.to_db(df)
+        logger.debug("第%d次入库：%d个批次，%d条数据", part + 1, len(df_buffer), len(df))
+        return len(df)
+
+    def __drop_downloaded(self, df, code_start_dates):
+        """一个批次是从其中最早的开始日期下载的，其他股票在自己开始日期之前的，库里已经有了，去掉"""
+        date_column_name = self.get_date_column_name()
+        return df[df[date_column_name] >= df['ts_code'].map(code_start_dates)]
 
     def __need_download(self, code, start_date):
         if utils.today() == start_date and datetime.datetime.now().time() < datetime.time(TODAY_TIMING, 00):
@@ -23,9 +23,10 @@ class CodeDateDownloader(BaseDownloader):
     def download(self):
         start = time.time()
         df_all = []
+        start_dates = self.get_start_dates()
         for code in self.codes:
-            # 这里需要增加一个where条件，逐个code来下载，这样做的原因是因为可能会后续追加其他code
-            start_date = self.get_start_date(where=f"ts_code='{code}'")
+            # 这里需要逐个code来取开始日期，这样做的原因是因为可能会后续追加其他code
+            start_date = self.get_code_start_date(start_dates, code)
             end_date = utils.date2str(datetime.datetime.now())
 
             df = self.retry_call(func=self.get_func(),
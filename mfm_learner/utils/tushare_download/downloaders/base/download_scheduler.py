@@ -0,0 +1,59 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from mfm_learner.utils.tushare_download.conf import MAX_RETRY, SLEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadScheduler():
+    """
+    并发下载：workers个线程同时调用tushare，都从同一个限速器(RateLimiter)取令牌，
+    这样，调用的速度是配额允许的最快速度，而不是一个一个的调用、每次再sleep一下，
+    （tushare的耗时主要在网络等待上，所以用线程就够了）
+
+    下载完一个，就返回(yield)一个，交给调用者去保存，
+    正在下载、还没被取走的，最多workers*2个，不会把所有的结果都攒在内存里。
+    """
+
+    def __init__(self, rate_limiter, workers, retry_sleep=SLEEP_INTERVAL):
+        self.rate_limiter = rate_limiter
+        self.workers = workers
+        self.retry_sleep = retry_sleep
+
+    def call(self, func, **kwargs):
+        """调用一次，出异常（一般是超过了每分钟的次数）的话，限速器降速，等一会儿再试，最多试MAX_RETRY次，成功了，限速器慢慢提速"""
+        for i in range(MAX_RETRY):
+            self.rate_limiter.acquire()
+            try:
+                df = func(**kwargs)
+                self.rate_limiter.speed_up()
+                return df
+            except Exception:
+                logger.exception("调用Tushare函数[%s]失败(第%d次):%r", str(func), i + 1, kwargs)
+                self.rate_limiter.slow_down()
+                time.sleep(self.retry_sleep)
+        raise RuntimeError("尝试调用Tushare API多次失败......")
+
+    def run(self, func, tasks):
+        """
+        :param func: tushare的api函数
+        :param tasks: 每次调用的参数，[{ts_code:..., start_date:..., end_date:...}, ...]
+        :return: 生成器，按照完成的顺序，返回 (参数, 下载的dataframe)
+        """
+        tasks = iter(tasks)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        running = {}
+        try:
+            while True:
+                for kwargs in tasks:
+                    running[executor.submit(self.call, func, **kwargs)] = kwargs
+                    if len(running) >= self.workers * 2: break
+                if len(running) == 0: return
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield running.pop(future), future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter():
+    """
+    令牌桶限速：tushare是按照每分钟的次数限制的（200元/年的账号是400次/分钟），
+    桶里每秒补充 calls_per_minute/60 个令牌，最多存burst个，每次调用前取一个令牌，没有就等，
+    多个线程共用一个，总的调用速度就不会超过每分钟的配额。
+
+    被限制了就降一半的速度(slow_down)，之后每连续成功recover_calls次，就加回配额的1/10(speed_up)，
+    直到恢复到配置的calls_per_minute，不然，偶尔被限制一次，后面就一直是慢速了。
+    """
+
+    def __init__(self, calls_per_minute, burst=1, cooldown=1, recover_calls=20, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param burst: 桶里最多存几个令牌，即最多可以连着调用几次
+        :param cooldown: 降速后的cooldown秒内，别的线程同时失败的，算同一次，不再降速
+        :param recover_calls: 降速后，连续成功多少次，提一次速
+        :param clock, sleep: 取当前时间(秒)、等待的函数，测试的时候可以换成假的时钟
+        """
+        self.max_rate = calls_per_minute / 60
+        self.rate = self.max_rate  # 每秒几次
+        self.recover_calls = recover_calls
+        self.successes = 0
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.last_time = clock()
+        self.cooldown = cooldown
+        self.slow_down_time = None
+        self.lock = threading.Lock()
+
+    def __refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def acquire(self):
+        """取一个令牌，没有的话，就等到有为止"""
+        while True:
+            with self.lock:
+                self.__refill()
+                if self.tokens >= 1 - 1e-9:  # 浮点误差，等了(1-tokens)/rate秒后，可能还差一点点
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def slow_down(self):
+        """被tushare限制了，降一半的速度"""
+        with self.lock:
+            now = self.clock()
+            if self.slow_down_time is not None and now - self.slow_down_time < self.cooldown: return
+            self.slow_down_time = now
+            self.__refill()
+            self.rate /= 2
+            self.successes = 0
+        logger.warning("调用被限制，降速到每分钟%.0f次", self.rate * 60)
+
+    def speed_up(self):
+        """调用成功了，连续成功了recover_calls次，就加一点速度，最多到配置的速度"""
+        with self.lock:
+            if self.rate >= self.max_rate: return
+            self.successes += 1
+            if self.successes < self.recover_calls: return
+            self.successes = 0
+            self.__refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        logger.info("连续调用成功，提速到每分钟%.0f次", self.rate * 60)
@@ -23,10 +23,11 @@ class IndexWeight(PeriodlyDownloader):
 
     def download(self):
         df_all = []
+        start_dates = self.get_start_dates(code_column_name='index_code')
 
         for index_code in self.index_codes:
-            # 这里需要增加一个where条件，逐个指数来下载，这样做的原因是因为可能会后续追加其他指数
-            start_date = self.get_start_date(where=f"index_code='{index_code}'")
+            # 这里需要逐个指数来取开始日期，这样做的原因是因为可能会后续追加其他指数
+            start_date = self.get_code_start_date(start_dates, index_code)
             end_date = utils.date2str(datetime.datetime.now())
 
             # 不行，年还是范围太大，我观察，1那年有5000+，所以还是超级录了，改为每月
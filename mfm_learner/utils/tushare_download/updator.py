@@ -22,51 +22,94 @@ from mfm_learner.utils.tushare_download.downloaders.stk_holdernumber import Stoc
 from mfm_learner.utils.tushare_download.downloaders.stock_basic import StockBasic
 from mfm_learner.utils.tushare_download.downloaders.stock_company import StockCompany
 from mfm_learner.utils.tushare_download.downloaders.trade_cal import TradeCalendar
-import time, datetime, logging
+import argparse
+import datetime
+import logging
+import time
+
+from mfm_learner.utils.tushare_download import dag_runner
+from mfm_learner.utils.tushare_download.conf import CALLS_PER_MINUTE, DAG_WORKERS
+from mfm_learner.utils.tushare_download.downloaders.base.rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+INDEX_CODES = ["000001.SH", "000905.SH", "000300.SH", "000016.SH"]
+
+# ctazoo用到的数据
+CTAZOO_TASKS = ['trade_cal', 'stock_company', 'stock_basic', 'daily', 'daily_hfq', 'daily_basic', 'moneyflow',
+                'index_daily']
 
-def main():
+
+def create_tasks(names=None):
     """
-    仅下载ctazoo用到的数据
-    :return:
+    所有的下载任务，和它们的依赖：
+    按股票下载的，要先有stock_basic（股票列表）和trade_cal（交易日历，算每只股票缺几天），
+    其他的（指数、按月下载的）互相都不依赖，
+    所有下载器共用一个限速器，并行下载时，总的调用次数也不会超过每分钟的配额
+    :param names: 只下载其中的这几个，None是所有的
+    :return: {任务名: (函数, [依赖的任务名])}
     """
-
-    TradeCalendar().download()
-    StockCompany().download()
-    StockBasic().download()
-    Daily().download()
-    DailyHFQ().download()
-    DailyBasic().download()
-    MoneyFlow().download()
-    IndexDaily(["000001.SH", "000905.SH", "000300.SH", "000016.SH"]).download()
+    stock_deps = ['trade_cal', 'stock_basic']
+    downloaders = {
+        'trade_cal': (TradeCalendar, [], []),
+        'stock_basic': (StockBasic, [], []),
+        'stock_company': (StockCompany, [], []),
+        'daily': (Daily, [], stock_deps),
+        'daily_hfq': (DailyHFQ, [], stock_deps),
+        'daily_basic': (DailyBasic, [], stock_deps),
+        'moneyflow': (MoneyFlow, [], stock_deps),
+        'fina_indicator': (FinanceIndicator, [], stock_deps),
+        'balancesheet': (BalanceSheet, [], stock_deps),
+        'income': (Income, [], stock_deps),
+        'cashflow': (CashFlow, [], stock_deps),
+        'stk_holdernumber': (StockHolderNumber, [], stock_deps),
+        'index_daily': (IndexDaily, [INDEX_CODES], []),
+        'index_weekly': (IndexWeekly, [INDEX_CODES], []),
+        'index_weight': (IndexWeight, [INDEX_CODES], []),
+        'limit_list': (LimitList, [], [])
+    }
+    if names is None: names = list(downloaders.keys())
+
+    rate_limiter = RateLimiter(CALLS_PER_MINUTE)
+    tasks = {}
+    for name in names:
+        clazz, args, deps = downloaders[name]
+        downloader = clazz(*args)  # 在主线程里创建好，注册tushare的token等，不在多个线程里同时做
+        downloader.rate_limiter = rate_limiter
+        tasks[name] = (downloader.download, deps)
+    return tasks
+
+
+def download(names=None, workers=DAG_WORKERS):
+    start = time.time()
+    tasks = create_tasks(names)
+    timings = dag_runner.run_dag(tasks, workers)
+    dag_runner.report(tasks, timings)
+    logger.debug("下载%d类数据，共耗时: %s ", len(tasks), str(datetime.timedelta(seconds=time.time() - start)))
+    return timings
 
 
-def download_all():
+def main(workers=DAG_WORKERS):
     """
-    下载全量数据
+    仅下载ctazoo用到的数据
     :return:
     """
+    return download(CTAZOO_TASKS, workers)
 
-    start = time.time()
-
-    main()
 
-    FinanceIndicator().download()
-    IndexWeight(["000001.SH", "000905.SH", "000300.SH", "000016.SH"]).download()
-    BalanceSheet().download()
-    Income().download()
-    CashFlow().download()
-    BalanceSheet().download()
-    IndexWeekly(["000001.SH", "000905.SH", "000300.SH", "000016.SH"]).download()
-    StockHolderNumber().download()
-    LimitList().download()
-
-    logger.debug("下载所有的最新数据，共耗时: %s ", str(datetime.timedelta(seconds=time.time() - start)))
+def download_all(workers=DAG_WORKERS):
+    """
+    下载全量数据，按照依赖关系，workers个下载器同时下载
+    :return:
+    """
+    return download(None, workers)
 
 
-# python -m mfm_learner.utils.tushare_download.updator
+# python -m mfm_learner.utils.tushare_download.updator --workers 4
 if __name__ == '__main__':
     utils.init_logger()
-    download_all()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=DAG_WORKERS, help="同时下载的下载器数")
+    args, _ = parser.parse_known_args()  # 其他的参数（如--code），是给下载器用的
+    download_all(args.workers)
@@ -0,0 +1,59 @@
+"""
+本地假的tushare pro接口，测试下载用，不用真的去连tushare：
+- 按照工作日造日线数据，每只股票每天一行
+- 和tushare一样，一次最多返回5000行，多只股票用逗号分隔
+- 有每分钟（window秒）调用次数的限制，超了就抛异常，和tushare的报错一样
+- 每次调用有latency秒的网络延时
+- 记录同时在调用的最大个数(max_running)，看看是不是真的并发了
+"""
+import threading
+import time
+
+import pandas as pd
+
+
+class FakeTushare():
+
+    def __init__(self, calls_per_minute=400, latency=0.05, window=60, max_rows=5000):
+        self.calls_per_minute = calls_per_minute
+        self.latency = latency
+        self.window = window
+        self.max_rows = max_rows
+        self.call_times = []  # 最近window秒内的调用时间
+        self.calls = []  # 所有成功的调用的参数
+        self.errors = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __check_quota(self):
+        with self.lock:
+            now = time.monotonic()
+            self.call_times = [t for t in self.call_times if now - t < self.window]
+            if len(self.call_times) >= self.calls_per_minute:
+                self.errors += 1
+                raise Exception(f"抱歉，您每分钟最多访问该接口{self.calls_per_minute}次，"
+                                f"权限的具体详情访问：https://tushare.pro/document/1?doc_id=108")
+            self.call_times.append(now)
+
+    def daily(self, ts_code, start_date, end_date, **kwargs):
+        self.__check_quota()
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.latency)
+        with self.lock:
+            self.running -= 1
+            self.calls.append(dict(ts_code=ts_code, start_date=start_date, end_date=end_date, **kwargs))
+
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')[::-1]  # tushare是日期倒序的
+        codes = ts_code.split(",")
+        df = pd.DataFrame({'ts_code': [c for d in dates for c in codes],
+                           'trade_date': [d for d in dates for _ in codes]})
+        df['close'] = 10.0
+        return df.head(self.max_rows)
+
+    # pro_bar、daily_basic等，都是一样的数据
+    pro_bar = daily
+    daily_basic = daily
+    moneyflow = daily
@@ -0,0 +1,219 @@
+# pytest test/unitest/test_batch_stocks_downloader.py -s
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from mfm_learner.utils import utils
+from mfm_learner.utils.tushare_download.downloaders.base.batch_stocks_downloader import BatchStocksDownloader
+from mfm_learner.utils.tushare_download.downloaders.base.download_scheduler import DownloadScheduler
+from mfm_learner.utils.tushare_download.downloaders.base.rate_limiter import RateLimiter
+from test.unitest.fake_tushare import FakeTushare
+
+CODES = [f'{600000 + i}.SH' for i in range(40)]
+
+
+class MockDownloader(BatchStocksDownloader):
+    """不连tushare，用FakeTushare，数据库用sqlite"""
+
+    def __init__(self, tmp_path, pro, calls_per_minute, workers):
+        self.db_engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+        self.pro = pro
+        self.save_dir = str(tmp_path)
+        self.save_format = 'csv'
+        self.flush_batches = 10
+        self.call_interval = 0
+        self.rate_limiter = RateLimiter(calls_per_minute)
+        self.workers = workers
+        self.multistocks = False
+
+    def get_table_name(self):
+        return "daily"
+
+    def get_date_column_name(self):
+        return "trade_date"
+
+
+class FakeClock():
+    """假的时钟，sleep就是把时间往后拨，不真的等"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    limiter = RateLimiter(calls_per_minute=60 * 50, clock=clock.time, sleep=clock.sleep)  # 每秒50次
+    for _ in range(26):
+        limiter.acquire()
+    assert len(clock.sleeps) == 25  # 第1次不用等，后面每次等一个令牌
+    assert np.allclose(clock.sleeps, 0.02)
+    assert np.isclose(clock.now, 0.5)
+
+    # 空闲了很久，桶里最多也只有burst个令牌
+    clock.now += 10
+    limiter.acquire()
+    limiter.acquire()
+    assert len(clock.sleeps) == 26
+
+
+def test_rate_limiter_recover():
+    """被限制了降速，之后连续成功，慢慢恢复到配置的速度，不会超过"""
+    limiter = RateLimiter(calls_per_minute=600, cooldown=0, recover_calls=5)
+    limiter.slow_down()
+    limiter.slow_down()
+    assert limiter.rate * 60 == 150
+    for _ in range(4): limiter.speed_up()
+    assert limiter.rate * 60 == 150  # 还不够5次
+    limiter.speed_up()
+    assert limiter.rate * 60 == 210  # 加回配额的1/10
+    for _ in range(100): limiter.speed_up()
+    assert limiter.rate * 60 == 600
+
+    limiter.slow_down()
+    for _ in range(4): limiter.speed_up()
+    limiter.slow_down()  # 又被限制了，重新计数
+    for _ in range(4): limiter.speed_up()
+    assert limiter.rate * 60 == 150
+
+
+def test_scheduler_concurrent():
+    """并发调用，按完成的顺序返回，每个调用都有"""
+    pro = FakeTushare(latency=0.1)
+    scheduler = DownloadScheduler(RateLimiter(calls_per_minute=60 * 1000), workers=10)
+    tasks = [dict(ts_code=code, start_date='20220103', end_date='20220107') for code in CODES]
+
+    results = list(scheduler.run(pro.daily, tasks))
+
+    assert 1 < pro.max_running <= 10  # 真的是同时在调用，但不超过workers个
+    assert sorted([task['ts_code'] for task, _ in results]) == CODES
+    assert all([(df.ts_code == task['ts_code']).all() and len(df) == 5 for task, df in results])
+
+
+def test_scheduler_retry_when_over_quota():
+    """限速比配额快，被tushare限制了，降速后重试，数据一条不少"""
+    pro = FakeTushare(calls_per_minute=10, latency=0, window=0.5)  # 每0.5秒最多10次
+    scheduler = DownloadScheduler(RateLimiter(calls_per_minute=60 * 40, burst=10), workers=4,
+                                  retry_sleep=0.1)
+    tasks = [dict(ts_code=code, start_date='20220103', end_date='20220107') for code in CODES]
+    results = list(scheduler.run(pro.daily, tasks))
+    assert pro.errors > 0
+    assert len(results) == len(CODES) and len(pro.calls) == len(CODES)
+
+
+def test_optimized_batch_download(tmp_path):
+    pro = FakeTushare(calls_per_minute=25, latency=0.05, window=1)  # 每秒最多25次
+    downloader = MockDownloader(tmp_path, pro, calls_per_minute=60 * 20, workers=8)
+    # 库里已经有了20个交易日之前的数据
+    last_date = (pd.Timestamp.now() - pd.offsets.BDay(20)).strftime('%Y%m%d')
+    df = pd.DataFrame({'ts_code': CODES, 'trade_date': last_date, 'close': 10.0})
+    downloader.to_db(df, if_exists='replace')
+
+    downloader.optimized_batch_download(func=pro.daily, stock_codes=CODES, multistocks=False)
+
+    assert pro.errors == 0  # 没有超过配额
+    assert sorted([call['ts_code'] for call in pro.calls]) == CODES
+    assert all([call['start_date'] == utils.tomorrow(last_date) for call in pro.calls])
+    df_db = pd.read_sql('select * from daily', downloader.db_engine)
+    assert df_db.groupby('ts_code').trade_date.min().eq(last_date).all()
+    assert not df_db.duplicated(['ts_code', 'trade_date']).any()
+    assert len(df_db) == len(CODES) * len(pd.date_range(last_date, pd.Timestamp.now(), freq='B'))
+
+
+def test_watermarks(tmp_path):
+    """每只股票的最后日期不一样，只查一次库，每只（每批）股票从自己的最后日期往后下载"""
+    pro = FakeTushare(latency=0)
+    downloader = MockDownloader(tmp_path, pro, calls_per_minute=60 * 1000, workers=4)
+    last_dates = [(pd.Timestamp.now() - pd.offsets.BDay(i % 5 + 1)).strftime('%Y%m%d') for i in range(len(CODES))]
+    downloader.to_db(pd.DataFrame({'ts_code': CODES, 'trade_date': last_dates, 'close': 10.0}), if_exists='replace')
+
+    # 多只股票一批的，从这批中最早的开始，库里没有的股票，从最早日期开始
+    start_dates = downloader.get_start_dates()
+    assert downloader.get_code_start_date(start_dates, ",".join(CODES[:5])) == utils.tomorrow(min(last_dates[:5]))
+    assert downloader.get_code_start_date(start_dates, CODES[0] + ",000001.SZ") == '20080102'
+
+    sqls = []
+    sqlalchemy.event.listen(downloader.db_engine, "before_cursor_execute",
+                            lambda conn, cursor, statement, *args: sqls.append(statement))
+    downloader.optimized_batch_download(func=pro.daily, stock_codes=CODES, multistocks=False)
+    assert len([sql for sql in sqls if sql.startswith('select') and 'max(trade_date)' in sql]) == 1
+    assert {call['ts_code']: call['start_date'] for call in pro.calls} == \
+           {code: utils.tomorrow(last_date) for code, last_date in zip(CODES, last_dates)}
+
+
+class Crash(BaseException):
+    """模拟下载到一半，进程挂了"""
+
+
+def test_streaming_resume(tmp_path):
+    """每10个批次入库一次，中途挂了，重新运行，从每只股票自己的进度接着下载"""
+    pro = FakeTushare(latency=0)
+    downloader = MockDownloader(tmp_path, pro, calls_per_minute=60 * 1000, workers=1)
+    downloader.save_format = 'parquet'
+    last_date = (pd.Timestamp.now() - pd.offsets.BDay(10)).strftime('%Y%m%d')
+    downloader.to_db(pd.DataFrame({'ts_code': CODES, 'trade_date': last_date, 'close': 10.0}), if_exists='replace')
+
+    def crash_daily(**kwargs):
+        if len(pro.calls) == 25: raise Crash()
+        return pro.daily(**kwargs)
+
+    with pytest.raises(Crash):
+        downloader.optimized_batch_download(func=crash_daily, stock_codes=CODES, multistocks=False)
+    df_db = pd.read_sql('select * from daily', downloader.db_engine)
+    assert (df_db.groupby('ts_code').trade_date.max() > last_date).sum() == 20  # 入库了2次，20只股票
+    assert len(glob.glob(os.path.join(tmp_path, "daily_*.parquet"))) == 2
+
+    pro.calls.clear()
+    downloader.optimized_batch_download(func=pro.daily, stock_codes=CODES, multistocks=False)
+    # 只有没入库的20只，是从原来的日期开始下载的
+    assert len([call for call in pro.calls if call['start_date'] == utils.tomorrow(last_date)]) == 20
+    df_db = pd.read_sql('select * from daily', downloader.db_engine)
+    assert not df_db.duplicated(['ts_code', 'trade_date']).any()
+    assert len(df_db) == len(CODES) * len(pd.date_range(last_date, pd.Timestamp.now(), freq='B'))
+
+
+def test_plan_batches(tmp_path):
+    """按照每只股票缺的交易日装箱，每个批次不超过MAX_RECORDS条"""
+    downloader = MockDownloader(tmp_path, FakeTushare(), calls_per_minute=60 * 1000, workers=1)
+    code_days = {code: 200 if i < 10 else 10 for i, code in enumerate(CODES)}
+    code_start_dates = {code: '20200101' if days == 200 else '20201001' for code, days in code_days.items()}
+    batches = downloader.plan_batches(code_start_dates, code_days)
+    # 10只缺200天的，和14只缺10天的一批(24x200=4800)，剩下16只一批
+    assert [(len(codes.split(",")), start_date) for codes, start_date in batches] == [(24, '20200101'), (16, '20201001')]
+    assert sorted(",".join([codes for codes, _ in batches]).split(",")) == CODES
+
+
+def test_multistocks_download(tmp_path):
+    """多只股票一起下载：按交易日历装箱，每次都不超过MAX_RECORDS，也没有重复的数据"""
+    pro = FakeTushare(latency=0)
+    downloader = MockDownloader(tmp_path, pro, calls_per_minute=60 * 1000, workers=2)
+    dates = pd.date_range(pd.Timestamp.now() - pd.offsets.BDay(300), pd.Timestamp.now() + pd.offsets.BDay(30))
+    df_cal = pd.DataFrame({'exchange': 'SSE', 'cal_date': dates.strftime('%Y%m%d'), 'is_open': dates.weekday < 5})
+    df_cal['is_open'] = df_cal['is_open'].astype(int)
+    df_cal.to_sql('trade_cal', downloader.db_engine, index=False)
+
+    last_dates = [(pd.Timestamp.now() - pd.offsets.BDay(200 if i < 10 else 10)).strftime('%Y%m%d')
+                  for i in range(len(CODES))]
+    downloader.to_db(pd.DataFrame({'ts_code': CODES, 'trade_date': last_dates, 'close': 10.0}), if_exists='replace')
+
+    downloader.optimized_batch_download(func=pro.daily, stock_codes=CODES, multistocks=True)
+    assert len(pro.calls) == 2
+    df_db = pd.read_sql('select * from daily', downloader.db_engine)
+    assert not df_db.duplicated(['ts_code', 'trade_date']).any()
+    expected = sum([len(pd.date_range(last_date, pd.Timestamp.now(), freq='B')) for last_date in last_dates])
+    assert len(df_db) == expected
+
+    # 周末、或者已经是最新的了，不用再调用
+    pro.calls.clear()
+    downloader.optimized_batch_download(func=pro.daily, stock_codes=CODES, multistocks=True)
+    assert len(pro.calls) == 0
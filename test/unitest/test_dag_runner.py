@@ -0,0 +1,91 @@
+# pytest test/unitest/test_dag_runner.py -s
+import threading
+import time
+
+import pytest
+
+from mfm_learner.utils.tushare_download import dag_runner
+
+
+def __sleep(seconds, fail=False):
+    def func():
+        time.sleep(seconds)
+        if fail: raise RuntimeError("下载失败")
+
+    return func
+
+
+def test_run_dag():
+    """依赖的跑完了才跑，互不依赖的同时跑"""
+    events = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(3, timeout=10)  # 3个互不依赖的任务，同时在跑，才都能过去，否则超时失败
+
+    def task(name, wait=False):
+        def func():
+            with lock: events.append(('start', name))
+            if wait: barrier.wait()
+            with lock: events.append(('end', name))
+
+        return func
+
+    tasks = {
+        'trade_cal': (task('trade_cal', wait=True), []),
+        'stock_basic': (task('stock_basic', wait=True), []),
+        'index_daily': (task('index_daily', wait=True), []),
+        'daily': (task('daily'), ['trade_cal', 'stock_basic']),
+        'daily_basic': (task('daily_basic'), ['trade_cal', 'stock_basic']),
+        'not_exist_dep': (task('not_exist_dep'), ['not_in_tasks'])
+    }
+    timings = dag_runner.run_dag(tasks, workers=4)
+
+    assert all([status == dag_runner.OK for _, _, status in timings.values()])
+    for name, (_, deps) in tasks.items():
+        for dep in deps:
+            if dep in tasks: assert events.index(('start', name)) > events.index(('end', dep))
+    dag_runner.report(tasks, timings)
+
+
+def test_critical_path():
+    """关键路径，用假的耗时算"""
+    tasks = {
+        'trade_cal': (None, []),
+        'stock_basic': (None, []),
+        'daily': (None, ['trade_cal', 'stock_basic']),
+        'daily_basic': (None, ['trade_cal', 'stock_basic']),
+        'index_daily': (None, [])
+    }
+    timings = {
+        'trade_cal': (0, 1, dag_runner.OK),
+        'stock_basic': (0, 2, dag_runner.OK),
+        'daily': (2, 5, dag_runner.OK),
+        'daily_basic': (2, 4, dag_runner.OK),
+        'index_daily': (0, 3, dag_runner.OK)
+    }
+    assert dag_runner.critical_path(tasks, timings) == (['stock_basic', 'daily'], 5)
+
+    # 失败的任务不算
+    timings['daily'] = (2, 5, dag_runner.FAILED)
+    assert dag_runner.critical_path(tasks, timings) == (['stock_basic', 'daily_basic'], 4)
+    dag_runner.report(tasks, timings)
+
+
+def test_run_dag_failed():
+    """失败了的，依赖它的都跳过，别的照样跑"""
+    tasks = {
+        'stock_basic': (__sleep(0, fail=True), []),
+        'daily': (__sleep(0), ['stock_basic']),
+        'daily_qfq': (__sleep(0), ['daily']),
+        'index_daily': (__sleep(0), [])
+    }
+    timings = dag_runner.run_dag(tasks, workers=2)
+    assert {name: status for name, (_, _, status) in timings.items()} == \
+           {'stock_basic': 'failed', 'daily': 'skipped', 'daily_qfq': 'skipped', 'index_daily': 'ok'}
+    assert dag_runner.critical_path(tasks, timings)[0] == ['index_daily']
+    dag_runner.report(tasks, timings)
+
+
+def test_cycle():
+    tasks = {'a': (__sleep(0), ['b']), 'b': (__sleep(0), ['a']), 'c': (__sleep(0), [])}
+    with pytest.raises(ValueError):
+        dag_runner.run_dag(tasks, workers=2)
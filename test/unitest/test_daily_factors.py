@@ -0,0 +1,109 @@
+# pytest test/unitest/test_daily_factors.py -s
+import numpy as np
+import pandas as pd
+
+from mfm_learner.datasource.datasource import post_query
+from mfm_learner.example.factors.clv import CLVFactor
+from mfm_learner.example.factors.factor import Factor
+from mfm_learner.example.factors.momentum import MomentumFactor
+from mfm_learner.example.factors.std import StdFactor
+
+
+class MockDataSource():
+    """造一些随机的日线数据，记录一下被调用了几次"""
+
+    def __init__(self):
+        self.calls = 0
+
+    @post_query
+    def daily(self, stock_code, start_date=None, end_date=None):
+        self.calls += 1
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')
+        df = pd.DataFrame([[c, d] for c in stock_code for d in dates], columns=['ts_code', 'trade_date'])
+        df['close'] = np.exp(np.random.normal(0, 0.02, len(df)).cumsum())
+        df['high'] = df['close'] * 1.01
+        df['low'] = df['close'] * 0.99
+        df['pct_chg'] = np.random.normal(0, 2, len(df))
+        df['open'] = df['close']
+        df['pre_close'] = df['close'] * 0.98
+        df.loc[df.index[::10], ['high', 'low']] = df['close']  # 一字涨停
+        return df.sample(frac=1)  # 打乱顺序
+
+
+def __create_factor(clazz, datasource):
+    factor = clazz.__new__(clazz)  # 不调用__init__，防止去连真正的数据源
+    factor.datasource = datasource
+    return factor
+
+
+def test_shared_daily_data():
+    Factor.clear_daily_data()
+    datasource = MockDataSource()
+    codes = ['000001.SZ', '000002.SZ', '600000.SH']
+
+    momentum = __create_factor(MomentumFactor, datasource)
+    results = momentum.calculate(codes, '20200101', '20200630')
+    assert datasource.calls == 1  # 6个周期，只加载1次
+    assert [r.name for r in results] == momentum.name()
+    assert all([r.index.get_level_values('datetime').min() >= pd.Timestamp('20200101') for r in results])
+
+    # 和一只一只股票单独算的结果比较，shift不能跨股票
+    df_daily = Factor.daily_data[tuple(sorted(codes))][2]
+    df_stock = df_daily[df_daily.code == '000002.SZ'].set_index('datetime')
+    adj_close = (df_stock['close'] + df_stock['high'] + df_stock['low']) / 3
+    expected = np.log(adj_close / adj_close.shift(20)).loc['20200101':]
+    result = results[1].xs('000002.SZ', level='code')
+    assert np.allclose(result.values, expected.values)
+
+    # 日期范围被覆盖的，不再重新加载
+    std = __create_factor(StdFactor, datasource)
+    results = std.calculate(codes, '20200101', '20200630')
+    assert datasource.calls == 1
+    assert [r.name for r in results] == std.name()
+    df_stock = df_daily[df_daily.code == '600000.SH'].set_index('datetime')
+    expected = df_stock['pct_chg'].rolling(window=60).std().loc['20200101':]
+    result = results[2].xs('600000.SH', level='code')
+    assert np.allclose(result.values, expected.values)
+
+    # 股票池变了，要重新加载，只留最新的这个股票池
+    momentum.calculate(codes[:2], '20200101', '20200630')
+    assert datasource.calls == 2
+    assert list(Factor.daily_data) == [tuple(sorted(codes[:2]))]
+
+    # 返回的是拷贝，改了不影响共享的
+    df = momentum.load_daily_data(codes[:2], '20200101', '20200630')
+    df['close'] = 0
+    assert (Factor.daily_data[tuple(sorted(codes[:2]))][2]['close'] != 0).all()
+
+
+def test_std_suspension():
+    """停牌了几天，波动率还是按这只股票自己最近的N个交易日算，不会变成nan"""
+    Factor.clear_daily_data()
+    datasource = MockDataSource()
+    df_daily = datasource.daily(['000001.SZ', '600000.SH'], '20190101', '20200630')
+    suspended = (df_daily.code == '600000.SH') & (df_daily.datetime >= '20200301') & (df_daily.datetime <= '20200305')
+    df_daily = df_daily[~suspended]
+
+    std = __create_factor(StdFactor, datasource)
+    results = std.calculate(['000001.SZ', '600000.SH'], '20200101', '20200630', df_daily=df_daily.copy())
+    result = results[1].xs('600000.SH', level='code')
+    df_stock = df_daily[df_daily.code == '600000.SH'].set_index('datetime').sort_index()
+    expected = df_stock['pct_chg'].rolling(window=20).std().loc['20200101':]
+    assert not result.isna().any()
+    assert len(result) == len(expected)
+    assert np.allclose(result.values, expected.values)
+
+
+def test_clv():
+    Factor.clear_daily_data()
+    datasource = MockDataSource()
+    clv = __create_factor(CLVFactor, datasource)
+    factors = clv.calculate(['000001.SZ', '000002.SZ'], '20200101', '20200331')
+
+    df_daily = Factor.daily_data[('000001.SZ', '000002.SZ')][2].set_index(['datetime', 'code'])
+    df_daily.index = df_daily.index.set_levels(pd.to_datetime(df_daily.index.levels[0]), level=0)
+    df_daily = df_daily.loc[factors.index]
+    expected = ((df_daily.close - df_daily.low) - (df_daily.high - df_daily.close)) / (df_daily.high - df_daily.low)
+    expected[df_daily.high == df_daily.low] = 1
+    assert len(factors) == len(df_daily) == 2 * 65
+    assert np.allclose(factors.values, expected.values)
@@ -0,0 +1,73 @@
+# pytest test/unitest/test_database_datasource.py -s
+import math
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event
+
+from mfm_learner.datasource.impl.database_datasource import DatabaseDataSource, MAX_CODES_PER_QUERY
+
+
+def __create_datasource(stock_num, days=250):
+    """
+    用sqlite内存库，造一个daily_hfq、daily_basic表，省的连mysql
+    """
+    engine = create_engine('sqlite://')
+    dates = pd.date_range('20200101', periods=days, freq='B').strftime('%Y%m%d')
+    codes = [f'{600000 + i}.SH' for i in range(stock_num)]
+    df = pd.DataFrame([[c, d] for c in codes for d in dates], columns=['ts_code', 'trade_date'])
+    df['close'] = np.random.random(len(df))
+    df.to_sql('daily_hfq', engine, index=False)
+    df.rename(columns={'close': 'total_mv'}).to_sql('daily_basic', engine, index=False)
+    engine.execute('create index daily_hfq_code_date on daily_hfq (ts_code,trade_date)')
+
+    datasource = DatabaseDataSource.__new__(DatabaseDataSource)  # 不调用__init__，防止去连mysql
+    datasource.db_engine = engine
+    return datasource, codes, dates
+
+
+def __daily_one_by_one(datasource, stock_codes, start_date, end_date):
+    """原来的实现：一只股票一次查询，然后append"""
+    df_all = None
+    for stock_code in stock_codes:
+        df = pd.read_sql(
+            f'select * from daily_hfq where ts_code="{stock_code}" and trade_date>="{start_date}" and trade_date<="{end_date}"',
+            datasource.db_engine)
+        df_all = df if df_all is None else df_all.append(df)
+    return df_all
+
+
+def test_daily():
+    datasource, codes, dates = __create_datasource(stock_num=20, days=30)
+    start_date, end_date = dates[5], dates[20]
+
+    df = datasource.daily(codes, start_date, end_date)
+    df_expected = __daily_one_by_one(datasource, codes, start_date, end_date).reset_index(drop=True)
+    assert len(df) == 20 * 16
+    assert (df['code'].values == df_expected['ts_code'].values).all()
+    assert (df['datetime'].values == df_expected['trade_date'].values).all()
+    assert np.allclose(df['close'].values, df_expected['close'].values)
+
+    df = datasource.daily(codes[0], start_date, end_date)
+    assert len(df) == 16 and (df['code'] == codes[0]).all()
+
+    df = datasource.daily_basic(codes, start_date, end_date)
+    assert len(df) == 20 * 16
+
+
+def test_daily_batch_queries():
+    """股票池变大，查询次数只随MAX_CODES_PER_QUERY分批增加，结果和逐只查询的一样"""
+    datasource, codes, dates = __create_datasource(stock_num=1200, days=5)
+    start_date, end_date = dates[0], dates[-1]
+
+    sqls = []
+    event.listen(datasource.db_engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: sqls.append(statement))
+    df = datasource.daily(codes, start_date, end_date)
+    assert len(sqls) == math.ceil(1200 / MAX_CODES_PER_QUERY)
+
+    df_expected = __daily_one_by_one(datasource, codes, start_date, end_date).reset_index(drop=True)
+    assert len(df) == 1200 * 5
+    assert (df['code'].values == df_expected['ts_code'].values).all()
+    assert (df['datetime'].values == df_expected['trade_date'].values).all()
+    assert np.allclose(df['close'].values, df_expected['close'].values)
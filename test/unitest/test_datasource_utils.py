@@ -1,4 +1,8 @@
 # pytest  test/unitest/test_datasource_utils.py -s
+import json
+import os
+import time
+
 from mfm_learner import utils
 import pandas as pd
 
@@ -22,6 +26,36 @@ def test_compile_industry():
     assert data[1] == "210000"
     assert data[2] == "710000"
 
+def test_compile_industry_mapping(tmp_path, monkeypatch):
+    """行业名只查一次，映射保存到文件，后面的调用不再去取index_classify"""
+    calls = []
+
+    class MockDataSource():
+        def index_classify(self):
+            calls.append(1)
+            return pd.DataFrame([['801110.SI', '家用电器', 'L1', '330000', '0'],
+                                 ['801750.SI', '计算机', 'L1', '710000', '0'],
+                                 ['801022.SI', '其他采掘', 'L2', '210300', '210000']],
+                                columns=['index_code', 'industry_name', 'level', 'industry_code', 'parent_code'])
+
+    monkeypatch.setattr(dsu.ds_factory, 'get', lambda: MockDataSource())
+    mapping_file = str(tmp_path / "industry.json")
+    index = pd.MultiIndex.from_product([pd.date_range('20200101', periods=1000), ['000001.SZ', '000002.SZ', '000003.SZ']])
+    data = pd.Series(["家用电器", "其他采掘", "计算机设备"] * 1000, index=index)
+    data.iloc[1] = None
+
+    result = dsu.compile_industry(data, mapping_file)
+    assert result.index.equals(data.index)
+    assert result.iloc[0] == "330000" and pd.isna(result.iloc[1]) and result.iloc[2] == "710000"
+    assert (result.iloc[3:].values == ["330000", "210000", "710000"] * 999).all()
+    assert len(calls) == 1
+
+    dsu._industry_mappings.clear()  # 清掉进程内缓存，从文件加载
+    result = dsu.compile_industry(data, mapping_file)
+    assert result.iloc[4] == "210000"
+    assert len(calls) == 1
+
+
 def test_tushare_cache():
     ts = TushareDataSource()
     df = ts.fina_indicator('600000.SH', start_date='20170101', end_date='20180801')
@@ -58,4 +92,92 @@ def test_tushare_cache():
 def test_akshare_cache():
     ak = AKShareDataSource()
     df = ak.fund_daily('710001',start_date=None, end_date=None)
-    print(df)
\ No newline at end of file
+    print(df)
+
+def test_data_cache(tmp_path):
+    """测试缓存，包括类型保留、日期区间的增量合并、LRU淘汰"""
+    from mfm_learner.datasource.datasource import cache
+
+    calls = []
+
+    class MockDataSource():
+        @cache(str(tmp_path))
+        def daily(self, stock_code, start_date, end_date):
+            calls.append((start_date, end_date))
+            dates = pd.date_range(start_date, end_date).strftime('%Y%m%d')
+            return pd.DataFrame({'ts_code': stock_code, 'trade_date': dates, 'close': 1.0})
+
+    ds = MockDataSource()
+    df = ds.daily('000001.SZ', '20180101', '20191231')
+    assert len(df) == 730
+    df = ds.daily('000001.SZ', start_date='20180301', end_date='20191231')
+    assert len(calls) == 1  # 命中缓存
+    assert df['trade_date'].iloc[0] == '20180301' and df['trade_date'].dtype == object
+
+    df = ds.daily('000001.SZ', '20180101', '20201231')
+    assert calls[-1] == ('20200101', '20201231')  # 只取了增量
+    assert len(df) == 730 + 366
+    assert df['trade_date'].is_unique
+
+    ds.daily('000002.SZ', '20180101', '20180110')
+    assert len(calls) == 3
+
+
+def test_data_cache_descending(tmp_path):
+    """tushare返回的是日期倒序的，增量合并后，还是倒序的，和直接调用的一样"""
+    from mfm_learner.datasource.datasource import cache
+
+    class MockDataSource():
+        @cache(str(tmp_path))
+        def daily(self, stock_code, start_date, end_date):
+            dates = pd.date_range(start_date, end_date).strftime('%Y%m%d')[::-1]
+            return pd.DataFrame({'ts_code': stock_code, 'trade_date': dates, 'close': 1.0})
+
+    ds = MockDataSource()
+    ds.daily('000001.SZ', '20180101', '20181231')
+    df = ds.daily('000001.SZ', '20180101', '20191231')  # 部分命中，合并
+    assert df['trade_date'].is_monotonic_decreasing and len(df) == 730
+    df = ds.daily('000001.SZ', '20180601', '20190630')  # 从合并后的缓存中切片
+    assert df['trade_date'].is_monotonic_decreasing
+    assert df['trade_date'].iloc[0] == '20190630' and df['trade_date'].iloc[-1] == '20180601'
+
+
+def test_save_industry_mapping_merge(tmp_path):
+    """另外一个进程已经保存了的映射，合并进来，不覆盖掉"""
+    mapping_file = str(tmp_path / "industry.json")
+    dsu._save_industry_mapping(mapping_file, {"家用电器": "330000"})
+    dsu._save_industry_mapping(mapping_file, {"计算机": "710000"})
+    with open(mapping_file, encoding='utf-8') as f:
+        assert json.load(f) == {"家用电器": "330000", "计算机": "710000"}
+    assert os.listdir(tmp_path) == ["industry.json"]  # 临时文件没了
+
+
+def test_data_cache_multiprocess(tmp_path):
+    """两个实例（模拟两个进程）共用一个目录，索引合并，不丢别人的文件，总大小也不超过max_size"""
+    from mfm_learner.datasource.datasource import DataCache, CACHE_INDEX_FILE
+
+    def call(stock_code):
+        return pd.DataFrame({'ts_code': stock_code, 'close': range(1000)})
+
+    cache1 = DataCache(str(tmp_path))
+    cache2 = DataCache(str(tmp_path))
+    cache1.get_or_call('daily', {'stock_code': '000001.SZ'}, call)
+    cache2.get_or_call('daily', {'stock_code': '000002.SZ'}, call)
+    cache1.get_or_call('daily', {'stock_code': '000003.SZ'}, call)
+    assert len(DataCache(str(tmp_path)).index) == 3
+    file_size = list(cache1.index.values())[0]['size']
+
+    # 命中缓存，不写索引文件
+    index_time = os.path.getmtime(tmp_path / CACHE_INDEX_FILE)
+    time.sleep(0.01)
+    cache2.get_or_call('daily', {'stock_code': '000002.SZ'}, call)
+    assert cache2.hit == 1
+    assert os.path.getmtime(tmp_path / CACHE_INDEX_FILE) == index_time
+
+    # 按照整个目录淘汰，000001最久没访问，被淘汰了
+    cache2.max_size = file_size * 3
+    cache2.get_or_call('daily', {'stock_code': '000004.SZ'}, call)
+    index = DataCache(str(tmp_path)).index
+    assert len(index) == 3
+    assert sorted([e['key'] for e in index.values()])[0] == "daily:[('stock_code', '000002.SZ')]"
+    assert sorted([f for f in os.listdir(tmp_path) if f.endswith(".pkl")]) == sorted(index)
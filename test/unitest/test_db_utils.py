@@ -0,0 +1,80 @@
+# pytest test/unitest/test_db_utils.py -s
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from mfm_learner.example import factor_utils
+from mfm_learner.utils import db_utils
+
+
+def __generate_factor(date_num, stock_num, start_date='20200101'):
+    dates = pd.date_range(start_date, periods=date_num, freq='B')
+    codes = [f'{600000 + i}.SH' for i in range(stock_num)]
+    index = pd.MultiIndex.from_product([dates, codes], names=['datetime', 'code'])
+    return pd.DataFrame({'bm': np.random.normal(0, 1, len(index))}, index=index).reset_index()
+
+
+def test_bulk_to_db(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    df = __generate_factor(date_num=100, stock_num=50)
+    db_utils.bulk_to_db(df, 'factor_bm', engine, if_exists='replace', chunksize=100)
+
+    columns = {c['name']: c['type'] for c in sqlalchemy.inspect(engine).get_columns('factor_bm')}
+    assert isinstance(columns['code'], sqlalchemy.types.VARCHAR)
+    assert isinstance(columns['datetime'], sqlalchemy.types.DateTime)
+    indices = sqlalchemy.inspect(engine).get_indexes('factor_bm')
+    assert [i['column_names'] for i in indices] == [['code', 'datetime']]
+
+    # 追加，索引不重复建
+    db_utils.bulk_to_db(__generate_factor(date_num=10, stock_num=50, start_date='20200601'), 'factor_bm', engine)
+    df_db = pd.read_sql('select * from factor_bm', engine)
+    assert len(df_db) == 5500
+    assert np.allclose(df_db['bm'].values[:5000], df['bm'].values)
+    assert len(sqlalchemy.inspect(engine).get_indexes('factor_bm')) == 1
+
+    # 替换
+    db_utils.bulk_to_db(df.head(10), 'factor_bm', engine, if_exists='replace')
+    assert len(pd.read_sql('select * from factor_bm', engine)) == 10
+    assert len(sqlalchemy.inspect(engine).get_indexes('factor_bm')) == 1
+
+
+def test_factor2db(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    monkeypatch.setattr(factor_utils.utils, 'connect_db', lambda: engine)
+
+    df = __generate_factor(date_num=20, stock_num=10)
+    factor_utils.factor2db('bm', df)
+    factor_utils.factor2db('bm', __generate_factor(date_num=5, stock_num=10, start_date='20200601'), append=True)
+    assert factor_utils.get_factor_last_date('bm') == '20200605'
+
+    factor_utils.factor_synthesis2db('test', 'bm+ep', df.copy())
+    factor_utils.factor_synthesis2db('test', 'bm+ep', df.copy())  # 先删掉旧的
+    assert len(pd.read_sql('select * from factor_synthesis', engine)) == 200
+    indices = sqlalchemy.inspect(engine).get_indexes('factor_synthesis')
+    assert [i['column_names'] for i in indices] == [['name', 'code', 'datetime']]
+
+
+def test_get_last_dates(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    assert db_utils.get_last_dates('daily', 'trade_date', engine) == {}
+
+    df = pd.DataFrame({'ts_code': ['000001.SZ', '000001.SZ', '600000.SH'],
+                       'trade_date': ['20200102', '20200103', '20200102']})
+    db_utils.bulk_to_db(df, 'daily', engine)
+    assert db_utils.get_last_dates('daily', 'trade_date', engine) == {'000001.SZ': '20200103', '600000.SH': '20200102'}
+
+
+def test_bulk_to_db_wide_table(tmp_path):
+    """宽表，一条insert的行数按列数减少，参数个数不超过PARAM_BUDGET"""
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    df = pd.DataFrame(np.random.random((1000, 100)), columns=[f'c{i}' for i in range(100)])
+    df.insert(0, 'ts_code', '600000.SH')
+    assert db_utils.get_chunk_size(df) == db_utils.PARAM_BUDGET // 101
+    assert db_utils.get_chunk_size(df[['ts_code', 'c0']]) == db_utils.BULK_CHUNK_SIZE
+
+    params = []
+    sqlalchemy.event.listen(engine, "before_cursor_execute",
+                            lambda conn, cursor, statement, parameters, *args: params.append(len(parameters)))
+    db_utils.bulk_to_db(df, 'fina_indicator', engine)
+    assert max(params) <= db_utils.PARAM_BUDGET
+    assert len(pd.read_sql('select * from fina_indicator', engine)) == 1000
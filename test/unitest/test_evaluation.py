@@ -0,0 +1,170 @@
+# pytest test/unitest/test_evaluation.py -s
+import time
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from pandas import DataFrame
+from scipy import stats
+
+from mfm_learner.example.analysis import evaluation
+
+
+def __generate_factor_data(date_num, stock_num, nan_ratio=0.02):
+    """造一个alphalens格式的factor_data：[date|asset]索引，1D,5D,10D,factor列"""
+    dates = pd.date_range('20200101', periods=date_num, freq='B')
+    index = pd.MultiIndex.from_product([dates, [f'{600000 + i}.SH' for i in range(stock_num)]],
+                                       names=['date', 'asset'])
+    factor = np.random.normal(0, 1, len(index))
+    df = DataFrame(index=index)
+    for period in [1, 5, 10]:
+        df[f'{period}D'] = 0.01 * factor + np.random.normal(0, 0.02 * np.sqrt(period), len(index))
+    df['factor'] = factor
+    df = df.mask(np.random.random(df.shape) < nan_ratio)
+    return df
+
+
+def __factor_returns_regression_by_statsmodels(factor_data):
+    """原来的实现：每天、每个周期，都用statsmodels回归一次"""
+    columns = evaluation.get_forward_returns_columns(factor_data.columns)
+    tvalues, factor_returns = [], []
+    for _, df_day in factor_data.groupby(level='date'):
+        tvalues.append([])
+        factor_returns.append([])
+        for column in columns:
+            df = df_day[[column, 'factor']].dropna()
+            result = sm.OLS(df[column], sm.add_constant(df['factor'])).fit()
+            tvalues[-1].append(result.tvalues[1])
+            factor_returns[-1].append(result.params[1])
+    index = factor_data.index.unique(level='date')
+    return DataFrame(tvalues, index=index, columns=columns), DataFrame(factor_returns, index=index, columns=columns)
+
+
+def test_get_forward_returns_columns():
+    assert evaluation.get_forward_returns_columns(['1D', '5D', 'factor', '10D', 'factor_quantile']) == \
+           ['1D', '5D', '10D']
+
+
+def test_factor_returns_regression():
+    factor_data = __generate_factor_data(date_num=250, stock_num=50)
+
+    start_time = time.time()
+    expected_tvalues, expected_returns = __factor_returns_regression_by_statsmodels(factor_data)
+    statsmodels_time = time.time() - start_time
+
+    start_time = time.time()
+    tvalues, factor_returns = evaluation.factor_returns_regression(factor_data)
+    vectorized_time = time.time() - start_time
+    print(f"250天x50只股票x3个周期：statsmodels {statsmodels_time:.2f} 秒, 向量化 {vectorized_time:.3f} 秒")
+
+    assert list(tvalues.columns) == ['1D', '5D', '10D']
+    assert (tvalues.index == expected_tvalues.index).all()
+    assert np.allclose(factor_returns.values, expected_returns.values, rtol=0, atol=1e-10)
+    assert np.allclose(tvalues.values, expected_tvalues.values, rtol=0, atol=1e-10)
+
+
+def test_factor_returns_regression_degenerate():
+    """股票太少、因子值都一样的那天，回归不出来，为nan"""
+    factor_data = __generate_factor_data(date_num=3, stock_num=10, nan_ratio=0)
+    factor_data.iloc[:8, :] = np.nan  # 第1天只剩2只股票
+    factor_data.loc[factor_data.index.get_level_values('date')[-1], 'factor'] = 1  # 最后1天因子值都一样
+    tvalues, factor_returns = evaluation.factor_returns_regression(factor_data)
+    assert np.isnan(tvalues.iloc[0]).all()
+    assert not np.isnan(factor_returns.iloc[0]).any()
+    assert not np.isnan(tvalues.iloc[1]).any()
+    assert np.isnan(factor_returns.iloc[2]).all() and np.isnan(tvalues.iloc[2]).all()
+
+
+def __generate_factor_and_prices(date_num, stock_num):
+    dates = pd.date_range('20200101', periods=date_num, freq='B')
+    codes = [f'{600000 + i}.SH' for i in range(stock_num)]
+    prices = DataFrame(np.exp(np.random.normal(0, 0.02, (date_num, stock_num)).cumsum(axis=0)),
+                       index=dates, columns=codes)
+    prices = prices.mask(np.random.random(prices.shape) < 0.02)  # 停牌
+    index = pd.MultiIndex.from_product([dates, codes], names=['datetime', 'code'])
+    factor = pd.Series(np.random.normal(0, 1, len(index)), index=index, name='factor')
+    factor = factor.mask(np.random.random(len(factor)) < 0.05)
+    return factor, prices
+
+
+def __clean_factor_by_pandas(factor, prices, periods, quantiles=5):
+    """按alphalens的做法：pct_change(N).shift(-N)，dropna，每天qcut，分不开的那天去掉"""
+    factor_data = DataFrame(index=factor.index)
+    for period in periods:
+        forward_returns = prices.pct_change(period).shift(-period)
+        factor_data[f'{period}D'] = forward_returns.stack(dropna=False).reindex(factor.index).values
+    factor_data['factor'] = factor
+    factor_data.index.names = ['date', 'asset']
+    factor_data = factor_data.dropna()
+
+    def quantile_calc(x):
+        try:
+            return pd.qcut(x, quantiles, labels=False) + 1
+        except Exception:
+            return pd.Series(index=x.index, dtype=float)
+
+    factor_data['factor_quantile'] = factor_data.groupby(level='date')['factor'].transform(quantile_calc)
+    return factor_data.dropna()
+
+
+def test_get_clean_factor_and_forward_returns():
+    factor, prices = __generate_factor_and_prices(date_num=120, stock_num=30)
+    factor.loc[factor.index.get_level_values(0)[0]] = 1  # 第1天因子值都一样，分不了组
+
+    factor_data = evaluation.get_clean_factor_and_forward_returns(factor, prices, periods=[1, 5, 10])
+    expected = __clean_factor_by_pandas(factor, prices, periods=[1, 5, 10])
+
+    assert list(factor_data.columns) == ['1D', '5D', '10D', 'factor', 'factor_quantile']
+    assert factor_data.index.names == ['date', 'asset']
+    assert (factor_data.index == expected.index).all()
+    assert np.allclose(factor_data.values, expected.values)
+    assert factor_data.index.get_level_values('date').min() > prices.index[0]
+
+
+def test_information_coefficient_and_quantile_returns():
+    factor, prices = __generate_factor_and_prices(date_num=250, stock_num=50)
+    factor_data = evaluation.get_clean_factor_and_forward_returns(factor, prices, periods=[1, 5])
+    factor_data.iloc[::7, 0] = np.nan  # 某个周期缺数据，那天只用不缺的股票算IC
+
+    start_time = time.time()
+    expected_rank_ic, expected_ic = [], []
+    for _, df in factor_data.groupby(level='date'):
+        expected_rank_ic.append([stats.spearmanr(df[c], df['factor'], nan_policy='omit')[0] for c in ['1D', '5D']])
+        expected_ic.append([df[c].corr(df['factor']) for c in ['1D', '5D']])
+    pandas_time = time.time() - start_time
+
+    start_time = time.time()
+    rank_ic = evaluation.information_coefficient(factor_data)
+    ic = evaluation.information_coefficient(factor_data, method='normal')
+    numpy_time = time.time() - start_time
+    print(f"250天x50只股票：逐日算IC {pandas_time:.2f} 秒, 批量 {numpy_time:.3f} 秒")
+
+    assert np.allclose(rank_ic.values, expected_rank_ic)
+    assert np.allclose(ic.values, expected_ic)
+
+    t_values, p_values, skew, kurtosis = evaluation.ic_statistics(rank_ic)
+    assert np.allclose(t_values, stats.ttest_1samp(rank_ic, 0)[0])
+    assert np.allclose(skew, stats.skew(rank_ic)) and np.allclose(kurtosis, stats.kurtosis(rank_ic))
+
+    # 分层收益率：先减去当天所有股票的平均收益，再按[组,日期]求平均
+    mean_quantile_ret_bydate = evaluation.mean_return_by_quantile(factor_data)
+    assert mean_quantile_ret_bydate.index.names == ['factor_quantile', 'date']
+    day = factor_data.index.get_level_values('date')[100]
+    df_day = factor_data.xs(day, level='date')
+    expected = (df_day['5D'] - df_day['5D'].mean())[df_day['factor_quantile'] == 3].mean()
+    assert np.isclose(mean_quantile_ret_bydate.loc[(3, day), '5D'], expected)
+
+
+def test_score_by_evaluation():
+    """算出来的结构，可以直接给score打分"""
+    from mfm_learner.example.analysis.score import score
+
+    factor, prices = __generate_factor_and_prices(date_num=120, stock_num=30)
+    factor_data = evaluation.get_clean_factor_and_forward_returns(factor, prices, periods=[1, 5])
+    ic_data = evaluation.information_coefficient(factor_data)
+    t_values, _, skew, kurtosis = evaluation.ic_statistics(ic_data)
+    factor_return_tvalues, factor_returns = evaluation.factor_returns_regression(factor_data)
+    df_result, _ = score(factor_return_tvalues, factor_returns, ic_data, t_values, skew, kurtosis,
+                         evaluation.mean_return_by_quantile(factor_data), [1, 5])
+    assert list(df_result.columns) == ['name_cn', 'name_en', '1D', '5D']
+    assert 'ic_mean' in df_result['name_en'].values
@@ -1,4 +1,7 @@
-from mfm_learner.example import factor_analyzer
+import numpy as np
+import pandas as pd
+
+from mfm_learner.example import factor_analyzer, factor_utils
 from test.unitest import test_utils
 
 # pytest test/unitest/test_factor_analyzer.py -s
@@ -7,3 +10,71 @@ def test_factor_returns_regression():
     df_tavlues,df_factor_returns = factor_analyzer.factor_returns_regression(df_factor_data)
     print(df_tavlues.head(3))
     print(df_factor_returns.head(3))
+
+
+def __generate_shared_data(date_num=120, stock_num=30):
+    dates = pd.date_range('20200101', periods=date_num, freq='B')
+    codes = [f'{600000 + i}.SH' for i in range(stock_num)]
+    index = pd.MultiIndex.from_product([dates, codes], names=['datetime', 'code'])
+    df_stocks = pd.DataFrame({'close': np.exp(np.random.normal(0, 0.02, (stock_num, date_num)).cumsum(axis=1)).T.ravel()},
+                             index=index).reset_index()
+    df_mv = pd.Series(np.random.lognormal(10, 1, len(index)), index=index, name='total_mv')
+    return {
+        'stock_codes': codes,
+        'start_date': '20200101',
+        'end_date': '20200630',
+        'periods': [1, 5],
+        'df_stocks': df_stocks,
+        'df_mv': df_mv,
+        'df_stock_basic': None,
+        'index_prices': None,
+        'exposures': factor_utils.neutralize_exposures(None, df_mv),
+        'use_alphalens': False,
+        'plot': False
+    }
+
+
+def test_analyze_factors_parallel(monkeypatch):
+    """多进程并行分析的结果，和一个一个分析的一样"""
+    shared_data = __generate_shared_data()
+    index = shared_data['df_mv'].index
+
+    def get_factor(name, stock_codes, start_date, end_date):
+        if name == 'not_exist': return None
+        seed = sum(map(ord, name))  # 每个因子固定的随机数，子进程里算出来的也一样
+        values = np.random.default_rng(seed).normal(0, 1, len(index))
+        return pd.DataFrame({name: values}, index=index)
+
+    monkeypatch.setattr(factor_analyzer.factor_utils, 'get_factor', get_factor)
+    factor_names = ['clv', 'momentum', 'not_exist', 'std']
+
+    serial = dict(factor_analyzer.analyze_factors(factor_names, shared_data, workers=1))
+    parallel = dict(factor_analyzer.analyze_factors(factor_names, shared_data, workers=3))
+
+    assert set(parallel.keys()) == set(factor_names)
+    assert parallel['not_exist'] is None
+    for name in ['clv', 'momentum', 'std']:
+        assert list(parallel[name].columns) == ['name_cn', 'name_en', '1D', '5D']
+        assert np.allclose(parallel[name][['1D', '5D']].values.astype(float),
+                           serial[name][['1D', '5D']].values.astype(float))
+
+    df_records = factor_analyzer.analysis_result_to_records('clv', serial['clv'])
+    assert list(df_records.columns) == ['name_cn', 'name_en', 'metrics', 'factor', 'period']
+    assert len(df_records) == 2 * len(serial['clv'])
+
+
+def test_dispose_inherited_connections(monkeypatch):
+    """子进程丢掉从父进程继承来的连接池，但不关闭父进程的连接"""
+    from mfm_learner.datasource import datasource_factory
+    disposed = []
+
+    class MockEngine():
+        def dispose(self, close=True):
+            disposed.append(close)
+
+    class MockDataSource():
+        db_engine = MockEngine()
+
+    monkeypatch.setattr(datasource_factory, '__database_datasource', MockDataSource())
+    datasource_factory.dispose_inherited_connections()
+    assert disposed == [False]
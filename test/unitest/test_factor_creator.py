@@ -0,0 +1,187 @@
+# pytest test/unitest/test_factor_creator.py -s
+import multiprocessing
+import os
+import pickle
+
+import pandas as pd
+
+from mfm_learner.datasource.datasource import DataSource, post_query
+from mfm_learner.example import factor_creator
+from mfm_learner.example.factors.factor import Factor
+
+CODES = ['000001.SZ', '000002.SZ', '600000.SH']
+
+
+class MockDataSource(DataSource):
+    """预加载过的数据集，子进程里不应该再来取"""
+
+    def __check(self):
+        assert multiprocessing.parent_process() is None, "子进程不应该再去取预加载过的数据"
+
+    def index_weight(self, index_code, start_date, end_date=None):
+        return CODES
+
+    def trade_cal(self, start_date, end_date, exchange='SSE'):
+        return pd.Series(pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d'))
+
+    @post_query
+    def daily(self, stock_code, start_date=None, end_date=None):
+        self.__check()
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')
+        return pd.DataFrame([[c, d, 1.0] for c in stock_code for d in dates], columns=['ts_code', 'trade_date', 'close'])
+
+    @post_query
+    def daily_basic(self, stock_code, start_date, end_date):
+        self.__check()
+        if type(stock_code) != list: stock_code = [stock_code]
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')
+        return pd.DataFrame([[c, d, 2.0] for c in stock_code for d in dates], columns=['ts_code', 'trade_date', 'pb'])
+
+
+class MockBasicFactor(Factor):
+    datasets = {'daily_basic': 0}
+
+    def __init__(self):
+        self.datasource = MockDataSource()
+
+    def name(self):
+        return "mock_bm"
+
+    def calculate(self, stock_codes, start_date, end_date):
+        df = self.datasource.daily_basic(stock_codes, start_date, end_date)
+        df['mock_bm'] = 1 / df['pb']
+        return df.set_index(['datetime', 'code'])['mock_bm']
+
+
+class MockDailyFactor(Factor):
+    datasets = {'daily': 1}
+
+    def __init__(self):
+        self.datasource = MockDataSource()
+
+    def name(self):
+        return ["mock_close", "mock_close2"]
+
+    def calculate(self, stock_codes, start_date, end_date):
+        df = self.load_daily_data(stock_codes, factor_creator.utils.last_year(start_date), end_date)
+        df = df.set_index(['datetime', 'code'])
+        return [df['close'].rename('mock_close'), (df['close'] * 2).rename('mock_close2')]
+
+
+def test_parallel_create(monkeypatch, tmp_path):
+    def factor2db(name, factor, append=False):
+        with open(os.path.join(tmp_path, name + ".pkl"), "wb") as f:
+            pickle.dump(factor, f)
+
+    monkeypatch.setattr(factor_creator, 'datasource', MockDataSource())
+    monkeypatch.setattr(factor_creator.factor_utils, 'factor2db', factor2db)
+    monkeypatch.setattr(factor_creator.dynamic_loader, 'dynamic_instantiation',
+                        lambda package, parent: {'MockBasicFactor': MockBasicFactor,
+                                                 'MockDailyFactor': MockDailyFactor})
+    Factor.clear_daily_data()
+
+    stats = []
+    monkeypatch.setattr(factor_creator, 'report', lambda s: stats.extend(s))
+    factor_creator.main("all", '20200101', '20200331', '000905.SH', 10, workers=2)
+    assert Factor.daily_data == {} and factor_creator._preload_data is None  # 算完就释放了
+
+    assert [s[0] for s in stats] == ["mock_bm", ["mock_close", "mock_close2"]]
+    assert all([seconds >= 0 and peak_memory > 0 for _, seconds, peak_memory in stats])
+
+    df = pd.read_pickle(os.path.join(tmp_path, "mock_bm.pkl"))
+    assert list(df.columns) == ['datetime', 'code', 'mock_bm'] and (df.mock_bm == 0.5).all()
+    assert df.datetime.min() == '20200101' and df.code.nunique() == 3
+    df = pd.read_pickle(os.path.join(tmp_path, "mock_close2.pkl"))
+    assert (df.mock_close2 == 2).all() and df.datetime.min() < '20200101'
+
+
+class MockWarmupFactor(MockBasicFactor):
+    warmup_days = 5
+
+    def name(self):
+        return "mock_warmup"
+
+    def calculate(self, stock_codes, start_date, end_date):
+        return super().calculate(stock_codes, start_date, end_date).rename('mock_warmup')
+
+
+def test_incremental_create(monkeypatch):
+    """增量计算：只追加库里最后日期之后的，有滚动窗口的，往前多算warmup_days个交易日"""
+    saved = {}
+
+    def factor2db(name, factor, append=False):
+        saved[name] = (append, factor.datetime.min(), factor.datetime.max(), len(factor))
+
+    last_dates = {'mock_bm': '20200320', 'mock_warmup': '20200320', 'mock_close': '20200331', 'mock_close2': '20200331'}
+    monkeypatch.setattr(factor_creator, 'datasource', MockDataSource())
+    monkeypatch.setattr(factor_creator.factor_utils, 'factor2db', factor2db)
+    monkeypatch.setattr(factor_creator.factor_utils, 'get_factor_last_date', lambda name: last_dates.get(name))
+    monkeypatch.setattr(factor_creator.dynamic_loader, 'dynamic_instantiation',
+                        lambda package, parent: {'MockBasicFactor': MockBasicFactor,
+                                                 'MockDailyFactor': MockDailyFactor,
+                                                 'MockWarmupFactor': MockWarmupFactor})
+    monkeypatch.setattr(factor_creator, 'report', lambda s: None)
+    Factor.clear_daily_data()
+
+    assert factor_creator.incremental_dates(MockWarmupFactor(), '20200101', '20200331') == \
+           ('20200316', {'mock_warmup': '20200320'})  # 20200320之前的5个交易日
+    assert factor_creator.incremental_dates(MockDailyFactor(), '20200101', '20200331') is None
+
+    factor_creator.main("all", '20200101', '20200331', '000905.SH', 10, incremental=True)
+
+    assert 'mock_close' not in saved  # 已经是最新的了
+    # 20200323~20200331，7个交易日 x 3只股票
+    assert saved['mock_bm'] == (True, '20200323', '20200331', 21)
+    assert saved['mock_warmup'] == (True, '20200323', '20200331', 21)
+
+    # 库里还没有的因子，从头算，替换
+    saved.clear()
+    last_dates.pop('mock_bm')
+    factor_creator.main("mock_bm", '20200101', '20200331', '000905.SH', 10, incremental=True)
+    assert saved['mock_bm'][0] is False and saved['mock_bm'][1] == '20200101'
+
+
+class MockDatetimeFactor(MockBasicFactor):
+    """真正的因子，日期是datetime类型的"""
+
+    def name(self):
+        return "mock_dt"
+
+    def calculate(self, stock_codes, start_date, end_date):
+        df = super().calculate(stock_codes, start_date, end_date).rename('mock_dt').reset_index()
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        return df.set_index(['datetime', 'code'])['mock_dt']
+
+
+def test_create_without_database(monkeypatch, tmp_path):
+    """配置的是parquet数据源，因子存到本地parquet目录中，增量计算、加载因子，都不用连数据库"""
+    from mfm_learner.datasource.impl.parquet_datasource import ParquetDataSource
+    from mfm_learner.example import factor_utils
+
+    def connect_db():
+        raise AssertionError("不应该连数据库")
+
+    store = ParquetDataSource(str(tmp_path))
+    monkeypatch.setitem(factor_utils.CONF, 'datasource', 'parquet')
+    monkeypatch.setattr(factor_utils.datasource_factory, 'create', lambda type=None: store)
+    monkeypatch.setattr(factor_utils.utils, 'connect_db', connect_db)
+    monkeypatch.setattr(factor_creator, 'datasource', MockDataSource())
+    monkeypatch.setattr(factor_creator.dynamic_loader, 'dynamic_instantiation',
+                        lambda package, parent: {'MockDatetimeFactor': MockDatetimeFactor})
+    monkeypatch.setattr(factor_creator, 'report', lambda s: None)
+
+    factor_creator.main("all", '20200101', '20200331', '000905.SH', 10, incremental=True)
+    assert factor_utils.get_factor_last_date('mock_dt') == '20200331'
+    assert os.path.exists(os.path.join(tmp_path, 'factor_mock_dt'))
+
+    factor_creator.main("all", '20200101', '20200430', '000905.SH', 10, incremental=True)  # 追加4月份的
+    df = factor_utils.get_factor('mock_dt', CODES[:2], '20200301', '20200430')
+    assert df.index.names == ['datetime', 'code']
+    assert df.index.get_level_values('code').unique().tolist() == CODES[:2]
+    expected_dates = pd.date_range('20200301', '20200430', freq='B')
+    assert len(df) == 2 * len(expected_dates) and not df.index.duplicated().any()
+    assert (df['mock_dt'] == 0.5).all()
+
+    factor_utils.factor_synthesis2db('mock_synth', 'mock_dt', df.rename(columns={'mock_dt': 'value'}).reset_index())
+    df = factor_utils.get_factor_synthesis('mock_synth', CODES, '20200401', '20200430')
+    assert len(df) == 2 * len(pd.date_range('20200401', '20200430', freq='B'))
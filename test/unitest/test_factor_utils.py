@@ -1,7 +1,10 @@
 # pytest -o log_cli=true test/unitest/test_factor_utils.py -s
 import math
+import time
 from random import random
 
+import numpy as np
+
 import pandas as pd
 from pandas import DataFrame
 
@@ -24,6 +27,95 @@ def test_pct_chg():
     assert math.isnan(returns[3])
 
 
+def __preprocess_by_apply(factors):
+    """原来的实现：逐日的groupby.apply"""
+    factors = factors.groupby(level='datetime').apply(factor_utils.fill_nan)
+    factors = factors.groupby(level='datetime').apply(factor_utils.winsorize)
+    factors = factors.groupby(level='datetime').apply(factor_utils.standardize)
+    return factors
+
+
+def __generate_random_factor(date_num, stock_num, nan_ratio=0.05):
+    dates = pd.date_range('20100101', periods=date_num, freq='B')
+    codes = [f'{600000 + i}.SH' for i in range(stock_num)]
+    index = pd.MultiIndex.from_product([dates, codes], names=['datetime', 'code'])
+    values = np.random.standard_t(3, len(index))  # 厚尾，保证有极值要去
+    values[np.random.random(len(index)) < nan_ratio] = np.nan
+    df = pd.Series(values, index=index, name='factor')
+    return df.sample(frac=0.9).sort_index()  # 有些股票某些天没有数据
+
+
+def test_preprocess():
+    factors = __generate_random_factor(date_num=50, stock_num=300)
+    # 某一天全是nan，某一天只有1只股票
+    factors.loc[factors.index[0][0]] = np.nan
+    factors = factors.drop(factors.loc[factors.index[-1][0]].index[1:], level='code')
+
+    expected = __preprocess_by_apply(factors.copy())
+    result = factor_utils.preprocess(factors)
+    assert result.index.equals(factors.index)
+    assert result.name == factors.name
+    assert np.allclose(result.values, expected.loc[factors.index].values, rtol=1e-12, atol=1e-12, equal_nan=True)
+    assert result.isna().sum() == expected.isna().sum()
+
+    # 单列的DataFrame也可以
+    result = factor_utils.preprocess(factors.to_frame())
+    assert np.allclose(result.values, expected.loc[factors.index].values, rtol=1e-12, atol=1e-12, equal_nan=True)
+
+
+def __residual_by_lstsq(data):
+    """原来的实现：每天get_dummies(行业) + 市值，lstsq求残差"""
+    residuals = []
+    for _, X in data.groupby(level=0):
+        signal = X.pop("signal")
+        if 'industry' in X: X = pd.concat([X, pd.get_dummies(X.pop("industry"))], axis=1)
+        else: X['const'] = 1  # 只有市值时，带截距项
+        m = np.linalg.lstsq(X.values.astype(float), signal.values, rcond=None)[0]
+        residuals.append(pd.Series(signal.values - X.values.astype(float) @ m, index=signal.index))
+    return pd.concat(residuals)
+
+
+def __generate_neutralize_data(date_num, stock_num, industry_num=28):
+    factors = __generate_random_factor(date_num, stock_num, nan_ratio=0)
+    industries = {code: str(i % industry_num) for i, code in enumerate(factors.index.levels[1])}
+    return pd.DataFrame({'signal': factors.values,
+                         'industry': factors.index.get_level_values('code').map(industries),
+                         'size': np.random.lognormal(size=len(factors))}, index=factors.index)
+
+
+def test_cross_sectional_residual():
+    data = __generate_neutralize_data(date_num=20, stock_num=100)
+    for columns in [['signal', 'industry'], ['signal', 'size'], ['signal', 'industry', 'size']]:
+        expected = __residual_by_lstsq(data[columns].copy())
+        result = factor_utils.cross_sectional_residual(data['signal'],
+                                                       industry=data['industry'] if 'industry' in columns else None,
+                                                       size=data['size'] if 'size' in columns else None)
+        assert np.allclose(result.values, expected.loc[result.index].values, atol=1e-10), columns
+
+    # 每个行业就1只股票，市值是多余的，残差都是0
+    data = __generate_neutralize_data(date_num=5, stock_num=10, industry_num=10)
+    result = factor_utils.cross_sectional_residual(data['signal'], industry=data['industry'], size=data['size'])
+    assert np.allclose(result.values, 0)
+
+
+def test_neutralize_with_exposures(monkeypatch):
+    """预先算好的市值、行业，和每次现算的，中性化结果一样"""
+    monkeypatch.setattr(factor_utils.datasource_utils, 'compile_industry', lambda s: s)  # 行业名直接当代码用
+    data = __generate_neutralize_data(date_num=20, stock_num=50, industry_num=5)
+    df_stock_basic = data['industry'].groupby(level='code').first().reset_index()
+    df_mv = data['size']
+
+    exposures = factor_utils.neutralize_exposures(df_stock_basic, df_mv)
+    assert exposures[1].index.name == 'code' and len(exposures[1]) == 50
+    result = factor_utils.neutralize(data['signal'], exposures=exposures)
+    assert np.allclose(result.values, factor_utils.neutralize(data['signal'], df_stock_basic, df_mv).values)
+
+    expected = factor_utils.cross_sectional_residual(data['signal'],
+                                                     industry=data['industry'],
+                                                     size=factor_utils.preprocess(df_mv))
+    assert np.allclose(result.values, expected.loc[result.index].values)
+
+
 def test_neutralize():
     """
     测试行业中性化
@@ -107,7 +199,7 @@ def test_handle_finance_ttm():
 
 
 
-def test_handle_finance_ttm():
+def test_handle_finance_fill():
 
 
     start_date = '20180101'
@@ -121,4 +213,100 @@ def test_handle_finance_ttm():
                                           end_date,
                                           finance_index_col_name_value='roe')
     print("ROE:")
-    print(df)
\ No newline at end of file
+    print(df)
+
+def __generate_finance(stock_codes, start_year, end_year):
+    """造季报数据：季末后1个月发布，年报和下一年1季报同一天(4月底)发布，随机缺掉一些报告"""
+    rows = []
+    for code in stock_codes:
+        for year in range(start_year, end_year + 1):
+            for end_date, ann_date in [('0331', '0428'), ('0630', '0828'), ('0930', '1028')]:
+                rows.append([code, f'{year}{ann_date}', f'{year}{end_date}', np.random.random() * 10])
+            rows.append([code, f'{year + 1}0428', f'{year}1231', np.random.random() * 20])
+    df = pd.DataFrame(rows, columns=['code', 'datetime', 'end_date', 'roe'])
+    df = df.drop(df.sample(frac=0.1).index)
+    df = df[df.datetime > f'{start_year}0428']  # 保证第一份报告之前没有交易日
+    return df.sample(frac=1)  # 打乱顺序
+
+
+def __handle_finance_ttm_by_loop(stock_codes, df_finance, trade_dates):
+    """原来的实现：逐只股票、逐日过滤计算"""
+    df_finance = df_finance.dropna().sort_values(['datetime', 'end_date'], kind='stable')
+    rows = []
+    for stock_code in stock_codes:
+        df_stock_finance = df_finance[df_finance['code'] == stock_code]
+        for the_date in trade_dates:
+            last_one = df_stock_finance[df_stock_finance['datetime'] <= the_date].iloc[-1]
+            finance_date, current_value = last_one['end_date'], last_one['roe']
+            if finance_date.endswith("1231"):
+                value = current_value
+            else:
+                def __value(date):
+                    df = df_stock_finance[df_stock_finance['end_date'] == date]
+                    return None if len(df) == 0 else df['roe'].iloc[0]
+
+                last_year_value = __value(utils.last_year(finance_date)[:4] + "1231")
+                last_year_same_period_value = __value(utils.last_year(finance_date))
+                if last_year_value is None or last_year_same_period_value is None:
+                    value = current_value * {'0331': 4, '0630': 2, '0930': 1.33}[finance_date[-4:]]
+                else:
+                    value = current_value + last_year_value - last_year_same_period_value
+            rows.append([the_date, stock_code, current_value, value])
+    return pd.DataFrame(rows, columns=['datetime', 'code', 'roe', 'roe_ttm'])
+
+
+def test_handle_finance_ttm_vectorized():
+    stock_codes = ['600000.SH', '600001.SH', '000001.SZ']
+    df_finance = __generate_finance(stock_codes, 2015, 2019)
+    trade_dates = pd.Series(pd.date_range('20170101', '20191231', freq='B').strftime('%Y%m%d'))
+
+    start_time = time.time()
+    expected = __handle_finance_ttm_by_loop(stock_codes, df_finance, trade_dates)
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    df = factor_utils.handle_finance_ttm(stock_codes, df_finance, trade_dates, col_name_value='roe')
+    vectorized_time = time.time() - start_time
+    print(f"{len(stock_codes)}只股票x{len(trade_dates)}天：逐日循环 {loop_time:.2f} 秒, 向量化 {vectorized_time:.3f} 秒")
+
+    assert list(df.columns) == ['datetime', 'code', 'roe', 'roe_ttm']
+    assert (df[['datetime', 'code']].values == expected[['datetime', 'code']].values).all()
+    assert np.allclose(df['roe'].values, expected['roe'].values)
+    assert np.allclose(df['roe_ttm'].values, expected['roe_ttm'].values)
+
+
+def __fill_finance_by_loop(df_finance, stock_codes, trade_dates, col_name_value):
+    """原来的实现：逐只股票，日历左连接财务数据，再ffill"""
+    df_calender = pd.DataFrame({'datetime': trade_dates})
+    df_result = []
+    for stock_code in stock_codes:
+        df_stock_finance = df_finance[df_finance['code'] == stock_code]
+        df_join = df_calender.merge(df_stock_finance, how="left", on='datetime').sort_values('datetime')
+        df_join = df_join.fillna(method='ffill')
+        df_join['code'] = stock_code
+        df_result.append(df_join)
+    return pd.concat(df_result, ignore_index=True)[['code', 'datetime', col_name_value]]
+
+
+def test_fill_finance_by_trade_dates():
+    stock_codes = [f'{600000 + i}.SH' for i in range(50)]
+    trade_dates = pd.date_range('20180101', '20191231', freq='B').strftime('%Y%m%d')
+    rows = []
+    for code in stock_codes:
+        ann_dates = [trade_dates[0]] + sorted(np.random.choice(trade_dates[1:], 8, replace=False))
+        for ann_date in ann_dates:
+            rows.append([code, ann_date, np.nan if np.random.random() < 0.1 else np.random.random()])
+    df_finance = pd.DataFrame(rows, columns=['code', 'datetime', 'debt_to_assets']).sample(frac=1)
+
+    start_time = time.time()
+    expected = __fill_finance_by_loop(df_finance, stock_codes, trade_dates, 'debt_to_assets')
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    df = factor_utils.fill_finance_by_trade_dates(df_finance.dropna(), stock_codes, trade_dates, 'debt_to_assets')
+    vectorized_time = time.time() - start_time
+    print(f"{len(stock_codes)}只股票x{len(trade_dates)}天：逐只循环 {loop_time:.2f} 秒, 向量化 {vectorized_time:.3f} 秒")
+
+    assert list(df.columns) == ['code', 'datetime', 'debt_to_assets']
+    assert (df[['code', 'datetime']].values == expected[['code', 'datetime']].values).all()
+    assert np.allclose(df['debt_to_assets'].values, expected['debt_to_assets'].values, equal_nan=True)
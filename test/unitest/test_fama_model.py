@@ -0,0 +1,79 @@
+# pytest test/unitest/test_fama_model.py -s
+import time
+
+import numpy as np
+import pandas as pd
+
+from mfm_learner.fama import fama_model
+
+
+def __cal_smb_hml_one_day(df):
+    """原来的实现：一天的截面，map、apply、query分6组"""
+    median = df['circ_mv'].median()
+    df['SB'] = df['circ_mv'].map(lambda x: 'B' if x >= median else 'S')
+    df['BM'] = 1 / df['pb']
+    border_down, border_up = df['BM'].quantile([0.3, 0.7])
+    df['HML'] = df['BM'].map(lambda x: 'H' if x >= border_up else 'M')
+    df['HML'] = df.apply(lambda row: 'L' if row['BM'] <= border_down else row['HML'], axis=1)
+
+    returns = {}
+    for group in ['SL', 'SM', 'SH', 'BL', 'BM', 'BH']:
+        df_group = df.query(f'(SB=="{group[0]}") & (HML=="{group[1]}")')
+        returns[group] = (df_group['pct_chg'] * df_group['circ_mv'] / 100).sum() / df_group['circ_mv'].sum()
+    smb = (returns['SL'] + returns['SM'] + returns['SH'] - returns['BL'] - returns['BM'] - returns['BH']) / 3
+    hml = (returns['SH'] + returns['BH'] - returns['SL'] - returns['BL']) / 2
+    return [smb, hml] + list(returns.values())
+
+
+def __generate_data(date_num, stock_num):
+    dates = pd.date_range('20200101', periods=date_num, freq='B').strftime('%Y%m%d')
+    df = pd.DataFrame([[d, f'{600000 + i}.SH'] for d in dates for i in range(stock_num)], columns=['datetime', 'code'])
+    df['pct_chg'] = np.random.normal(0, 2, len(df))
+    df['circ_mv'] = np.random.lognormal(10, 1, len(df))
+    df['pb'] = np.random.lognormal(0, 0.5, len(df))
+    df.loc[df.sample(frac=0.02).index, 'pct_chg'] = np.nan
+    return df
+
+
+def test_cal_smb_hml():
+    df = __generate_data(date_num=60, stock_num=100)
+
+    start_time = time.time()
+    expected = [[date] + __cal_smb_hml_one_day(df_day.copy()) for date, df_day in df.groupby('datetime')]
+    expected = pd.DataFrame(expected, columns=['datetime', 'SMB', 'HML', 'SL', 'SM', 'SH', 'BL', 'BM', 'BH'])
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    result = fama_model.cal_smb_hml(df)
+    vectorized_time = time.time() - start_time
+    print(f"60天x100只股票：逐日计算 {loop_time:.2f} 秒, 向量化 {vectorized_time:.3f} 秒")
+
+    assert list(result.columns) == list(expected.columns)
+    assert (result['datetime'].values == expected['datetime'].values).all()
+    assert np.allclose(result.iloc[:, 1:].values, expected.iloc[:, 1:].values, equal_nan=True)
+
+
+def test_calculate_factors_cache(monkeypatch):
+    """同样的(股票池, 日期范围)，只算一次"""
+    df = __generate_data(date_num=10, stock_num=20)
+    calls = []
+
+    class MockDataSource():
+        def index_weight(self, index_code, start_date):
+            return df['code'].unique().tolist()
+
+        def daily(self, stock_code, start_date, end_date):
+            calls.append(1)
+            return df[['code', 'datetime', 'pct_chg']]
+
+        def daily_basic(self, stock_code, start_date, end_date):
+            return df[['code', 'datetime', 'circ_mv', 'pb']]
+
+    monkeypatch.setattr(fama_model.datasource_factory, 'get', lambda: MockDataSource())
+    fama_model._cache.clear()
+    df_fama = fama_model.calculate_factors('000905.SH', 20, '20200101', '20200131')
+    assert len(df_fama) == 10 and df_fama.index.name == 'datetime'
+    df_fama['SMB'] = 0  # 改了返回值，不能影响缓存
+    df_fama = fama_model.calculate_factors('000905.SH', 20, '20200101', '20200131')
+    assert len(calls) == 1
+    assert (df_fama['SMB'] != 0).all()
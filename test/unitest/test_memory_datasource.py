@@ -0,0 +1,55 @@
+# pytest test/unitest/test_memory_datasource.py -s
+import pandas as pd
+
+from mfm_learner.datasource.datasource import DataSource, post_query
+from mfm_learner.datasource.impl.memory_datasource import MemoryCacheDataSource
+
+
+class MockDataSource(DataSource):
+    def __init__(self):
+        self.calls = 0
+
+    @post_query
+    def daily(self, stock_code, start_date=None, end_date=None):
+        self.calls += 1
+        if type(stock_code) != list: stock_code = [stock_code]
+        return pd.DataFrame({'ts_code': stock_code, 'trade_date': start_date, 'close': 1.0})
+
+    def trade_cal(self, start_date, end_date, exchange='SSE'):
+        self.calls += 1
+        return pd.Series(['20200102', '20200103'], name='cal_date')
+
+    def get_factor(self, name, stock_codes, start_date, end_date):
+        return name
+
+
+def test_memory_cache():
+    mock = MockDataSource()
+    datasource = MemoryCacheDataSource(mock)
+
+    df = datasource.daily(['000001.SZ', '000002.SZ'], '20200101', '20200201')
+    df['close'] = 2.0  # 调用方修改了返回值，不能污染缓存
+    df = datasource.daily(['000001.SZ', '000002.SZ'], start_date='20200101', end_date='20200201')
+    assert mock.calls == 1
+    assert (df['close'] == 1.0).all()
+    assert list(df.columns) == ['code', 'datetime', 'close']
+
+    datasource.daily('000001.SZ', '20200101', '20200201')
+    assert mock.calls == 2
+
+    datasource.trade_cal('20200101', '20200201')
+    datasource.trade_cal('20200101', '20200201', 'SSE')
+    assert mock.calls == 3
+    assert datasource.hit == 2 and datasource.miss == 3
+
+    assert datasource.get_factor('clv', [], None, None) == 'clv'
+
+
+def test_memory_cache_evict():
+    mock = MockDataSource()
+    datasource = MemoryCacheDataSource(mock, max_size=1)
+    codes = [f'{i:06d}.SZ' for i in range(3000)]
+    for s in ['20200101', '20200102', '20200103']:
+        datasource.daily(codes, s, '20200201')
+    assert datasource.size <= 1024 * 1024
+    assert len(datasource.cache) < 3
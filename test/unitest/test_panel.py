@@ -0,0 +1,116 @@
+# pytest test/unitest/test_panel.py -s
+import numpy as np
+import pandas as pd
+
+from mfm_learner.example.factors import panel
+
+
+def __generate_panel(date_num=300, stock_num=50, nan_ratio=0.05):
+    x = np.random.normal(100, 10, (date_num, stock_num))  # 均值大一些，看看std有没有丢精度
+    x[np.random.random(x.shape) < nan_ratio] = np.nan
+    return x
+
+
+def test_pivot():
+    dates = pd.date_range('20200101', periods=5)
+    df = pd.DataFrame([[d, c, i] for i, (d, c) in enumerate([(d, c) for d in dates for c in ['b', 'a']])],
+                      columns=['datetime', 'code', 'close'])
+    df = df.drop(index=3).sample(frac=1)
+
+    df_panel = panel.pivot(df, 'close')
+    assert df_panel.shape == (5, 2)
+    assert list(df_panel.columns) == ['a', 'b']
+    assert np.isnan(df_panel.values[1, 0])
+
+    series = panel.unpivot(df_panel.values * 2, like=df_panel, name='double')
+    assert series.index.names == ['datetime', 'code']
+    assert len(series) == 9
+    assert series.loc[(dates[2], 'b')] == 8
+
+
+def test_ts_ops():
+    """和pandas按列(即每只股票)的rolling比较"""
+    x = __generate_panel()
+    df = pd.DataFrame(x)
+
+    assert np.allclose(panel.ts_shift(x, 3), df.shift(3).values, equal_nan=True)
+    assert np.allclose(panel.ts_shift(x, -3), df.shift(-3).values, equal_nan=True)
+    assert np.isnan(panel.ts_shift(x, 1000)).all()
+
+    for window, min_periods in [(5, None), (20, 10), (60, 1)]:
+        rolling = df.rolling(window=window, min_periods=min_periods)
+        assert np.allclose(panel.ts_sum(x, window, min_periods), rolling.sum().values, equal_nan=True)
+        assert np.allclose(panel.ts_mean(x, window, min_periods), rolling.mean().values, equal_nan=True)
+        assert np.allclose(panel.ts_std(x, window, min_periods), rolling.std().values, equal_nan=True)
+        assert np.allclose(panel.ts_std(x, window, min_periods, ddof=0), rolling.std(ddof=0).values, equal_nan=True)
+
+    def rank_last(w):
+        if np.isnan(w[-1]): return np.nan
+        return (w[~np.isnan(w)] <= w[-1]).mean()
+
+    expected = df.rolling(window=10, min_periods=5).apply(rank_last, raw=True)
+    assert np.allclose(panel.ts_rank(x, 10, min_periods=5), expected.values, equal_nan=True)
+
+
+def test_ts_ops_skip_nan():
+    """skip_nan，和每只股票去掉nan(停牌)后的rolling一样，nan的那天还是nan"""
+    x = __generate_panel(nan_ratio=0.2)
+    for window, min_periods in [(5, None), (20, 10)]:
+        for func, name in [(panel.ts_sum, 'sum'), (panel.ts_mean, 'mean'), (panel.ts_std, 'std')]:
+            result = func(x, window, min_periods, skip_nan=True)
+            for n in range(x.shape[1]):
+                series = pd.Series(x[:, n]).dropna()
+                expected = getattr(series.rolling(window=window, min_periods=min_periods), name)()
+                expected = expected.reindex(range(len(x))).values
+                assert np.allclose(result[:, n], expected, equal_nan=True)
+
+
+def test_cs_ops():
+    x = __generate_panel()
+    df = pd.DataFrame(x)
+
+    assert np.allclose(panel.cs_rank(x), df.rank(axis=1, pct=True).values, equal_nan=True)
+    expected = df.sub(df.mean(axis=1), axis=0).div(df.std(axis=1), axis=0)
+    assert np.allclose(panel.cs_zscore(x), expected.values, equal_nan=True)
+
+
+def test_ts_regression():
+    """和每只股票单独用statsmodels做回归比较"""
+    import statsmodels.api as sm
+
+    x = np.random.normal(0, 1, (250, 3))
+    y = x @ np.random.normal(0, 1, (3, 20)) + np.random.normal(0, 1, (250, 20))
+    x[5] = np.nan  # 某天没有fama数据
+    y[np.random.random(y.shape) < 0.1] = np.nan  # 停牌
+
+    betas, residuals = panel.ts_regression(y, x)
+    for n in [0, 7, 19]:
+        valid = ~np.isnan(y[:, n]) & ~np.isnan(x).any(axis=1)
+        result = sm.OLS(y[valid, n], sm.add_constant(x[valid])).fit()
+        assert np.allclose(betas[n], result.params)
+        assert np.allclose(residuals[valid, n], result.resid)
+        assert np.isnan(residuals[~valid, n]).all()
+
+    # 不缺数据的，共用一个(X'X)^-1 X'
+    betas, residuals = panel.ts_regression(np.nan_to_num(y), np.nan_to_num(x))
+    result = sm.OLS(np.nan_to_num(y[:, 3]), sm.add_constant(np.nan_to_num(x))).fit()
+    assert np.allclose(betas[3], result.params)
+
+
+def test_ts_regression_residual_std():
+    x = np.random.normal(0, 1, (120, 3))
+    y = x @ np.random.normal(0, 1, (3, 10)) + np.random.normal(0, 1, (120, 10))
+    y[np.random.random(y.shape) < 0.1] = np.nan
+
+    window = 20
+    std = panel.ts_regression_residual_std(y, x, window=window, min_periods=15)
+    for n in [0, 9]:
+        for t in [14, 30, 119]:
+            y_w, x_w = y[max(t - window + 1, 0):t + 1, n], x[max(t - window + 1, 0):t + 1]
+            valid = ~np.isnan(y_w)
+            if valid.sum() < 15 or np.isnan(y[t, n]):
+                assert np.isnan(std[t, n])
+                continue
+            x_v = np.column_stack([np.ones(valid.sum()), x_w[valid]])
+            resid = y_w[valid] - x_v @ np.linalg.lstsq(x_v, y_w[valid], rcond=None)[0]
+            assert np.isclose(std[t, n], resid.std(ddof=1))
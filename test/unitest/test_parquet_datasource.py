@@ -0,0 +1,77 @@
+# pytest test/unitest/test_parquet_datasource.py -s
+import numpy as np
+import pandas as pd
+
+from mfm_learner.datasource.impl.parquet_datasource import ParquetDataSource
+
+
+def __generate_daily(codes, dates):
+    df = pd.DataFrame([[c, d] for c in codes for d in dates], columns=['ts_code', 'trade_date'])
+    df['close'] = np.random.random(len(df))
+    df['open'] = np.random.random(len(df))
+    return df
+
+
+def test_daily(tmp_path):
+    datasource = ParquetDataSource(str(tmp_path))
+    codes = ['600000.SH', '600001.SH', '000001.SZ', '300152.SZ']
+    dates = pd.date_range('20181201', '20200131', freq='B').strftime('%Y%m%d')
+    df_daily = __generate_daily(codes, dates)
+
+    # 分2次写入，第2次追加
+    datasource.write('daily_hfq', df_daily[df_daily.trade_date < '20200101'], mode='replace')
+    datasource.write('daily_hfq', df_daily[df_daily.trade_date >= '20200101'])
+
+    df = datasource.daily(['600000.SH', '300152.SZ'], '20191220', '20200110')
+    df_expected = df_daily[df_daily.ts_code.isin(['600000.SH', '300152.SZ']) &
+                           (df_daily.trade_date >= '20191220') &
+                           (df_daily.trade_date <= '20200110')]
+    assert len(df) == len(df_expected)
+    assert set(df.columns) == {'code', 'datetime', 'close', 'open'}
+    assert df.groupby('code')['datetime'].apply(lambda s: s.is_monotonic_increasing).all()
+    assert np.isclose(df['close'].sum(), df_expected['close'].sum())
+
+    # 列裁剪
+    df = datasource.daily('000001.SZ', '20200101', '20200131', fields='ts_code,trade_date,close')
+    assert list(df.columns) == ['code', 'datetime', 'close']
+    assert (df['code'] == '000001.SZ').all()
+
+
+def test_trade_cal(tmp_path):
+    datasource = ParquetDataSource(str(tmp_path))
+    dates = pd.date_range('20191201', '20200131').strftime('%Y%m%d')
+    df_cal = pd.DataFrame({'exchange': 'SSE', 'cal_date': dates, 'is_open': [1, 0] * (len(dates) // 2)})
+    datasource.write('trade_cal', df_cal, mode='replace')
+
+    trade_dates = datasource.trade_cal('20191225', '20200105')
+    assert trade_dates.tolist() == ['20191225', '20191227', '20191229', '20191231', '20200102', '20200104']
+
+
+def test_null_date(tmp_path):
+    """没有公告日期的财报，丢掉，不影响其他的数据"""
+    datasource = ParquetDataSource(str(tmp_path))
+    df = pd.DataFrame({'ts_code': '600000.SH',
+                       'ann_date': ['20200425', None, '20200829', np.nan],
+                       'netprofit_yoy': [1.0, 2.0, 3.0, 4.0]})
+    datasource.write('fina_indicator', df, mode='replace')
+    df = datasource.fina_indicator('600000.SH', '20200101', '20201231')
+    assert df['netprofit_yoy'].tolist() == [1.0, 3.0]
+
+
+def test_fund_daily(tmp_path, monkeypatch):
+    """本地有就用本地的，没有的话，去tushare取"""
+    from mfm_learner.datasource import datasource_factory
+
+    class MockTushare():
+        def fund_daily(self, fund_code, start_date, end_date):
+            return pd.DataFrame({'code': [fund_code], 'datetime': [start_date], 'close': [1.0]})
+
+    monkeypatch.setattr(datasource_factory, 'create', lambda type=None: MockTushare())
+    datasource = ParquetDataSource(str(tmp_path))
+    df = datasource.fund_daily('510300.SH', '20200101', '20200131')
+    assert df['code'].tolist() == ['510300.SH']
+
+    dates = pd.date_range('20200101', '20200131', freq='B').strftime('%Y%m%d')
+    datasource.write('fund_daily', __generate_daily(['510300.SH', '159915.SZ'], dates), mode='replace')
+    df = datasource.fund_daily('510300.SH', '20200101', '20200110')
+    assert len(df) == 8 and (df['code'] == '510300.SH').all()
@@ -0,0 +1,43 @@
+# pytest test/unitest/test_peg_factor.py -s
+import numpy as np
+import pandas as pd
+
+from mfm_learner.datasource.datasource import post_query
+from mfm_learner.example.factors.peg import PEGFactor
+
+CODES = ['000001.SZ', '600000.SH']
+ANN_DATES = ['20190830', '20191030', '20200425', '20200829']
+
+
+class MockDataSource():
+
+    @post_query
+    def daily_basic(self, stock_code, start_date, end_date):
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')
+        return pd.DataFrame({'ts_code': stock_code, 'trade_date': dates, 'pe': 20.0})
+
+    @post_query
+    def fina_indicator(self, stock_code, start_date, end_date):
+        df = pd.DataFrame({'ts_code': stock_code, 'ann_date': ANN_DATES, 'netprofit_yoy': [5.0, 10.0, 20.0, 40.0]})
+        return df[(df.ann_date >= start_date) & (df.ann_date <= end_date)].reset_index(drop=True)
+
+
+def __create_factor():
+    factor = PEGFactor.__new__(PEGFactor)  # 不调用__init__，防止去连真正的数据源
+    factor.datasource = MockDataSource()
+    return factor
+
+
+def test_incremental_peg():
+    """增量计算的日期里没有发布财报，也要用之前最后发布的那份，和全部计算的结果一样"""
+    factor = __create_factor()
+    df_full = factor.calculate(CODES, '20200101', '20200630')
+    df_incremental = factor.calculate(CODES, '20200601', '20200630')
+
+    assert not df_incremental.isna().any()
+    assert (df_incremental == 20.0 / 20.0).all()  # 用的是20200425发布的
+    assert df_incremental.index.get_level_values('datetime').min() == pd.Timestamp('20200601')
+    expected = df_full[df_full.index.get_level_values('datetime') >= pd.Timestamp('20200601')]
+    assert np.allclose(df_incremental.sort_index().values, expected.sort_index().values)
+    # 年初的，用的是20191030发布的
+    assert (df_full.xs(pd.Timestamp('20200102'), level='datetime') == 20.0 / 10.0).all()
@@ -0,0 +1,48 @@
+# pytest test/unitest/test_preload_datasource.py -s
+import pandas as pd
+
+from mfm_learner.datasource.datasource import DataSource, post_query
+from mfm_learner.datasource.impl.preload_datasource import PreloadDataSource
+
+
+class MockDataSource(DataSource):
+    def __init__(self):
+        self.calls = []
+
+    @post_query
+    def daily_basic(self, stock_code, start_date, end_date):
+        self.calls.append(('daily_basic', stock_code, start_date, end_date))
+        if type(stock_code) != list: stock_code = [stock_code]
+        dates = pd.date_range(start_date, end_date, freq='B').strftime('%Y%m%d')
+        return pd.DataFrame([[c, d, 1.0] for c in stock_code for d in dates], columns=['ts_code', 'trade_date', 'pe'])
+
+    def trade_cal(self, start_date, end_date, exchange='SSE'):
+        self.calls.append(('trade_cal',))
+        return pd.Series(['20200102', '20200103'], name='cal_date')
+
+
+def test_preload():
+    mock = MockDataSource()
+    datasource = PreloadDataSource(mock)
+    codes = ['000001.SZ', '000002.SZ', '600000.SH']
+    datasource.preload('daily_basic', codes, '20190101', '20201231')
+    assert len(mock.calls) == 1
+
+    # 股票、日期范围被覆盖的，从预加载的数据中切出来，和直接取的一样
+    df = datasource.daily_basic(codes[:2], '20200101', '20200331')
+    expected = mock.daily_basic(codes[:2], '20200101', '20200331')
+    assert len(mock.calls) == 2
+    assert df.equals(expected)
+
+    df = PreloadDataSource(mock, datasource.data).daily_basic(stock_code='600000.SH', start_date='20200101',
+                                                              end_date='20200110')
+    assert len(mock.calls) == 2
+    assert (df.code == '600000.SH').all() and len(df) == 8
+
+    # 覆盖不了的，去调被包装的数据源
+    datasource.daily_basic(codes, '20181201', '20200331')
+    datasource.daily_basic(['000004.SZ'], '20200101', '20200331')
+    assert len(mock.calls) == 4
+
+    datasource.trade_cal('20200101', '20200201')
+    assert mock.calls[-1] == ('trade_cal',)
@@ -18,3 +18,35 @@ def test_ivff():
     df = df.set_index(['datetime','code'])
     df = df.unstack('code')
     print(df)
+
+
+def test_calculate_turnover_rate():
+    """和原来的rolling.apply(np.nanmean/np.nanstd)，一只股票一只股票算的结果比较"""
+    import time
+    import numpy as np
+    import pandas as pd
+
+    codes = [f'{600000 + i}.SH' for i in range(20)]
+    dates = pd.date_range('20180101', periods=600, freq='B').strftime('%Y%m%d')
+    data = pd.DataFrame([[d, c] for c in codes for d in dates], columns=['datetime', 'code'])
+    data['turnover_rate'] = np.random.lognormal(size=len(data))
+    data.loc[data.sample(frac=0.05).index, 'turnover_rate'] = np.nan  # 有停牌
+    data['circ_mv'] = 1.0
+    data = data.sample(frac=1)  # 打乱顺序
+
+    turnover_factor = TurnOverFactor.__new__(TurnOverFactor)  # 不调用__init__，防止去连数据源
+    start_time = time.time()
+    results = turnover_factor.calculate_turnover_rate(data.copy())
+    print(f"{len(codes)}只股票x{len(dates)}天，耗时 {time.time() - start_time:.3f} 秒")
+    assert len(results) == len(turnover_factor.name())
+    assert [r.name for r in results] == turnover_factor.name()
+
+    df_stock = data[data.code == codes[3]].sort_values('datetime')
+    expected_1m = df_stock['turnover_rate'].rolling(window=20, min_periods=1).apply(func=np.nanmean).values
+    expected_std_3m = df_stock['turnover_rate'].rolling(window=60, min_periods=2).apply(func=np.nanstd).values
+    expected_2y = df_stock['turnover_rate'].rolling(window=480, min_periods=1).apply(func=np.nanmean).values
+    assert np.allclose(results[0].xs(codes[3], level='code').values, expected_1m, equal_nan=True)
+    assert np.allclose(results[5].xs(codes[3], level='code').values, expected_std_3m, equal_nan=True)
+    expected_bias_6m = df_stock['turnover_rate'].rolling(window=120, min_periods=1).apply(func=np.nanmean).values \
+                       / expected_2y - 1
+    assert np.allclose(results[9].xs(codes[3], level='code').values, expected_bias_6m, equal_nan=True)